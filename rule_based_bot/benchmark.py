@@ -0,0 +1,684 @@
+"""Micro-benchmarks for the MJAI gateway and the rule based bot.
+
+Usage::
+
+    python benchmark.py tiles
+    python benchmark.py serialize
+    python benchmark.py replay [--seat N] [--write-baseline F | --baseline F] [LOG ...]
+    python benchmark.py shanten
+    python benchmark.py decision
+    python benchmark.py scoring
+    python benchmark.py act-batch
+    python benchmark.py load [--tables N] [--workers N | --port P | --unix PATH]
+    python benchmark.py table [--to-json]
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import random
+import time
+import timeit
+
+from mjx.tile import Tile
+from mjx.const import TileType
+
+from gateway import (
+    to_mjx_tile,
+    to_mjai_tile,
+    to_mjx_base_tile,
+    json_dumps,
+    MjxGateway,
+    StageTimer,
+)
+
+
+def _legacy_to_mjx_tile(tile_str: str, ignore_aka: bool = False) -> int:
+    # 表引きにする前の gateway.to_mjx_tile (比較用)
+    match tile_str:
+        case "1m": return 0
+        case "2m": return 4
+        case "3m": return 8
+        case "4m": return 12
+        case "5mr": return 16
+        case "5m": return (16 if ignore_aka else 17)
+        case "6m": return 20
+        case "7m": return 24
+        case "8m": return 28
+        case "9m": return 32
+        case "1p": return 36
+        case "2p": return 40
+        case "3p": return 44
+        case "4p": return 48
+        case "5pr": return 52
+        case "5p": return (52 if ignore_aka else 53)
+        case "6p": return 56
+        case "7p": return 60
+        case "8p": return 64
+        case "9p": return 68
+        case "1s": return 72
+        case "2s": return 76
+        case "3s": return 80
+        case "4s": return 84
+        case "5sr": return 88
+        case "5s": return (88 if ignore_aka else 89)
+        case "6s": return 92
+        case "7s": return 96
+        case "8s": return 100
+        case "9s": return 104
+        case "E": return 108
+        case "S": return 112
+        case "W": return 116
+        case "N": return 120
+        case "P": return 124
+        case "F": return 128
+        case "C": return 132
+
+
+def _legacy_to_mjai_tile(tile_id: int) -> str:
+    # 表引きにする前の gateway.to_mjai_tile (比較用)
+    tile = Tile(tile_id)
+    tile_type = tile.type()
+    match tile_type:
+        case TileType.M1: return "1m"
+        case TileType.M2: return "2m"
+        case TileType.M3: return "3m"
+        case TileType.M4: return "4m"
+        case TileType.M5: return "5mr" if tile.is_red() else "5m"
+        case TileType.M6: return "6m"
+        case TileType.M7: return "7m"
+        case TileType.M8: return "8m"
+        case TileType.M9: return "9m"
+        case TileType.P1: return "1p"
+        case TileType.P2: return "2p"
+        case TileType.P3: return "3p"
+        case TileType.P4: return "4p"
+        case TileType.P5: return "5pr" if tile.is_red() else "5p"
+        case TileType.P6: return "6p"
+        case TileType.P7: return "7p"
+        case TileType.P8: return "8p"
+        case TileType.P9: return "9p"
+        case TileType.S1: return "1s"
+        case TileType.S2: return "2s"
+        case TileType.S3: return "3s"
+        case TileType.S4: return "4s"
+        case TileType.S5: return "5sr" if tile.is_red() else "5s"
+        case TileType.S6: return "6s"
+        case TileType.S7: return "7s"
+        case TileType.S8: return "8s"
+        case TileType.S9: return "9s"
+        case TileType.EW: return "E"
+        case TileType.SW: return "S"
+        case TileType.WW: return "W"
+        case TileType.NW: return "N"
+        case TileType.WD: return "P"
+        case TileType.GD: return "F"
+        case TileType.RD: return "C"
+
+
+def _report(name, legacy_sec, new_sec, calls):
+    print(f"{name:<24} legacy {legacy_sec / calls * 1e9:8.1f} ns/call"
+          f"  new {new_sec / calls * 1e9:8.1f} ns/call"
+          f"  x{legacy_sec / new_sec:.1f}")
+
+
+def bench_tiles(args):
+    tile_strs = [to_mjai_tile(t) for t in range(136)]
+    tile_ids = list(range(136))
+    for tile_str in tile_strs:
+        assert _legacy_to_mjx_tile(tile_str) == to_mjx_tile(tile_str)
+    for tile_id in tile_ids:
+        assert _legacy_to_mjai_tile(tile_id) == to_mjai_tile(tile_id)
+        assert _legacy_to_mjx_tile(_legacy_to_mjai_tile(tile_id)) == to_mjx_base_tile(tile_id)
+
+    number = args.number
+
+    def run(fn, inputs):
+        return timeit.timeit(lambda: [fn(x) for x in inputs], number=number)
+
+    calls = number * 136
+    _report("to_mjx_tile", run(_legacy_to_mjx_tile, tile_strs), run(to_mjx_tile, tile_strs), calls)
+    _report("to_mjai_tile", run(_legacy_to_mjai_tile, tile_ids), run(to_mjai_tile, tile_ids), calls)
+    _report(
+        "id -> base id",
+        run(lambda t: _legacy_to_mjx_tile(_legacy_to_mjai_tile(t)), tile_ids),
+        run(to_mjx_base_tile, tile_ids),
+        calls,
+    )
+
+
+def synthetic_kyoku(seat: int, seed: int = 0, num_draws: int = 70) -> list[dict]:
+    """Generate the MJAI events of a kyoku where everyone just discards what they draw.
+
+    Tiles are dealt from a shuffled wall so that no tile appears more than four times,
+    and everything the given seat cannot see is masked with "?".
+    """
+    rng = random.Random(seed)
+    wall = list(range(136))
+    rng.shuffle(wall)
+    tehais = [[to_mjai_tile(t) for t in wall[13 * i:13 * (i + 1)]] for i in range(4)]
+    events = [{
+        "type": "start_kyoku", "bakaze": "E", "kyoku": 1, "honba": 0, "kyotaku": 0, "oya": 0,
+        "scores": [25000, 25000, 25000, 25000],
+        "dora_marker": to_mjai_tile(wall[52]),
+        "tehais": [tehai if i == seat else ["?"] * 13 for i, tehai in enumerate(tehais)],
+        "can_act": False,
+    }]
+    for i, tile in enumerate(wall[53:53 + num_draws]):
+        actor = i % 4
+        pai = to_mjai_tile(tile)
+        events.append({"type": "tsumo", "actor": actor, "pai": pai if actor == seat else "?", "can_act": actor == seat})
+        events.append({"type": "dahai", "actor": actor, "pai": pai, "tsumogiri": True, "can_act": False})
+    return events
+
+
+def bench_serialize(args):
+    events = synthetic_kyoku(0, seed=args.seed, num_draws=args.draws)
+    legacy = [0.0] * (len(events) - 1)
+    compact = [0.0] * (len(events) - 1)
+    for _ in range(args.number):
+        gateway = MjxGateway(0, None)
+        gateway._apply_mjai_events(events[:1])
+        for i, event in enumerate(events[1:]):
+            gateway._apply_mjai_events([event])
+
+            # 以前の react と同じく base_obs 全体を 2 回シリアライズする
+            start = time.perf_counter()
+            json.dumps(gateway.base_obs.copy())
+            json_dumps(gateway.base_obs.copy())
+            legacy[i] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            gateway.state.to_json()
+            compact[i] += time.perf_counter() - start
+        assert gateway.state.to_json() == json_dumps(gateway.base_obs)
+
+    print(f"{'events':>10} {'legacy us/call':>16} {'compact us/call':>16}")
+    step = args.bucket
+    for begin in range(0, len(legacy), step):
+        end = min(begin + step, len(legacy))
+        scale = 1e6 / (args.number * (end - begin))
+        print(f"{begin + 1:>4}-{end:<5} {sum(legacy[begin:end]) * scale:16.1f}"
+              f" {sum(compact[begin:end]) * scale:16.1f}")
+
+
+def open_log(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path)
+
+
+def synthetic_react_inputs(seat: int, num_kyokus: int = 8, seed: int = 0) -> list[str]:
+    # 従来の MJAI と同じく 1 イベントずつ react に渡す
+    lines = [json_dumps([{"type": "start_game", "id": seat}])]
+    for kyoku in range(num_kyokus):
+        for event in synthetic_kyoku(seat, seed=seed + kyoku):
+            lines.append(json_dumps([event]))
+        lines.append(json_dumps([{"type": "end_kyoku"}]))
+    lines.append(json_dumps([{"type": "end_game"}]))
+    return lines
+
+
+def mask_for_seat(event: dict, seat: int) -> dict:
+    """The event as MJAI sends it to ``seat``, from a full (unmasked) log."""
+    match event.get("type"):
+        case "start_game":
+            return {**event, "id": seat}
+        case "start_kyoku":
+            tehais = [tehai if i == seat else ["?"] * len(tehai) for i, tehai in enumerate(event["tehais"])]
+            return {**event, "tehais": tehais}
+        case "tsumo" if event["actor"] != seat:
+            return {**event, "pai": "?"}
+    return event
+
+
+def replay_sessions(paths: list[str], seats: list[int] | None = None) -> list[tuple[int, list[str]]]:
+    """(seat, react inputs) per log and seat.
+
+    A log is either react() inputs (one JSON array per line, as seen by one seat) or
+    a full MJAI log (one event per line), which is replayed as each of ``seats``.
+    """
+    sessions = []
+    for path in paths:
+        with open_log(path) as f:
+            lines = [line.strip() for line in f if line.strip()]
+        if not lines:
+            continue
+        first = json.loads(lines[0])
+        if isinstance(first, list):
+            seat = next((e["id"] for e in first if e.get("type") == "start_game" and "id" in e), None)
+            sessions.append((seat if seat is not None else (seats or [0])[0], lines))
+            continue
+        events = [json.loads(line) for line in lines]
+        for seat in seats if seats is not None else range(4):
+            sessions.append((seat, [json_dumps([mask_for_seat(e, seat)]) for e in events]))
+    return sessions
+
+
+def _percentile(sorted_values: list[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q / 100))]
+
+
+def _latency_stats(latencies: list[float]) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "p50": _percentile(latencies, 50) * 1e6,
+        "p95": _percentile(latencies, 95) * 1e6,
+        "p99": _percentile(latencies, 99) * 1e6,
+        "mean": sum(latencies) / len(latencies) * 1e6,
+    }
+
+
+def compare_to_baseline(result: dict, baseline: dict, tolerance: float = 0.2, min_count: int = 50) -> list[str]:
+    """Regressions of ``result`` against ``baseline`` (both as written by ``replay --write-baseline``)."""
+    regressions = []
+    if result["throughput"] < baseline["throughput"] / (1 + tolerance):
+        regressions.append(f"throughput {result['throughput']:.0f} react/s < baseline {baseline['throughput']:.0f}")
+    for key, stats in result["latency_us"].items():
+        base = baseline["latency_us"].get(key)
+        if base is None or min(stats["count"], base["count"]) < min_count:
+            continue
+        for q in ["p50", "p95", "p99"]:
+            if stats[q] > base[q] * (1 + tolerance):
+                regressions.append(f"{key} {q} {stats[q]:.1f} us > baseline {base[q]:.1f} us")
+    return regressions
+
+
+def bench_replay(args):
+    import platform
+    import sys
+    from bot import RuleBasedAgent
+    from shanten import ShantenCache
+
+    seats = [args.seat] if args.seat is not None else None
+    if args.logs:
+        sessions = replay_sessions(args.logs, seats)
+    else:
+        sessions = [(seat, synthetic_react_inputs(seat, args.kyokus)) for seat in (seats or range(4))]
+
+    shanten_cache = ShantenCache()
+    stage_timer = StageTimer()
+    latencies = {}
+    num_lines = 0
+    num_acts = 0
+    num_skipped_acts = 0
+    elapsed = 0.0
+    for _ in range(args.repeat):
+        for seat, lines in sessions:
+            gateway = MjxGateway(seat, RuleBasedAgent(shanten_cache=shanten_cache))
+            if args.stages:
+                gateway.enable_timings()
+            for line in lines:
+                acts = gateway.num_acts
+                start = time.perf_counter()
+                gateway.react(line)
+                latency = time.perf_counter() - start
+                elapsed += latency
+                # 最後のイベントの種類ごと、および agent を呼んだ (= 判断した) 呼び出しをまとめて集計する
+                latencies.setdefault(json.loads(line)[-1].get("type"), []).append(latency)
+                if gateway.num_acts > acts:
+                    latencies.setdefault("(decision)", []).append(latency)
+                latencies.setdefault("(all)", []).append(latency)
+            num_lines += len(lines)
+            num_acts += gateway.num_acts
+            num_skipped_acts += gateway.num_skipped_acts
+            if args.stages:
+                stage_timer.merge(gateway.timer)
+
+    result = {
+        "sessions": len(sessions),
+        "react_calls": num_lines,
+        "agent_calls": num_acts,
+        "throughput": num_lines / elapsed,
+        "latency_us": {key: _latency_stats(values) for key, values in sorted(latencies.items())},
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+    }
+
+    print(f"sessions:           {len(sessions)}")
+    print(f"react calls:        {num_lines}")
+    print(f"agent calls:        {num_acts}")
+    print(f"agent calls avoided: {num_skipped_acts}")
+    print(f"total:              {elapsed:.3f} s ({elapsed / num_lines * 1e6:.1f} us/react, {result['throughput']:.0f} react/s)")
+    print(f"{'event':<16} {'count':>8} {'p50 us':>10} {'p95 us':>10} {'p99 us':>10} {'mean us':>10}")
+    for key, stats in result["latency_us"].items():
+        print(f"{key:<16} {stats['count']:>8} {stats['p50']:10.1f} {stats['p95']:10.1f} {stats['p99']:10.1f} {stats['mean']:10.1f}")
+
+    if args.stages:
+        print(f"{'stage':<16} {'count':>8} {'p50 us <':>10} {'p99 us <':>10} {'mean us':>10} {'total ms':>10}")
+        for stage, stats in stage_timer.summary().items():
+            print(f"{stage:<16} {stats['count']:>8} {stats['p50_us_below']:>10} {stats['p99_us_below']:>10}"
+                  f" {stats['mean_us']:10.1f} {stats['total_ms']:10.1f}")
+
+    if args.write_baseline:
+        with open(args.write_baseline, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(result, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regression against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+def bench_shanten(args):
+    import mjx
+    from shanten import (
+        closed_tile_type_counts,
+        table_shanten_number,
+        table_shanten_and_effective_draw_types,
+        _load_tables,
+    )
+
+    rng = random.Random(args.seed)
+    hands = [sorted(rng.sample(range(136), 13)) for _ in range(args.hands)]
+    hand_jsons = [json.dumps({"closedTiles": hand, "opens": []}) for hand in hands]
+    counts = [closed_tile_type_counts(hand) for hand in hands]
+    start = time.perf_counter()
+    _load_tables()
+    print(f"table load:                     {time.perf_counter() - start:.3f} s")
+
+    def run(name, fn, inputs):
+        start = time.perf_counter()
+        for x in inputs:
+            fn(x)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<32} {len(inputs) / elapsed:10.0f} hands/s")
+
+    run("mjx.Hand shanten", lambda s: mjx.Hand(s).shanten_number(), hand_jsons)
+    run("table shanten", table_shanten_number, counts)
+
+    def mjx_effective(s):
+        hand = mjx.Hand(s)
+        return hand.shanten_number(), hand.effective_draw_types()
+
+    run("mjx.Hand shanten + effective", mjx_effective, hand_jsons)
+    run("table shanten + effective", table_shanten_and_effective_draw_types, counts)
+
+
+def late_game_observations(seat: int, seed: int = 0, num_draws: int = 70):
+    """mjx.Observation at every own draw of a synthetic kyoku where the opposite seat declares riichi early."""
+    events = synthetic_kyoku(seat, seed=seed, num_draws=num_draws)
+    riichi_actor = (seat + 2) % 4
+    i = next(i for i, e in enumerate(events) if e["type"] == "dahai" and e["actor"] == riichi_actor)
+    events[i:i + 1] = [
+        {"type": "reach", "actor": riichi_actor},
+        events[i],
+        {"type": "reach_accepted", "actor": riichi_actor},
+    ]
+
+    gateway = MjxGateway(seat, None)
+    observations = []
+    for event in events:
+        if event["type"] == "tsumo" and event["actor"] == seat:
+            observation = gateway._get_mjx_obs([event])
+            # discard_index はその後も更新され続けるので外し、牌譜を走査する経路で比べる
+            del observation.discard_index
+            observations.append(observation)
+        else:
+            gateway._apply_mjai_events([event])
+    return observations
+
+
+def bench_decision(args):
+    from mjx.const import ActionType
+    from bot import DecisionContext, RuleBasedAgent
+
+    agent = RuleBasedAgent()
+    observations = late_game_observations(args.seat, seed=args.seed, num_draws=args.draws)
+
+    def legacy(observation, discards):
+        # 以前の _heuristic_score と同じく候補ごとに牌譜全体を走査し直す
+        return [agent._heuristic_score(DecisionContext(agent, observation), a) for a in discards]
+
+    def with_context(observation, discards):
+        ctx = DecisionContext(agent, observation)
+        return [agent._heuristic_score(ctx, a) for a in discards]
+
+    print(f"{'events':>8} {'candidates':>11} {'legacy us/decision':>19} {'context us/decision':>20} {'ratio':>6}")
+    for observation in observations:
+        discards = [a for a in observation.legal_actions()
+                    if a.type() in [ActionType.DISCARD, ActionType.TSUMOGIRI]]
+        assert legacy(observation, discards) == with_context(observation, discards)
+        legacy_sec = timeit.timeit(lambda: legacy(observation, discards), number=args.number)
+        context_sec = timeit.timeit(lambda: with_context(observation, discards), number=args.number)
+        print(f"{len(observation.events()):>8} {len(discards):>11}"
+              f" {legacy_sec / args.number * 1e6:19.1f} {context_sec / args.number * 1e6:20.1f}"
+              f" {legacy_sec / context_sec:6.1f}")
+
+
+def bench_scoring(args):
+    from mjx.const import ActionType
+    from bot import DecisionContext, RuleBasedAgent, DISCARD_SCORE_SCALE
+
+    agent = RuleBasedAgent()
+    observations = late_game_observations(args.seat, seed=args.seed, num_draws=args.draws)
+    contexts = [DecisionContext(agent, observation) for observation in observations]
+    candidates = [[a for a in observation.legal_actions() if a.type() in [ActionType.DISCARD, ActionType.TSUMOGIRI]]
+                  for observation in observations]
+
+    def per_action():
+        return [[agent._heuristic_score(ctx, a) for a in actions] for ctx, actions in zip(contexts, candidates)]
+
+    def per_decision():
+        return [agent._score_discards([ctx], [actions])[0] for ctx, actions in zip(contexts, candidates)]
+
+    def batch():
+        return agent._score_discards(contexts, candidates)
+
+    expected = per_action()
+    for scores in [per_decision(), batch()]:
+        assert [list(s / DISCARD_SCORE_SCALE) for s in scores] == expected
+
+    num_candidates = sum(len(actions) for actions in candidates)
+    print(f"{len(observations)} decisions, {num_candidates} candidates")
+    for name, fn in [("per action", per_action), ("per decision", per_decision), ("batch", batch)]:
+        sec = timeit.timeit(fn, number=args.number) / args.number
+        print(f"{name:<14} {sec / len(observations) * 1e6:10.1f} us/decision")
+
+
+def bench_act_batch(args):
+    from bot import RuleBasedAgent
+
+    # 複数卓ぶんの観測をまとめて 1 バッチにする
+    observations = []
+    for table in range(args.tables):
+        observations.extend(late_game_observations(table % 4, seed=args.seed + table, num_draws=args.draws))
+
+    agent = RuleBasedAgent()
+    expected = [agent.act(observation).to_json() for observation in observations]
+    assert [action.to_json() for action in agent.act_batch(observations)] == expected
+
+    for name, fn in [
+        ("act", lambda: [agent.act(observation) for observation in observations]),
+        ("act_batch", lambda: agent.act_batch(observations)),
+    ]:
+        sec = timeit.timeit(fn, number=args.number) / args.number
+        print(f"{name:<10} {len(observations) / sec:10.0f} decisions/s")
+    print(f"shanten cache: {agent.shanten_cache_info()}")
+
+
+async def _load_session(connect, lines: list[str], latencies: list[float]) -> None:
+    reader, writer = await connect()
+    for line in lines:
+        start = time.perf_counter()
+        writer.write((line + "\n").encode())
+        await writer.drain()
+        await reader.readline()
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+    await writer.wait_closed()
+
+
+async def _run_load(args) -> None:
+    import tempfile
+    from server import MjaiServer
+
+    server = None
+    tmpdir = None
+    path = args.unix
+    if args.port is None and path is None:
+        # 接続先が指定されなければ同じプロセスでサーバーを立てる
+        tmpdir = tempfile.TemporaryDirectory()
+        path = f"{tmpdir.name}/mjai.sock"
+        mjai_server = MjaiServer(args.workers)
+        server = await mjai_server.start(path=path)
+
+    def connect():
+        if path is not None:
+            return asyncio.open_unix_connection(path)
+        return asyncio.open_connection(args.host, args.port)
+
+    latencies = []
+    sessions = [
+        _load_session(connect, synthetic_react_inputs(seat, args.kyokus, seed=table * args.kyokus), latencies)
+        for table in range(args.tables)
+        for seat in range(4)
+    ]
+    start = time.perf_counter()
+    await asyncio.gather(*sessions)
+    elapsed = time.perf_counter() - start
+
+    if server is not None:
+        server.close()
+        await mjai_server.wait_sessions()
+        await server.wait_closed()
+        mjai_server.shutdown()
+        tmpdir.cleanup()
+
+    latencies.sort()
+    print(f"tables:     {args.tables} ({len(sessions)} connections)")
+    print(f"requests:   {len(latencies)} in {elapsed:.2f} s ({len(latencies) / elapsed:.0f} req/s)")
+    for q in [50, 90, 99]:
+        print(f"p{q:<2}        {latencies[min(len(latencies) - 1, len(latencies) * q // 100)] * 1e3:8.2f} ms")
+    print(f"max         {latencies[-1] * 1e3:8.2f} ms")
+
+
+def bench_load(args):
+    asyncio.run(_run_load(args))
+
+
+def bench_table(args):
+    import tracemalloc
+    from table import TableState, TableGateway
+
+    kyokus = [[synthetic_kyoku(seat, seed=args.seed + k, num_draws=args.draws) for seat in range(4)]
+              for k in range(args.kyokus)]
+
+    def run(make_gateways):
+        # 4 席に同じ順でイベントを配る (--to-json のときは毎回全員の観測を JSON にする)
+        def feed(gateways, kyokus):
+            for events in kyokus:
+                for i in range(len(events[0])):
+                    for seat in range(4):
+                        gateways[seat]._apply_mjai_events([events[seat][i]])
+                        if args.to_json:
+                            gateways[seat].state.to_json()
+
+        gateways = make_gateways()
+        start = time.perf_counter()
+        feed(gateways, kyokus)
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        gateways = make_gateways()
+        feed(gateways, kyokus[:1])
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return elapsed, size
+
+    def separate():
+        return [MjxGateway(seat, None) for seat in range(4)]
+
+    def shared():
+        table = TableState()
+        return [TableGateway(table, seat, None) for seat in range(4)]
+
+    num_events = sum(len(events[0]) for events in kyokus)
+    separate_sec, separate_bytes = run(separate)
+    shared_sec, shared_bytes = run(shared)
+    print(f"events:           {num_events} x 4 seats")
+    print(f"4 MjxGateway      {separate_sec / num_events * 1e6:8.1f} us/event  {separate_bytes / 1024:8.1f} KiB after a kyoku")
+    print(f"TableGateway      {shared_sec / num_events * 1e6:8.1f} us/event  {shared_bytes / 1024:8.1f} KiB after a kyoku")
+    print(f"                  x{separate_sec / shared_sec:.1f} time  x{separate_bytes / shared_bytes:.1f} memory")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    tiles = subparsers.add_parser("tiles", help="tile conversion helpers against the former match based versions")
+    tiles.add_argument("--number", type=int, default=2000)
+    tiles.set_defaults(func=bench_tiles)
+
+    serialize = subparsers.add_parser("serialize", help="observation serialization cost as the kyoku gets longer")
+    serialize.add_argument("--draws", type=int, default=70)
+    serialize.add_argument("--seed", type=int, default=0)
+    serialize.add_argument("--number", type=int, default=200)
+    serialize.add_argument("--bucket", type=int, default=20)
+    serialize.set_defaults(func=bench_serialize)
+
+    replay = subparsers.add_parser("replay", help="react() latency of MjxGateway + RuleBasedAgent per event type over MJAI logs")
+    replay.add_argument("logs", nargs="*", help="plain or gzipped full MJAI logs (one event per line) or react() inputs"
+                        " (one JSON array per line); synthetic kyokus are used when omitted")
+    replay.add_argument("--seat", type=int, default=None, help="replay full logs as this seat only (default: every seat)")
+    replay.add_argument("--kyokus", type=int, default=8)
+    replay.add_argument("--repeat", type=int, default=1)
+    replay.add_argument("--stages", action="store_true", help="also time each stage of react (MjxGateway.enable_timings)")
+    replay.add_argument("--write-baseline", default=None, help="write the results as JSON")
+    replay.add_argument("--baseline", default=None, help="compare against a file written by --write-baseline, exit 1 on regression")
+    replay.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    replay.set_defaults(func=bench_replay)
+
+    shanten = subparsers.add_parser("shanten", help="hands per second of mjx.Hand and the table based shanten engine")
+    shanten.add_argument("--hands", type=int, default=20000)
+    shanten.add_argument("--seed", type=int, default=0)
+    shanten.set_defaults(func=bench_shanten)
+
+    decision = subparsers.add_parser("decision", help="discard scoring with and without a per-decision context")
+    decision.add_argument("--seat", type=int, default=0)
+    decision.add_argument("--seed", type=int, default=0)
+    decision.add_argument("--draws", type=int, default=70)
+    decision.add_argument("--number", type=int, default=20)
+    decision.set_defaults(func=bench_decision)
+
+    scoring = subparsers.add_parser("scoring", help="discard scoring per action, per decision and as one batch")
+    scoring.add_argument("--seat", type=int, default=0)
+    scoring.add_argument("--seed", type=int, default=0)
+    scoring.add_argument("--draws", type=int, default=70)
+    scoring.add_argument("--number", type=int, default=20)
+    scoring.set_defaults(func=bench_scoring)
+
+    act_batch = subparsers.add_parser("act-batch", help="RuleBasedAgent.act against act_batch over many tables")
+    act_batch.add_argument("--tables", type=int, default=16)
+    act_batch.add_argument("--seed", type=int, default=0)
+    act_batch.add_argument("--draws", type=int, default=70)
+    act_batch.add_argument("--number", type=int, default=5)
+    act_batch.set_defaults(func=bench_act_batch)
+
+    load = subparsers.add_parser("load", help="concurrent MJAI sessions against server.py, throughput and latency")
+    load.add_argument("--tables", type=int, default=32)
+    load.add_argument("--kyokus", type=int, default=2)
+    load.add_argument("--workers", type=int, default=None, help="workers of the in-process server")
+    load.add_argument("--host", default="127.0.0.1")
+    load.add_argument("--port", type=int, default=None, help="connect to a running server instead")
+    load.add_argument("--unix", default=None, help="connect to a running server on a Unix socket instead")
+    load.set_defaults(func=bench_load)
+
+    table = subparsers.add_parser("table", help="four seats sharing a TableState against four separate gateways")
+    table.add_argument("--kyokus", type=int, default=8)
+    table.add_argument("--seed", type=int, default=0)
+    table.add_argument("--draws", type=int, default=70)
+    table.add_argument("--to-json", action="store_true", help="also serialize every seat's observation after each event")
+    table.set_defaults(func=bench_table)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,302 @@
+import atexit
+import functools
+import json
 import mjx
+import os
+import queue
 import sys
-import json
-from gateway import MjxGateway
+import threading
+import time
+import numpy as np
+from typing import Any
+from gateway import MjxGateway, meld_revealed_tiles
+from meld import MELDS
+from shanten import ShantenCache, closed_tile_type_counts
 import random
 from mjx.const import ActionType, TileType, EventType
 
+# 打牌候補の特徴量 (1 行 1 候補) の列
+(
+    F_BIAS,
+    F_SHANTEN,
+    F_EFFECTIVE_TILES,
+    F_HONOR,
+    F_TERMINAL,
+    F_TWO_EIGHT,
+    F_FANPAI,
+    F_DORA,
+    F_RED,
+    F_ADJACENCY_HEAD,
+    F_ADJACENCY_RYANMEN,
+    F_ADJACENCY_SKIP,
+    F_ADJACENCY_PENCHAN,
+    F_SAFE,
+    NUM_DISCARD_FEATURES,
+) = range(15)
+
+# 隣接牌の分類 (adjacency_classes) と、その分類ごとの _adjacency_heuristic_score
+ADJACENCY_NONE, ADJACENCY_HEAD, ADJACENCY_RYANMEN, ADJACENCY_SKIP, ADJACENCY_PENCHAN = range(5)
+ADJACENCY_SCORES = (0, 0.2, 0.3, 0.2, 0.1)
+
+
+def _adjacency_class_of_pattern(num, pattern):
+    # 対子でない牌の分類を、同じ色の n-2, n-1, n+1, n+2 を持っているか (pattern の bit 0-3) から決める
+    has = {-2: pattern & 1, -1: pattern & 2, 0: True, 1: pattern & 4, 2: pattern & 8}
+    shuntsu = any(has[start] and has[start + 1] and has[start + 2] for start in range(-2, 1))
+    penchan = not shuntsu and (num in (1, 8) and has[1] or num in (2, 9) and has[-1])
+    if not shuntsu and not penchan and (has[-1] or has[1]):
+        return ADJACENCY_RYANMEN
+    elif has[-2] or has[2]:
+        return ADJACENCY_SKIP
+    elif penchan:
+        return ADJACENCY_PENCHAN
+    return ADJACENCY_NONE
+
+
+# ADJACENCY_CLASSES[数牌の数字 (字牌は 0)][周りの pattern] -> 対子でない牌の隣接牌の分類
+ADJACENCY_CLASSES = tuple(tuple(_adjacency_class_of_pattern(num, pattern) for pattern in range(16)) for num in range(10))
+
+
+def adjacency_classes(closed_tile_types):
+    """Adjacency class of every tile type (34 entries) for the closed tile type counts."""
+    classes = [ADJACENCY_HEAD if c >= 2 else ADJACENCY_NONE for c in closed_tile_types]
+    for suit_begin in (0, 9, 18):
+        # 数字 i + 1 の牌を bit i + 2 に置くと、(present >> i) の bit 0-4 が n-2 から n+2 になる
+        present = 0
+        for i in range(9):
+            if closed_tile_types[suit_begin + i] > 0:
+                present |= 1 << (i + 2)
+        for i in range(9):
+            if classes[suit_begin + i] != ADJACENCY_HEAD:
+                window = present >> i
+                classes[suit_begin + i] = ADJACENCY_CLASSES[i + 1][(window & 3) | ((window >> 1) & 12)]
+    return classes
+
+# 打牌の評価値は特徴量と重みの内積。隣接牌の 0.1 刻みも整数で扱えるよう 10 倍しておく
+DISCARD_SCORE_SCALE = 10
+DISCARD_WEIGHTS = np.zeros(NUM_DISCARD_FEATURES, dtype=np.int64)
+DISCARD_WEIGHTS[F_BIAS] = 130000
+DISCARD_WEIGHTS[F_SHANTEN] = -10000
+# 有効牌は残り枚数 1 枚あたり。4 枚とも残っていれば種類数で数えていたときの 100 と同じ
+DISCARD_WEIGHTS[F_EFFECTIVE_TILES] = 25
+DISCARD_WEIGHTS[F_HONOR] = 60
+DISCARD_WEIGHTS[F_TERMINAL] = 40
+DISCARD_WEIGHTS[F_TWO_EIGHT] = 20
+DISCARD_WEIGHTS[F_FANPAI] = -10
+DISCARD_WEIGHTS[F_DORA] = -20
+DISCARD_WEIGHTS[F_RED] = -20
+DISCARD_WEIGHTS[F_ADJACENCY_HEAD] = -2
+DISCARD_WEIGHTS[F_ADJACENCY_RYANMEN] = -3
+DISCARD_WEIGHTS[F_ADJACENCY_SKIP] = -2
+DISCARD_WEIGHTS[F_ADJACENCY_PENCHAN] = -1
+# リーチ者がいるときにベタオリ用として足す重み
+BETAORI_WEIGHTS = np.zeros(NUM_DISCARD_FEATURES, dtype=np.int64)
+BETAORI_WEIGHTS[F_SAFE] = 200000
+BETAORI_WEIGHTS[F_DORA] = -100000
+BETAORI_WEIGHTS[F_RED] = -100000
+BETAORI_WEIGHTS[F_HONOR] = 2000
+BETAORI_WEIGHTS[F_TERMINAL] = 1000
+
+
+class DecisionContext:
+    """Observation dependent values shared by every scorer within one act() call.
+
+    Riichi players and safe tiles need a scan of the whole event history, so they are
+    computed once per decision instead of once per candidate action.
+    """
+
+    def __init__(self, agent, observation: mjx.Observation) -> None:
+        self.observation = observation
+        self.curr_hand = observation.curr_hand()
+        self.fanpais = agent._fanpais(observation)
+        self.doras = observation.doras()
+        self.riichi_players = agent._get_riichi_players(observation)
+        self.under_riichi = any(self.riichi_players)
+        # 安全牌はリーチ者がいるときにしか使わない。DiscardIndex はこの後も更新されるので写しを持つ
+        self.safe_tiles = [frozenset(s) for s in agent._safe_tiles(observation)] if self.under_riichi else None
+        # 打牌をスコアで選ぶときの候補 (RuleBasedAgent._decide が設定する)
+        self.legal_discards = None
+        # 先読み済みなら、切る牌種 -> (切った後の向聴数, 有効牌の牌種)
+        self.speculated = None
+
+
+class CallTable:
+    """Chi/pon/open kan decisions for one closed hand, filled in as calls are offered.
+
+    Until our next draw or call the closed hand does not change, so whether the
+    agent would take a call only depends on the meld. The table is created on the
+    first call decision for a hand (never after a discard, and never while we are in
+    riichi since no call is offered then) and ``good`` memoizes, per ``(stolen tile
+    type, kind, tile_types)``, what the call path of RuleBasedAgent._decide would
+    answer. ``tenpai`` is whether it would pass every call. ``key`` (the hand and the
+    fanpais) is compared with each observation, so a draw or a call of ours replaces
+    the table.
+    """
+
+    def __init__(self, key, tenpai: bool, is_good) -> None:
+        self.key = key
+        self.tenpai = tenpai
+        self.good = {}
+        # (stolen tile type, kind, tile_types) -> bool。good にない面子で呼ぶ
+        self.is_good = is_good
+        self.fresh = True
+
+    def decide(self, steal_actions, pass_actions):
+        # _decide の鳴き判定と同じ順で、向聴数や役の計算の代わりに表を引く。
+        # (行動, 表にあった値だけで決まったか) を返す
+        hit = not self.fresh
+        self.fresh = False
+        if self.tenpai and len(pass_actions) > 0:
+            return pass_actions[0], hit
+        for action in steal_actions:
+            meld = MELDS[action.open().bit]
+            meld_key = (meld.stolen_tile // 4, meld.kind, meld.tile_types)
+            if meld_key not in self.good:
+                self.good[meld_key] = self.is_good(*meld_key)
+                hit = False
+            if self.good[meld_key]:
+                return action, hit
+        if len(pass_actions) > 0:
+            return pass_actions[0], hit
+        return None, False
+
+
+class DiscardSpeculation:
+    """Discard features of our next turn, computed in a worker thread while we wait.
+
+    After our own discard the closed hand only changes by our next draw (or our
+    own call). ``start`` computes, for each tile type we could still draw, the
+    shanten number and the effective draw types after each possible discard,
+    which is the costly part of _discard_features. The jobs run one after another
+    on a single long-lived worker thread, which has its own ShantenCache so that
+    the agent's cache is never used from two threads. ``lookup`` returns the entry
+    of the drawn tile if it is ready; ``cancel`` (and ``lookup`` itself) only tell
+    the job to stop, so the caller never waits for the worker. ``close`` stops the
+    worker thread.
+
+    The agent times _discard_features with ``record_features``; ``info`` reports
+    its mean time with and without a hit and the draw-to-discard time the hits
+    saved by that difference.
+    """
+
+    def __init__(self, use_table: bool = False) -> None:
+        self.cache = ShantenCache(use_table=use_table)
+        self.key = None
+        self.results = {}
+        self._stop = threading.Event()
+        self._done = threading.Event()
+        self._jobs = queue.SimpleQueue()
+        self._thread = None
+        self.started = 0
+        self.cancelled = 0
+        self.hits = 0
+        self.misses = 0
+        # _discard_features にかかった時間と回数 ([外れ, ヒット])
+        self.features_seconds = [0.0, 0.0]
+        self.features_count = [0, 0]
+
+    def start(self, closed_tile_ids: list[int], opens: list[int], live_tiles: list[int] | None = None) -> None:
+        # live_tiles: 牌種ごとの見えていない残り枚数。0 の牌種はツモれないので計算しない
+        self.cancel()
+        self.key = (frozenset(closed_tile_ids), tuple(opens))
+        # 前の job が書き込んでいるかもしれないので、毎回新しい dict を渡す
+        self.results = {}
+        self._stop = threading.Event()
+        self._done = threading.Event()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+        self._jobs.put((
+            list(closed_tile_ids), list(opens), list(live_tiles) if live_tiles is not None else None,
+            self._stop, self._done, self.results))
+        self.started += 1
+
+    def _work(self) -> None:
+        # None は close から。それまでに積まれた job は止める印が付いているのですぐ終わる
+        while (job := self._jobs.get()) is not None:
+            self._run(*job)
+
+    def _run(self, closed_tile_ids, opens, live_tiles, stop, done, results) -> None:
+        try:
+            counts = list(closed_tile_type_counts(closed_tile_ids))
+            for draw_type in range(34):
+                if stop.is_set():
+                    return
+                if counts[draw_type] == 4 or (live_tiles is not None and live_tiles[draw_type] <= 0):
+                    continue
+                counts[draw_type] += 1
+                after_discard = {}
+                for discard_type in range(34):
+                    if counts[discard_type] == 0:
+                        continue
+                    counts[discard_type] -= 1
+                    after_discard[discard_type] = self.cache.get_counts(counts, opens)
+                    counts[discard_type] += 1
+                counts[draw_type] -= 1
+                results[draw_type] = after_discard
+        finally:
+            done.set()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Block until the current job has finished or stopped (for tests and benchmarks)."""
+        return self._done.wait(timeout)
+
+    def cancel(self) -> None:
+        # 鳴きなどで手牌が変わったら捨てる。止める印を付けるだけで待たない。
+        # worker は牌種 1 つ分の計算を終えたところで次の job に移る
+        if self.key is not None and not self._done.is_set():
+            self._stop.set()
+            self.cancelled += 1
+        self.key = None
+
+    def close(self) -> None:
+        """Stop the worker thread and wait for it to exit; ``start`` starts a new one."""
+        self.cancel()
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def lookup(self, closed_tile_ids: list[int], opens: list[int]):
+        if self.key is None:
+            return None
+        base, base_opens = self.key
+        drawn = set(closed_tile_ids) - base
+        after_discard = None
+        if tuple(opens) == base_opens and len(drawn) == 1 and len(closed_tile_ids) == len(base) + 1:
+            draw_type = drawn.pop() // 4
+            after_discard = self.results.get(draw_type)
+        if after_discard is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.cancel()
+        return after_discard
+
+    def record_features(self, hit: bool, seconds: float) -> None:
+        self.features_seconds[hit] += seconds
+        self.features_count[hit] += 1
+
+    def info(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        miss_us, hit_us = (
+            seconds / count * 1e6 if count else 0.0
+            for seconds, count in zip(self.features_seconds, self.features_count)
+        )
+        # ヒットで短くなった _discard_features の時間 (外れとの平均の差) × ヒットした回数
+        saved_ms = (miss_us - hit_us) * self.features_count[True] / 1e3 if all(self.features_count) else 0.0
+        return {
+            "started": self.started,
+            "cancelled": self.cancelled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "miss_features_us": miss_us,
+            "hit_features_us": hit_us,
+            "saved_ms": saved_ms,
+        }
+
+
 class RuleBasedAgent(mjx.Agent):
     def __init__(self, enable_opens=True,
                  enable_heuristic_score=True,
@@ -15,6 +307,11 @@ class RuleBasedAgent(mjx.Agent):
                  dora_heuristics=True,
                  adjacency_heuristics=True,
                  betaori_heuristics=True,
+                 shanten_cache=None,
+                 use_table_shanten=False,
+                 use_call_table=True,
+                 speculative=False,
+                 live_tile_ukeire=True,
                  verbose=False) -> None:
         super().__init__()
         self.enable_opens = enable_opens
@@ -26,6 +323,19 @@ class RuleBasedAgent(mjx.Agent):
         self.dora_heuristics = dora_heuristics
         self.adjacency_heuristics = adjacency_heuristics
         self.betaori_heuristics = betaori_heuristics
+        # 向聴数の計算はすべてこのキャッシュを通す (複数の agent で共有してもよい)
+        # use_table_shanten なら mjx.Hand の代わりに shanten.py のテーブルで計算する
+        if shanten_cache is None:
+            shanten_cache = ShantenCache(use_table=use_table_shanten)
+        self.shanten_cache = shanten_cache
+        # 最初に鳴きを聞かれたときに作る鳴き判定の表 (席ごと) と、表にあった値だけで答えた回数
+        self.use_call_table = use_call_table
+        self.call_tables = {}
+        self.call_table_hits = 0
+        # speculative なら、自分の打牌から次のツモまでの間に次の打牌の特徴量を別スレッドで計算しておく
+        self.speculation = DiscardSpeculation(use_table=shanten_cache.use_table) if speculative else None
+        # 有効牌を見えていない残り枚数で数える (False なら 1 種 4 枚として種類数で数える)
+        self.live_tile_ukeire = live_tile_ukeire
         self.verbose = verbose
  
     def _fanpais(self, observation):
@@ -34,114 +344,151 @@ class RuleBasedAgent(mjx.Agent):
         fanpais.append(TileType(int(TileType.EW) + (int(observation.who()) - int(observation.dealer()) + 4)% 4))
         return fanpais
 
-    def _is_open_tanyao_or_fanpai(self, observation, open):
-        tiles = open.tiles()
-        fanpais = self._fanpais(observation)
-        ok = None
-        if all([tile.num() is not None and tile.num() >= 2 and tile.num() <= 8 for tile in tiles]) or all([tile.type() in fanpais for tile in tiles]):
-            ok = True
-        else:
-            ok = False
+    def _is_tanyao_or_fanpai(self, fanpais, tile_types):
+        return all([t < TileType.EW and 1 <= t % 9 <= 7 for t in tile_types]) or all([t in fanpais for t in tile_types])
+
+    def _is_open_tanyao_or_fanpai(self, ctx, open):
+        tile_types = MELDS[open.bit].tile_types
+        ok = self._is_tanyao_or_fanpai(ctx.fanpais, tile_types)
         if self.verbose:
             print('open:  ',
-                [int(tile.type()) for tile in open.tiles()],
+                list(tile_types),
                 ok
             )
         return ok
                
+    def shanten_cache_info(self):
+        return self.shanten_cache.info()
+
+    def _hand_ids(self, curr_hand):
+        closed_tile_ids = [tile.id() for tile in curr_hand.closed_tiles()]
+        opens = [open.bit for open in curr_hand.opens()]
+        return closed_tile_ids, opens
+
+    def _shanten_number(self, curr_hand):
+        return self.shanten_cache.shanten_number(*self._hand_ids(curr_hand))
+
+    def _shanten_and_effective_types_after_discard(self, curr_hand, tile_to_discard):
+        closed_tile_ids, opens = self._hand_ids(curr_hand)
+        assert tile_to_discard.id() in closed_tile_ids
+        closed_tile_ids.remove(tile_to_discard.id())
+        return self.shanten_cache.get(closed_tile_ids, opens)
+
     def _shanten_and_effective_tiles_after_discard(self, curr_hand, tile_to_discard):
-        curr_hand_dict = json.loads(curr_hand.to_json())
-        assert tile_to_discard.id() in curr_hand_dict['closedTiles']
-        curr_hand_dict['closedTiles'].remove(tile_to_discard.id())
-        hand_after_discard = mjx.Hand(json.dumps(curr_hand_dict))
-        shanten_number = hand_after_discard.shanten_number()
-        effective_draw_types = hand_after_discard.effective_draw_types()
+        shanten_number, effective_draw_types = self._shanten_and_effective_types_after_discard(curr_hand, tile_to_discard)
         return shanten_number, len(effective_draw_types)
 
     def _is_shanten_reduced_by_open(self, curr_hand, action):
         assert action.type() in [ActionType.CHI, ActionType.PON, ActionType.OPEN_KAN]
-        curr_shanten = curr_hand.shanten_number()
-        ok = False
-        hand_after_open = curr_hand
-        for tile in curr_hand.closed_tiles():
-            if tile.type() in [tile.type() for tile in action.open().tiles()]:
-                continue
-            curr_hand_dict = json.loads(curr_hand.to_json())
-            curr_hand_dict['closedTiles'].append(action.open().stolen_tile().id())
-            curr_hand_dict['closedTiles'].remove(tile.id())
-            hand_after_open = mjx.Hand(json.dumps(curr_hand_dict))
-            shanten_after_open = hand_after_open.shanten_number()
-            if shanten_after_open < curr_shanten:
-                ok = True
-                break
+        # 鳴いた後に手牌のどれか 1 種を切って向聴数が下がるか。牌種の枚数だけで決まるのでキャッシュに任せる
+        closed_tile_ids, opens = self._hand_ids(curr_hand)
+        counts = closed_tile_type_counts(closed_tile_ids)
+        meld = MELDS[action.open().bit]
+        ok, curr_shanten, shanten_after_open, discarded_type = self.shanten_cache.call_reduces_shanten(
+            counts, opens, meld.stolen_tile // 4, meld.tile_types)
         if self.verbose:
+            types_after_open = sorted(t // 4 for t in closed_tile_ids)
+            if discarded_type is not None:
+                types_after_open.append(meld.stolen_tile // 4)
+                types_after_open.remove(discarded_type)
+                types_after_open.sort()
             print('open:  ',
                   [int(tile.type()) for tile in curr_hand.closed_tiles()],
-                  [int(tile.type()) for tile in hand_after_open.closed_tiles()],
+                  types_after_open,
                   curr_shanten,
                   shanten_after_open,
                   ok)     
         return ok
 
     def _adjacency_heuristic_score(self, curr_hand, tile):
-        closed_tile_types = curr_hand.closed_tile_types()
-        def is_single(tile):
-            return closed_tile_types[tile.type()] == 1
-        def is_head(tile):
-            return closed_tile_types[tile.type()] >= 2
-        def is_kotsu(tile):
-            return closed_tile_types[tile.type()] >= 3
-        def has_relative(tile, offset):
-            if offset == 0:
-                return True
-            to_find = int(tile.type()) + offset
-            if to_find < TileType.M1 or to_find > TileType.S9 or int(tile.type()) // 9 != int(to_find) // 9:
-                return False
-            return closed_tile_types[to_find] > 0
-        def is_shuntsu(tile):
-            for start in range(-2, 1):
-                if has_relative(tile, start) and has_relative(tile, start+1) and has_relative(tile, start+2):
-                    return True
-            return False
-        def has_neighbors(tile):
-            return has_relative(tile, -1) or has_relative(tile, 1)
-        def has_skip_neighbors(tile):
-            return has_relative(tile, -2) or has_relative(tile, 2)
-        def is_penchan(tile):
-            return not is_shuntsu(tile) and (
-                tile.num() == 1 and has_relative(tile, 1) or
-                tile.num() == 2 and has_relative(tile, -1) or
-                tile.num() == 8 and has_relative(tile, 1) or
-                tile.num() == 9 and has_relative(tile, -1))
-        def is_ryanmen(tile):
-            return not is_shuntsu(tile) and not is_penchan(tile) and has_neighbors(tile)
-        def is_ryankan(tile):
-            return not is_shuntsu(tile) and not has_neighbors(tile) and (
-                has_relative(tile, -4) and has_relative(tile, -2) or
-                has_relative(tile, -2) and has_relative(tile, 2) or
-                has_relative(tile, 2) and has_relative(tile, 4))
-        score = 0
-        if is_head(tile):
-            score += 0.2
-        elif is_ryanmen(tile):
-            score += 0.3
-        elif has_skip_neighbors(tile):
-            score += 0.2
-        elif is_penchan(tile):
-            score += 0.1
-        return score
+        return ADJACENCY_SCORES[adjacency_classes(curr_hand.closed_tile_types())[tile.type()]]
 
     def _get_riichi_players(self, observation):
+        # MjxGateway が作った観測なら、更新済みの DiscardIndex をそのまま使う
+        discard_index = getattr(observation, "discard_index", None)
+        if discard_index is not None:
+            return list(discard_index.riichi)
         riichi_players = [False] * 4
-        for i in range(4):
-            if any([e.type() == EventType.RIICHI and e.who() == i for e in observation.events()]):
-                riichi_players[i] = True
+        for e in observation.events():
+            if e.type() == EventType.RIICHI:
+                riichi_players[e.who()] = True
         return riichi_players
 
+    def _visible_tiles(self, observation):
+        # 河・晒した牌・ドラ表示牌で見えている枚数 (牌種ごと)。自分の手牌は含まない
+        discard_index = getattr(observation, "discard_index", None)
+        if discard_index is not None:
+            return discard_index.visible
+        visible = [0] * 34
+        for e in observation.events():
+            if e.type() in [EventType.DISCARD, EventType.TSUMOGIRI]:
+                visible[e.tile().type()] += 1
+            elif e.type() in [EventType.CHI, EventType.PON, EventType.CLOSED_KAN, EventType.OPEN_KAN, EventType.ADDED_KAN]:
+                for tile in meld_revealed_tiles(e.open().bit):
+                    visible[tile // 4] += 1
+        for tile in observation.to_proto().public_observation.dora_indicators:
+            visible[tile // 4] += 1
+        return visible
+
+    def _live_tiles(self, ctx):
+        # 自分から見えていない残り枚数。打牌候補を切っても河に移るだけなので、候補によらない
+        closed_tile_types = ctx.curr_hand.closed_tile_types()
+        return [max(0, 4 - v - c) for v, c in zip(self._visible_tiles(ctx.observation), closed_tile_types)]
+
+    def _is_good_call(self, fanpais, counts, opens, stolen_type, kind, tile_types):
+        # _decide の鳴き判定と同じ条件。安い役の判定を先にして、向聴数は役がつくときだけ計算する
+        if self.tanyao_fanpai_aware_opens and not self._is_tanyao_or_fanpai(fanpais, tile_types):
+            return False
+        if self.shanten_aware_opens and not self.shanten_cache.call_reduces_shanten(
+                counts, opens, stolen_type, tile_types)[0]:
+            return False
+        return True
+
+    def _call_table(self, ctx):
+        # 同じ手牌の表があればそれを、なければ作って返す
+        closed_tile_ids, opens = self._hand_ids(ctx.curr_hand)
+        key = (tuple(sorted(closed_tile_ids)), tuple(opens), tuple(ctx.fanpais))
+        call_table = self.call_tables.get(ctx.observation.who())
+        if call_table is None or call_table.key != key:
+            counts = closed_tile_type_counts(closed_tile_ids)
+            tenpai = self.shanten_cache.shanten_number(closed_tile_ids, opens) == 0
+            is_good = functools.partial(self._is_good_call, ctx.fanpais, counts, opens)
+            call_table = CallTable(key, tenpai, is_good)
+            self.call_tables[ctx.observation.who()] = call_table
+        return call_table
+
+    def _after_decision(self, ctx, action):
+        # act と act_batch で共通の後処理。ctx は打牌をスコアで選んだときの DecisionContext (それ以外は None)
+        if self.speculation is None:
+            return
+        if ctx is not None:
+            closed_tile_ids, opens = self._hand_ids(ctx.curr_hand)
+            closed_tile_ids.remove(action.tile().id())
+            # 切った牌も手牌に数えたまま残り枚数を出せば、河に移った分を引いたことになる
+            self.speculation.start(closed_tile_ids, opens, self._live_tiles(ctx))
+        elif action.type() in [ActionType.CHI, ActionType.PON, ActionType.OPEN_KAN]:
+            # 鳴くと手牌が変わるので先読みは使えない
+            self.speculation.cancel()
+
+    def speculation_info(self):
+        return self.speculation.info() if self.speculation is not None else {}
+
+    def close(self):
+        # 先読みの worker thread を止める
+        if self.speculation is not None:
+            self.speculation.close()
+
+    def _uses_call_table(self):
+        return self.use_call_table and self.enable_opens and self.enable_heuristic_score and (
+            self.shanten_aware_opens or self.tanyao_fanpai_aware_opens)
+
     def _under_riichi(self, observation):
         return any(self._get_riichi_players(observation))
 
     def _safe_tiles(self, observation):
+        discard_index = getattr(observation, "discard_index", None)
+        if discard_index is not None:
+            return discard_index.safe_tiles
         discarded = [set() for _ in range(4)]
         safe = [set() for _ in range(4)]
         riichi_players = [False] * 4
@@ -159,79 +506,153 @@ class RuleBasedAgent(mjx.Agent):
                 safe[player].add(t)    
         return safe
 
-    def _betaori_score(self, observation, tile):
-        score = 0
-        riichi_players = self._get_riichi_players(observation)
-        if not any(riichi_players):
-            return score
-        safe_tiles = self._safe_tiles(observation)
-        for player in range(4):
-            if not riichi_players[player]:
-                continue
-            if tile.type() in safe_tiles[player]:
-                score += 20000
-        score -= 10000 * observation.doras().count(tile.type())
-        if tile.is_red():
-            score -= 10000
-        num = tile.num()
-        if num == None:
-            score += 200
-        if num == 1 or num == 9:
-            score += 100
-        return score
-            
-    def _heuristic_score(self, observation, curr_hand, action):
-        shanten, effective_tiles = self._shanten_and_effective_tiles_after_discard(curr_hand, action.tile())
-              
-        score = 13000
-        score -= 1000 * shanten
-        score += 10 * effective_tiles
-        num = action.tile().num()
-        fanpais = self._fanpais(observation)
-        if self.type_heuristics:
+    def _discard_weights(self, ctx):
+        weights = DISCARD_WEIGHTS.copy()
+        if not self.type_heuristics:
+            weights[[F_HONOR, F_TERMINAL, F_TWO_EIGHT]] = 0
+        if not self.fanpai_heuristics:
+            weights[F_FANPAI] = 0
+        if not self.dora_heuristics:
+            weights[[F_DORA, F_RED]] = 0
+        if not self.adjacency_heuristics:
+            weights[[F_ADJACENCY_HEAD, F_ADJACENCY_RYANMEN, F_ADJACENCY_SKIP, F_ADJACENCY_PENCHAN]] = 0
+        if self.betaori_heuristics and ctx.under_riichi:
+            weights += BETAORI_WEIGHTS
+        return weights
+
+    def _discard_features(self, ctx, actions):
+        features = np.zeros((len(actions), NUM_DISCARD_FEATURES), dtype=np.int64)
+        features[:, F_BIAS] = 1
+        classes = adjacency_classes(ctx.curr_hand.closed_tile_types())
+        live_tiles = self._live_tiles(ctx) if self.live_tile_ukeire else None
+        for i, action in enumerate(actions):
+            tile = action.tile()
+            tile_type = tile.type()
+            row = features[i]
+            if ctx.speculated is not None:
+                row[F_SHANTEN], effective_draw_types = ctx.speculated[tile_type]
+            else:
+                row[F_SHANTEN], effective_draw_types = self._shanten_and_effective_types_after_discard(ctx.curr_hand, tile)
+            if live_tiles is not None:
+                row[F_EFFECTIVE_TILES] = sum(live_tiles[t] for t in effective_draw_types)
+            else:
+                row[F_EFFECTIVE_TILES] = 4 * len(effective_draw_types)
+            num = tile.num()
             if num == None:
-                score += 6
-            if num == 1 or num == 9:
-                score += 4
-            if num == 2 or num == 8:
-                score += 2
-        if self.fanpai_heuristics:
-            if action.tile().type() in fanpais:
-                score -= 1
-        if self.dora_heuristics:
-            score -= 2 * observation.doras().count(action.tile().type())
-            if action.tile().is_red():
-                score -= 2
-        if self.adjacency_heuristics:
-            score -= self._adjacency_heuristic_score(curr_hand, action.tile())
-        if self.betaori_heuristics:
-            score += self._betaori_score(observation, action.tile())
+                row[F_HONOR] = 1
+            elif num == 1 or num == 9:
+                row[F_TERMINAL] = 1
+            elif num == 2 or num == 8:
+                row[F_TWO_EIGHT] = 1
+            if tile_type in ctx.fanpais:
+                row[F_FANPAI] = 1
+            row[F_DORA] = ctx.doras.count(tile_type)
+            if tile.is_red():
+                row[F_RED] = 1
+            adjacency = classes[tile_type]
+            if adjacency != ADJACENCY_NONE:
+                row[F_ADJACENCY_HEAD + adjacency - ADJACENCY_HEAD] = 1
+            if ctx.under_riichi:
+                row[F_SAFE] = sum(1 for player in range(4)
+                                  if ctx.riichi_players[player] and tile_type in ctx.safe_tiles[player])
+        return features
+
+    def _timed_discard_features(self, ctx, actions):
+        # 先読みがあれば、ヒットしたかどうか別に _discard_features の時間を数える
+        if self.speculation is None:
+            return self._discard_features(ctx, actions)
+        start = time.perf_counter()
+        features = self._discard_features(ctx, actions)
+        self.speculation.record_features(ctx.speculated is not None, time.perf_counter() - start)
+        return features
+
+    def _score_discards(self, contexts, candidates):
+        """Score the candidate discards of several decisions with one weighted sum.
+
+        ``candidates[i]`` are the discard actions of ``contexts[i]``; returns one array of
+        scores (multiplied by DISCARD_SCORE_SCALE) per decision.
+        """
+        features = np.concatenate([self._timed_discard_features(ctx, actions) for ctx, actions in zip(contexts, candidates)])
+        weights = np.repeat(np.stack([self._discard_weights(ctx) for ctx in contexts]),
+                            [len(actions) for actions in candidates], axis=0)
+        scores = np.einsum("ij,ij->i", features, weights)
         if self.verbose:
-            print('score: ',
-                [int(tile.type()) for tile in curr_hand.closed_tiles()],
-                [[int(tile.type()) for tile in open.tiles()] for open in observation.curr_hand().opens()],
-                action.type(),
-                int(action.tile().type()) if action.tile() else None,
-                shanten,
-                effective_tiles,
-                score,
-            )
-        return score
+            rows = iter(zip(features, scores))
+            for ctx, actions in zip(contexts, candidates):
+                for action in actions:
+                    row, score = next(rows)
+                    print('score: ',
+                        [int(tile.type()) for tile in ctx.curr_hand.closed_tiles()],
+                        [list(MELDS[open.bit].tile_types) for open in ctx.curr_hand.opens()],
+                        action.type(),
+                        int(action.tile().type()) if action.tile() else None,
+                        row[F_SHANTEN],
+                        row[F_EFFECTIVE_TILES],
+                        score / DISCARD_SCORE_SCALE,
+                    )
+        return np.split(scores, np.cumsum([len(actions) for actions in candidates])[:-1])
+
+    def _select_discard(self, scores, actions):
+        # 安定ソートして末尾を取っていたのと同じく、最高点が並んだら後ろの候補を選ぶ
+        return actions[np.flatnonzero(scores == scores.max())[-1]]
+
+    def _heuristic_score(self, ctx, action):
+        return self._score_discards([ctx], [[action]])[0][0] / DISCARD_SCORE_SCALE
 
 
     def act(self, observation: mjx.Observation) -> mjx.Action:
         action = self._act(observation)
+        self._print_acted(observation, action)
+        return action
+
+    def act_batch(self, observations: list[mjx.Observation]) -> list[mjx.Action]:
+        """Same actions as calling act() on each observation, in order.
+
+        Only the discard scoring is batched: the observations that end up choosing a
+        discard are gathered and scored together with a single _score_discards call.
+        Win/riichi, call and kan decisions are taken one by one as in act(), since they
+        are a few comparisons and cache lookups with nothing to vectorize. The shanten
+        cache is shared by all of them.
+        """
+        decided = [self._decide(observation) for observation in observations]
+        contexts = [d if isinstance(d, DecisionContext) else None for d in decided]
+        actions = list(decided)
+        pending = [i for i, ctx in enumerate(contexts) if ctx is not None]
+        if pending:
+            scores = self._score_discards([contexts[i] for i in pending], [contexts[i].legal_discards for i in pending])
+            for i, discard_scores in zip(pending, scores):
+                actions[i] = self._select_discard(discard_scores, contexts[i].legal_discards)
+        # 先読みは 1 つしか持てず、act() を順に呼んでも後処理で残るのは最後の打牌か鳴きの分だけなので、それだけ行う
+        for ctx, action in zip(reversed(contexts), reversed(actions)):
+            if ctx is not None or action.type() in [ActionType.CHI, ActionType.PON, ActionType.OPEN_KAN]:
+                self._after_decision(ctx, action)
+                break
+        for observation, action in zip(observations, actions):
+            self._print_acted(observation, action)
+        return actions
+
+    def _print_acted(self, observation, action):
         if self.verbose:
             print('acted: ',
               [int(tile.type()) for tile in observation.curr_hand().closed_tiles()],
-              [[int(tile.type()) for tile in open.tiles()] for open in observation.curr_hand().opens()],
+              [list(MELDS[open.bit].tile_types) for open in observation.curr_hand().opens()],
               action.type(),
               int(action.tile().type()) if action.tile() else '',
-              [int(tile.type()) for tile in action.open().tiles()] if action.open() else '',
+              list(MELDS[action.open().bit].tile_types) if action.open() else '',
             )
-        return action
 
     def _act(self, observation: mjx.Observation) -> mjx.Action:
+        action = self._decide(observation)
+        ctx = None
+        if isinstance(action, DecisionContext):
+            ctx = action
+            scores = self._score_discards([ctx], [ctx.legal_discards])[0]
+            action = self._select_discard(scores, ctx.legal_discards)  # one with highest heuristic score
+        self._after_decision(ctx, action)
+        return action
+
+    def _decide(self, observation: mjx.Observation):
+        # 打牌をスコアで選ぶ場合は DecisionContext (legal_discards 付き) を返し、評価は呼び出し側でまとめて行う
         curr_hand = observation.curr_hand()
         legal_actions = observation.legal_actions()
         if len(legal_actions) == 1:
@@ -255,20 +676,28 @@ class RuleBasedAgent(mjx.Agent):
             return abort_actions[0]
 
         pass_actions = [a for a in legal_actions if a.type() == ActionType.PASS]
+        ctx = DecisionContext(self, observation)
 
         # pon/chi/open kan
         steal_actions = [a for a in legal_actions if a.type() in [ActionType.CHI, ActionType.PON, ActionType, ActionType.OPEN_KAN]]
         if self.enable_opens and len(steal_actions) >= 1:
-            if self.betaori_heuristics and self._under_riichi(observation) and len(pass_actions) > 0:
+            if self.betaori_heuristics and ctx.under_riichi and len(pass_actions) > 0:
                 return pass_actions[0]
-            if curr_hand.shanten_number() == 0 and len(pass_actions) > 0:
+            call_table = self._call_table(ctx) if self._uses_call_table() else None
+            if call_table is not None:
+                action, hit = call_table.decide(steal_actions, pass_actions)
+                if action is not None:
+                    if hit:
+                        self.call_table_hits += 1
+                    return action
+            elif self._shanten_number(curr_hand) == 0 and len(pass_actions) > 0:
                 return pass_actions[0]
-            if self.shanten_aware_opens or self.tanyao_fanpai_aware_opens:
+            elif self.shanten_aware_opens or self.tanyao_fanpai_aware_opens:
                 for action in steal_actions:
                     good = True
                     if self.shanten_aware_opens and not self._is_shanten_reduced_by_open(curr_hand, action):
                         good = False
-                    if self.tanyao_fanpai_aware_opens and not self._is_open_tanyao_or_fanpai(observation, action.open()):
+                    if self.tanyao_fanpai_aware_opens and not self._is_open_tanyao_or_fanpai(ctx, action.open()):
                         good = False
                     if good:
                         return action
@@ -279,8 +708,8 @@ class RuleBasedAgent(mjx.Agent):
 
         # closed kan/added kan
         kan_actions = [a for a in legal_actions if a.type() in [ActionType.CLOSED_KAN, ActionType.ADDED_KAN]]
-        if self.enable_opens and len(kan_actions) >= 1 and not (self.betaori_heuristics and self._under_riichi(observation)):
-            if curr_hand.shanten_number() == 0:
+        if self.enable_opens and len(kan_actions) >= 1 and not (self.betaori_heuristics and ctx.under_riichi):
+            if self._shanten_number(curr_hand) == 0:
                 return random.choice(kan_actions)
 
         # discard/tsumogiri
@@ -288,8 +717,10 @@ class RuleBasedAgent(mjx.Agent):
         if not legal_discards:
             return random.choice(legal_actions)
         if self.enable_heuristic_score:
-            legal_discards.sort(key=lambda action:self._heuristic_score(observation, curr_hand, action))
-            return legal_discards[-1]  # one with highest heuristic score
+            ctx.legal_discards = legal_discards
+            if self.speculation is not None:
+                ctx.speculated = self.speculation.lookup(*self._hand_ids(curr_hand))
+            return ctx
         else:
             # minimize shanten
             effective_discard_types = observation.curr_hand().effective_discard_types()
@@ -301,13 +732,25 @@ class RuleBasedAgent(mjx.Agent):
 def main():
     player_id = int(sys.argv[1])
     assert player_id in range(4)
-    bot = MjxGateway(player_id, RuleBasedAgent())
+    # MJAI_SPECULATE=1 なら他家の手番の間に次の打牌を先読みし、終了時にヒット率などを stderr に書き出す
+    speculative = os.environ.get("MJAI_SPECULATE") == "1"
+    agent = RuleBasedAgent(speculative=speculative)
+    if speculative:
+        atexit.register(lambda: print(json.dumps(agent.speculation_info()), file=sys.stderr))
+    bot = MjxGateway(player_id, agent)
+    # MJAI_TIMINGS にパス (- なら stderr) があれば、react の区間ごとの時間を終了時に書き出す
+    timings_path = os.environ.get("MJAI_TIMINGS")
+    if timings_path:
+        bot.enable_timings(timings_path)
 
-    while True:
-        line = sys.stdin.readline().strip()
-        resp = bot.react(line)
-        sys.stdout.write(resp + "\n")
-        sys.stdout.flush()
+    try:
+        while True:
+            line = sys.stdin.readline().strip()
+            resp = bot.react(line)
+            sys.stdout.write(resp + "\n")
+            sys.stdout.flush()
+    finally:
+        agent.close()
 
 if __name__ == "__main__":
     main()
@@ -1,110 +1,136 @@
+import abc
+import array
+import atexit
 import json
-from typing import Any
+import sys
+import time
+from typing import Any, Iterable
 
 import mjx
-from mjx.tile import Tile
-from mjx.const import TileType, EventType
 from mjx.agents import (
     RuleBasedAgent,
     ShantenAgent,
 )
 import mjxproto
 
+from meld import MELDS, meld_code
 
-def to_mjx_tile(tile_str: str, ignore_aka: bool = False) -> int:
-    match tile_str:
-        case "1m": return 0
-        case "2m": return 4
-        case "3m": return 8
-        case "4m": return 12
-        case "5mr": return 16
-        case "5m": return (16 if ignore_aka else 17)
-        case "6m": return 20
-        case "7m": return 24
-        case "8m": return 28
-        case "9m": return 32
-        case "1p": return 36
-        case "2p": return 40
-        case "3p": return 44
-        case "4p": return 48
-        case "5pr": return 52
-        case "5p": return (52 if ignore_aka else 53)
-        case "6p": return 56
-        case "7p": return 60
-        case "8p": return 64
-        case "9p": return 68
-        case "1s": return 72
-        case "2s": return 76
-        case "3s": return 80
-        case "4s": return 84
-        case "5sr": return 88
-        case "5s": return (88 if ignore_aka else 89)
-        case "6s": return 92
-        case "7s": return 96
-        case "8s": return 100
-        case "9s": return 104
-        case "E": return 108
-        case "S": return 112
-        case "W": return 116
-        case "N": return 120
-        case "P": return 124
-        case "F": return 128
-        case "C": return 132
+
+MJAI_TILE_TYPES = (
+    "1m", "2m", "3m", "4m", "5m", "6m", "7m", "8m", "9m",
+    "1p", "2p", "3p", "4p", "5p", "6p", "7p", "8p", "9p",
+    "1s", "2s", "3s", "4s", "5s", "6s", "7s", "8s", "9s",
+    "E", "S", "W", "N", "P", "F", "C",
+)
+RED_TILE_IDS = (16, 52, 88)
+
+
+def _build_tile_tables():
+    mjai_to_mjx = {}
+    mjai_to_mjx_ignore_aka = {}
+    for tile_type, tile_str in enumerate(MJAI_TILE_TYPES):
+        base = tile_type * 4
+        if base in RED_TILE_IDS:
+            mjai_to_mjx[tile_str + "r"] = base
+            mjai_to_mjx[tile_str] = base + 1
+            mjai_to_mjx_ignore_aka[tile_str + "r"] = base
+        else:
+            mjai_to_mjx[tile_str] = base
+        mjai_to_mjx_ignore_aka[tile_str] = base
+
+    mjx_to_mjai = tuple(
+        MJAI_TILE_TYPES[tile_id // 4] + ("r" if tile_id in RED_TILE_IDS else "")
+        for tile_id in range(136)
+    )
+    mjx_to_base = tuple(mjai_to_mjx[tile_str] for tile_str in mjx_to_mjai)
+    return mjai_to_mjx, mjai_to_mjx_ignore_aka, mjx_to_mjai, mjx_to_base
+
+
+# 変換は 1 イベントに何度も呼ばれるため、import 時に表を作っておく
+_MJAI_TO_MJX, _MJAI_TO_MJX_IGNORE_AKA, _MJX_TO_MJAI, _MJX_TO_BASE = _build_tile_tables()
+
+
+def to_mjx_tile(tile_str: str, ignore_aka: bool = False) -> int | None:
+    # 知らない牌 ("?" など) は表を引く前と同じく None
+    if ignore_aka:
+        return _MJAI_TO_MJX_IGNORE_AKA.get(tile_str)
+    return _MJAI_TO_MJX.get(tile_str)
 
 
 def to_mjai_tile(tile_id: int) -> str:
-    tile = Tile(tile_id)
-    tile_type = tile.type()
-    tile_num = tile.num()
-    match tile_type:
-        case TileType.M1: return "1m"
-        case TileType.M2: return "2m"
-        case TileType.M3: return "3m"
-        case TileType.M4: return "4m"
-        case TileType.M5: return "5mr" if tile.is_red() else "5m"
-        case TileType.M6: return "6m"
-        case TileType.M7: return "7m"
-        case TileType.M8: return "8m"
-        case TileType.M9: return "9m"
-        case TileType.P1: return "1p"
-        case TileType.P2: return "2p"
-        case TileType.P3: return "3p"
-        case TileType.P4: return "4p"
-        case TileType.P5: return "5pr" if tile.is_red() else "5p"
-        case TileType.P6: return "6p"
-        case TileType.P7: return "7p"
-        case TileType.P8: return "8p"
-        case TileType.P9: return "9p"
-        case TileType.S1: return "1s"
-        case TileType.S2: return "2s"
-        case TileType.S3: return "3s"
-        case TileType.S4: return "4s"
-        case TileType.S5: return "5sr" if tile.is_red() else "5s"
-        case TileType.S6: return "6s"
-        case TileType.S7: return "7s"
-        case TileType.S8: return "8s"
-        case TileType.S9: return "9s"
-        case TileType.EW: return "E"
-        case TileType.SW: return "S"
-        case TileType.WW: return "W"
-        case TileType.NW: return "N"
-        case TileType.WD: return "P"
-        case TileType.GD: return "F"
-        case TileType.RD: return "C"
-
-    raise ValueEerror(f"Invalid tile_id: {tile_id}")
+    if not 0 <= tile_id < 136:
+        raise ValueError(f"Invalid tile_id: {tile_id}")
+    return _MJX_TO_MJAI[tile_id]
+
+
+def to_mjx_base_tile(tile_id: int, ignore_aka: bool = False) -> int:
+    """Same as ``to_mjx_tile(to_mjai_tile(tile_id), ignore_aka)`` without the round trip."""
+    if ignore_aka:
+        return tile_id - tile_id % 4
+    return _MJX_TO_BASE[tile_id]
+
+
+# 同じ種類の 4 枚の既出ビット (下位ビットほど小さい id) -> まだ出ていない最小のオフセット (すべて既出なら -1)
+_LOWEST_UNSEEN = tuple(
+    next((offset for offset in range(4) if not (mask >> offset) & 1), -1)
+    for mask in range(16)
+)
+
+
+def lowest_unseen_tile(seen: int, tile_type: int, exclude_red: bool = False) -> int:
+    """Smallest id of ``tile_type`` whose bit is not set in the 136-bit ``seen`` mask, or -1."""
+    base = tile_type * 4
+    mask = (seen >> base) & 15
+    if exclude_red and base in RED_TILE_IDS:
+        mask |= 1
+    offset = _LOWEST_UNSEEN[mask]
+    return base + offset if offset >= 0 else -1
 
 
 def json_dumps(json_data):
     return json.dumps(json_data, separators=(",", ":"))
 
 
+def _unseen_consumed_tiles(consumed: list[str], seen: int) -> list[int]:
+    # 赤は id が決まっている。それ以外は赤を除いたまだ出ていない最小の id (出尽くしていれば最小の id)
+    tiles = []
+    for pai in consumed:
+        if pai.endswith("r"):
+            t = to_mjx_tile(pai)
+        else:
+            t = lowest_unseen_tile(seen, to_mjx_tile(pai) // 4, exclude_red=True)
+            if t < 0:
+                t = to_mjx_tile(pai)
+        seen |= 1 << t
+        tiles.append(t)
+    return tiles
+
+
+def _own_consumed_tiles(consumed: list[str], closed_tiles: list[int]) -> list[int]:
+    # 自家の手牌から同じ種類の小さい id 順に取る。consumed の赤の表記は手牌と合わないことがあるので
+    # (test_case21) 赤は区別しない
+    remaining = list(closed_tiles)
+    tiles = []
+    for pai in consumed:
+        tile_type = to_mjx_tile(pai, ignore_aka=True) // 4
+        t = min(t for t in remaining if t // 4 == tile_type)
+        remaining.remove(t)
+        tiles.append(t)
+    return tiles
+
+
 class OpenCodeGen:
+    """MJAI の鳴きイベントから mjx の open code と手牌から抜く牌 id を作る。
+
+    chi / pon は鳴いた牌 (直前の打牌) の id と、自家なら手牌 ``closed_tiles``、
+    他家ならまだ払い出していない牌 id の ``seen`` マスクから牌 id を決める。
+    """
+
     def __init__(self):
         pass
 
     @staticmethod
-    def from_mjai_kan(ev: dict[str, Any], obs: dict[str, Any]) -> tuple[int, list[int]]:
+    def from_mjai_kan(ev: dict[str, Any]) -> tuple[int, list[int]]:
         pai = ev["consumed"][0]
         base = to_mjx_tile(pai, ignore_aka=True) // 4
 
@@ -117,125 +143,64 @@ class OpenCodeGen:
             rel_pos = 0
             called = 0
 
-        value = rel_pos
-        value += ((base * 4 + called) << 8)
-
-        new_op = mjx.open.Open(value)
-        consume_tiles_from_hand = [t.id() for t in new_op.tiles_from_hand()]
+        kind = mjxproto.EVENT_TYPE_OPEN_KAN if rel_pos else mjxproto.EVENT_TYPE_CLOSED_KAN
+        value = meld_code(kind, base, called, range(base * 4, base * 4 + 4), rel_pos)
+        consume_tiles_from_hand = list(MELDS[value].tiles_from_hand)
 
         return value, consume_tiles_from_hand
 
     @staticmethod
-    def from_mjai_kakan(ev: dict[str, Any], obs: dict[str, Any]) -> tuple[int, list[int], int, int]:
+    def from_mjai_kakan(ev: dict[str, Any], open_codes: Iterable[int]) -> tuple[int, list[int], int, int]:
+        # open_codes: 加槓した人の副露 (自家なら手牌の opens、他家なら DiscardIndex.pons) から対応するポンを探す
         pai_base = to_mjx_tile(ev['pai'], ignore_aka=True) // 4
 
-        if ev["actor"] == obs["who"]:
-            # 自家の対応する open を探す
-            op = None
-            for open_code in obs["privateObservation"]["currHand"]["opens"]:
-                op = mjx.open.Open(open_code)
-                open_pai_base = op.tiles()[0].id() // 4
-                if pai_base == open_pai_base:
-                    break
-        else:
-            # 他家
-            op = None
-            for event in obs["publicObservation"]["events"]:
-                if "type" in event and event["type"] == "EVENT_TYPE_PON":
-                    open_code = event["open"]
-                    op = mjx.open.Open(open_code)
-                    open_pai_base = op.tiles()[0].id() // 4
-                    if pai_base == open_pai_base:
-                        break
-
-        assert op is not None
+        pon_code = next((
+            open_code for open_code in open_codes
+            if MELDS[open_code].kind == mjxproto.EVENT_TYPE_PON and MELDS[open_code].tile_types[0] == pai_base
+        ), None)
+        assert pon_code is not None
+        pon = MELDS[pon_code]
 
-        # pon flag を削除して kan flag を立てる
-        value = ((0xffff ^ (1 << 3)) & op.bit) | (1 << 4)
+        # 同じポンに残りの 1 枚を加えた加槓
+        value = meld_code(mjxproto.EVENT_TYPE_ADDED_KAN, pai_base, pon.called, pon.tiles, pon.rel_pos)
+        kan = MELDS[value]
 
-        new_op = mjx.open.Open(value)
-        consume_tiles_from_hand = [t.id() for t in new_op.tiles_from_hand()]
-        called_tile_id = new_op.last_tile().id()
-
-        return value, consume_tiles_from_hand, called_tile_id, op.bit
+        return value, list(kan.tiles_from_hand), kan.last_tile, pon_code
 
     @staticmethod
-    def from_mjai_pon(ev: dict[str, Any], obs: dict[str, Any]) -> tuple[int, list[int]]:
+    def from_mjai_pon(
+        ev: dict[str, Any], called_tile_id: int, closed_tiles: list[int] | None = None, seen: int = 0,
+    ) -> tuple[int, list[int]]:
         pai = ev["pai"]
         base = to_mjx_tile(pai, ignore_aka=True)
         base_lowest = base // 4
 
-        called_tile = obs["publicObservation"]["events"][-1]["tile"] - base
+        called_tile = called_tile_id - base
         called = 2
         if pai[-1] == "r":
             called = 0
 
-        if ev["actor"] == obs["who"]:
-            consume_tiles_from_hand = [
-                t for t in obs["privateObservation"]["currHand"]["closedTiles"]
-                if to_mjx_tile(to_mjai_tile(t), ignore_aka=True) == base
-            ][:2]
-
-            available_codes = [0, 1, 2, 3]
-            for t in consume_tiles_from_hand[:2]:
-                available_codes.remove(t - base)
-            available_codes.remove(called_tile)
-            not_pon = available_codes[0]  # pon していない牌
+        if closed_tiles is not None:
+            consume_tiles_from_hand = _own_consumed_tiles(ev["consumed"], closed_tiles)
         else:
-            not_consume_tiles_from_hand = [
-                t for t in obs["privateObservation"]["currHand"]["closedTiles"]
-                if to_mjx_tile(to_mjai_tile(t), ignore_aka=True) == base
-            ] + [
-                t for t in obs["publicObservation"]["doraIndicators"]
-                if to_mjx_tile(to_mjai_tile(t), ignore_aka=True) == base
-            ]
-
-            candidates = [
-                0 + to_mjx_tile(ev['pai'], ignore_aka=True),
-                1 + to_mjx_tile(ev['pai'], ignore_aka=True),
-                2 + to_mjx_tile(ev['pai'], ignore_aka=True),
-                3 + to_mjx_tile(ev['pai'], ignore_aka=True),
-            ]
-            candidates.remove(called_tile + base)
-            for t in not_consume_tiles_from_hand:
-                candidates.remove(t)
-
-            for e in obs["publicObservation"]["events"][:-1]:
-                if e not in ['tile', 'open']:
-                    continue
-                e = mjx.Event(e)
-                if e.type() == EventType.EVENT_TYPE_DRAW:
-                    t = e.tile().id()
-                    if t in candidates:
-                        candidates.remove(t)
-                elif e.type() == EventType.EVENT_TYPE_CHI:
-                    for t in e.open().tiles():
-                        t = t.id()
-                        if t in candidates:
-                            candidates.remove(t)
-                elif e.type() == EventType.EVENT_TYPE_PON:
-                    for t in e.open().tiles():
-                        t = t.id()
-                        if t in candidates:
-                            candidates.remove(t)
-
-            consume_tiles_from_hand = candidates[:2]
-
-            available_codes = [0, 1, 2, 3]
-            for t in consume_tiles_from_hand[:2]:
-                available_codes.remove(t - base)
-            available_codes.remove(called_tile)
-            not_pon = available_codes[0]  # pon していない牌
+            # 他家: まだ払い出していない牌 id から選ぶ
+            consume_tiles_from_hand = _unseen_consumed_tiles(ev["consumed"], seen)
+
+        available_codes = [0, 1, 2, 3]
+        for t in consume_tiles_from_hand:
+            available_codes.remove(t - base)
+        available_codes.remove(called_tile)
+        not_pon = available_codes[0]  # pon していない牌
 
         rel_pos = (ev["target"] - ev["actor"] + 4) % 4
-        value = rel_pos
-        value += (1 << 3)
-        value += (not_pon << 5)  # not pon
-        value += ((base_lowest * 3 + called) << 9)
+        pon_tiles = [base + i for i in range(4) if i != not_pon]
+        value = meld_code(mjxproto.EVENT_TYPE_PON, base_lowest, called, pon_tiles, rel_pos)
         return value, consume_tiles_from_hand
 
     @staticmethod
-    def from_mjai_chi(ev: dict[str, Any], obs: dict[str, Any]):
+    def from_mjai_chi(
+        ev: dict[str, Any], called_tile_id: int, closed_tiles: list[int] | None = None, seen: int = 0,
+    ) -> tuple[int, list[int]]:
         pai = ev['pai']
         consumed = ev['consumed']
         rel_pos = (ev["target"] - ev["actor"] + 4) % 4
@@ -247,360 +212,507 @@ class OpenCodeGen:
         ])
 
         # Which tile out of the three was called
-        tile_from_last_event = obs["publicObservation"]["events"][-1]["tile"]
         called = (to_mjx_tile(pai, ignore_aka=True) - base) // 4
 
-        if ev["actor"] == obs["who"]:
-            consume0_candidates = [
-                t for t in obs["privateObservation"]["currHand"]["closedTiles"]
-                if (t // 4) == (to_mjx_tile(consumed[0], ignore_aka=True) // 4)
-            ]
-            consume0 = consume0_candidates[0]
-            consume1_candidates = [
-                t for t in obs["privateObservation"]["currHand"]["closedTiles"]
-                if (t // 4) == (to_mjx_tile(consumed[1], ignore_aka=True) // 4)
-            ]
-            consume1 = consume1_candidates[0]
+        if closed_tiles is not None:
+            consume0, consume1 = _own_consumed_tiles(consumed, closed_tiles)
         else:
-            if consumed[0].endswith('r'):
-                consume0 = to_mjx_tile(consumed[0])
-            else:
-                consume0_base = to_mjx_tile(consumed[0])
-                consume0_candidates = [
-                    0 + consume0_base,
-                    1 + consume0_base,
-                    2 + consume0_base,
-                    3 + consume0_base,
-                ]
-                if consumed[0].startswith('5'):
-                    consume0_candidates.remove(consume0_base)  # 赤ドラを除外する
-
-                for t in obs["privateObservation"]["initHand"]["closedTiles"]:
-                    if t in consume0_candidates:
-                        consume0_candidates.remove(t)
-                for e in obs["publicObservation"]["events"]:
-                    if e not in ['tile', 'open']:
-                        continue
-                    e = mjx.Event(e)
-                    if e.type() == EventType.EVENT_TYPE_DRAW:
-                        t = e.tile().id()
-                        if t in consume0_candidates:
-                            consume0_candidates.remove(t)
-                    elif e.type() == EventType.EVENT_TYPE_CHI:
-                        for t in e.open().tiles():
-                            t = t.id()
-                            if t in consume0_candidates:
-                                consume0_candidates.remove(t)
-                    elif e.type() == EventType.EVENT_TYPE_PON:
-                        for t in e.open().tiles():
-                            t = t.id()
-                            if t in consume0_candidates:
-                                consume0_candidates.remove(t)
-                consume0 = consume0_candidates[0]
-
-            # ２個目の消費（他家の鳴き）
-            if consumed[1].endswith('r'):
-                consume1 = to_mjx_tile(consumed[1])
-            else:
-                consume1_base = to_mjx_tile(consumed[1])
-                consume1_candidates = [
-                    0 + consume1_base,
-                    1 + consume1_base,
-                    2 + consume1_base,
-                    3 + consume1_base,
-                ]
-                if consumed[1].startswith('5'):
-                    consume1_candidates.remove(consume1_base)  # 赤ドラを除外する
-
-                for t in obs["privateObservation"]["initHand"]["closedTiles"]:
-                    if t in consume1_candidates:
-                        consume1_candidates.remove(t)
-                for e in obs["publicObservation"]["events"]:
-                    if e not in ['tile', 'open']:
-                        continue
-                    e = mjx.Event(e)
-                    if e.type() == EventType.EVENT_TYPE_DRAW:
-                        t = e.tile().id()
-                        if t in consume1_candidates:
-                            consume1_candidates.remove(t)
-                    elif e.type() == EventType.EVENT_TYPE_CHI:
-                        for t in e.open().tiles():
-                            t = t.id()
-                            if t in consume1_candidates:
-                                consume1_candidates.remove(t)
-                    elif e.type() == EventType.EVENT_TYPE_PON:
-                        for t in e.open().tiles():
-                            t = t.id()
-                            if t in consume1_candidates:
-                                consume1_candidates.remove(t)
-                consume1 = consume1_candidates[0]
+            # 他家: まだ払い出していない牌 id から選ぶ
+            consume0, consume1 = _unseen_consumed_tiles(consumed, seen)
 
         # pai, consumed に赤ドラがある場合のために ignore_aka=True と比較する
         if called == 0:
             called_base = to_mjx_tile(ev['pai'])
-            t0 = obs["publicObservation"]["events"][-1]["tile"] - called_base
+            t0 = called_tile_id - called_base
             t1 = consume0 - to_mjx_tile(consumed[0], ignore_aka=True)
             t2 = consume1 - to_mjx_tile(consumed[1], ignore_aka=True)
         elif called == 1:
             called_base = to_mjx_tile(ev['pai'])
-            t1 = obs["publicObservation"]["events"][-1]["tile"] - called_base
+            t1 = called_tile_id - called_base
             t0 = consume0 - to_mjx_tile(consumed[0], ignore_aka=True)
             t2 = consume1 - to_mjx_tile(consumed[1], ignore_aka=True)
         else:
             called_base = to_mjx_tile(ev['pai'])
-            t2 = obs["publicObservation"]["events"][-1]["tile"] - called_base
+            t2 = called_tile_id - called_base
             t0 = consume0 - to_mjx_tile(consumed[0], ignore_aka=True)
             t1 = consume1 - to_mjx_tile(consumed[1], ignore_aka=True)
 
         base_lowest = base // 4
-        value = ((base_lowest // 9) * 7 + base_lowest % 9) * 3 + called
-        value = value << 10
-        value += (t2 << 7)
-        value += (t1 << 5)
-        value += (t0 << 3)
-        value += (1 << 2)
-        value += rel_pos
+        chi_tiles = [base + t0, base + 4 + t1, base + 8 + t2]
+        value = meld_code(mjxproto.EVENT_TYPE_CHI, base_lowest, called, chi_tiles, rel_pos)
         return value, [consume0, consume1]
 
 
-class MjxGateway:
-    def __init__(self, actor_id, mjx_bot):
-        self.actor_id = actor_id
-        self.mjx_bot = mjx_bot
-        self.base_obs = {}
-        self.hai_offset = {}
-
-    def get_obs_open(self) -> list[int]:
-        if len(self.base_obs) == 0:
-            raise ValueError("Kyoku not started.")
-        return self.base_obs["privateObservation"]["currHand"]["opens"]
-
-    def get_obs_hand(self) -> list[int]:
-        if len(self.base_obs) == 0:
-            raise ValueError("Kyoku not started.")
-        return self.base_obs["privateObservation"]["currHand"]["closedTiles"]
+def event_row(event_type: int, who: int, tile: int | None = None, open_code: int | None = None) -> dict[str, Any]:
+    # mjx の Observation JSON の publicObservation.events の 1 行と同じ形
+    row = {}
+    if event_type != mjxproto.EVENT_TYPE_DISCARD:
+        row["type"] = mjxproto.EventType.Name(event_type)
+    if tile is not None:
+        row["tile"] = tile
+    if open_code is not None:
+        row["open"] = open_code
+    if who > 0 or event_type == mjxproto.EVENT_TYPE_RIICHI:
+        row["who"] = who
+    return row
 
-    def get_obs(self) -> dict[str, Any]:
-        return self.base_obs
 
-    def set_obs_offset(self, base_obs, hai_offset) -> None:
-        self.base_obs = base_obs
-        self.hai_offset = hai_offset
-
-    def get_legal_actions(self) -> list[Any]:
-        obs = mjx.Observation(json.dumps(self.base_obs.copy()))
-        return obs.legal_actions()
-
-    def _get_mjx_obs(self, mjai_events):
-        # 1. MJAI の入力を MJX に変換して Game Client に渡す
-        for mjai_event in mjai_events:
-            mjai_event_type = mjai_event.get("type")
-
-            match mjai_event_type:
-                case "start_kyoku":
-                    tehais = [to_mjx_tile(s) for s in mjai_event["tehais"][self.actor_id]]
-
-                    # Initialize hai_offset
-                    self.hai_offset = {}
-                    self.hai_offset[to_mjx_tile(mjai_event["dora_marker"])] = 1
-                    for i, hai in enumerate(tehais):
-                        tehais[i] += self.hai_offset.get(hai, 0)
-                        self.hai_offset[hai] = self.hai_offset.get(hai, 0) + 1
-
-                    self.base_obs = {
-                        "who": self.actor_id,
-                        "publicObservation": {
-                            "playerIds": ["player_0","player_1","player_2","player_3"],
-                            "initScore": {
-                                "tens": mjai_event["scores"],
-                            },
-                            "doraIndicators": [
-                                to_mjx_tile(mjai_event["dora_marker"])
-                            ],
-                            "events": [],
-                        },
-                        "privateObservation": {
-                            "who": self.actor_id,
-                            "initHand": {
-                                "closedTiles": tehais,
-                            },
-                            "drawHistory": [],
-                            "currHand": {
-                                "closedTiles": list(sorted(tehais)),
-                                "opens": [],
-                            }
-                        }
-                    }
+_PLAYER_IDS_JSON = json_dumps(["player_0","player_1","player_2","player_3"])
 
-                case "tsumo":
-
-                    if self.actor_id == mjai_event["actor"]:
-                        hai = to_mjx_tile(mjai_event["pai"])
-                        hai_ = hai + self.hai_offset.get(hai, 0)
-                        self.hai_offset[hai] = self.hai_offset.get(hai, 0) + 1
-
-                        # Update obs
-                        self.base_obs["privateObservation"]["drawHistory"].append(hai_)
-                        self.base_obs["privateObservation"]["currHand"]["closedTiles"].append(hai_)
-                        self.base_obs["privateObservation"]["currHand"]["closedTiles"] = list(sorted(
-                            self.base_obs["privateObservation"]["currHand"]["closedTiles"]
-                        ))
-
-                    # Add event
-                    row = {"type": "EVENT_TYPE_DRAW"}
-                    if mjai_event["actor"] > 0:
-                        row["who"] = mjai_event["actor"]
-
-                    self.base_obs["publicObservation"]["events"].append(row)
-
-                case "dahai":
-                    hai = to_mjx_tile(mjai_event["pai"])
-
-                    if self.actor_id == mjai_event["actor"]:
-                        remove_candidates = [
-                            t for t in self.base_obs["privateObservation"]["currHand"]["closedTiles"]
-                            if to_mjx_tile(to_mjai_tile(t)) == hai
-                        ]
-                        hai_ = remove_candidates[0]
-
-                        # Update obs
-                        self.base_obs["privateObservation"]["currHand"]["closedTiles"].remove(hai_)
-
-                    else:
-                        # 自分ではない場合、新規に出現するため hai をインクリメントする
-                        hai_ = hai + self.hai_offset.get(hai, 0)
-                        self.hai_offset[hai] = self.hai_offset.get(hai, 0) + 1
-
-                    row = {
-                        "tile": hai_,
-                    }
-                    if mjai_event["actor"] > 0:
-                        row["who"] = mjai_event["actor"]
-                    self.base_obs["publicObservation"]["events"].append(row)
-
-                case "chi":
-                    open_code, consume_tiles_from_hand = OpenCodeGen.from_mjai_chi(
-                        mjai_event, self.base_obs
-                    )
-
-                    if self.actor_id == mjai_event["actor"]:
-                        # Update obs
-                        self.base_obs["privateObservation"]["currHand"]["opens"].append(open_code)
-                        for t in consume_tiles_from_hand:
-                            self.base_obs["privateObservation"]["currHand"]["closedTiles"].remove(t)
-
-                    row = {
-                        "type": "EVENT_TYPE_CHI",
-                        "open": open_code,
-                    }
-                    if mjai_event["actor"] > 0:
-                        row["who"] = mjai_event["actor"]
-
-                    self.base_obs["publicObservation"]["events"].append(row)
-
-                case "pon":
-                    open_code, consume_tiles_from_hand = OpenCodeGen.from_mjai_pon(
-                        mjai_event, self.base_obs)
-
-                    if self.actor_id == mjai_event["actor"]:
-                        # Update obs
-                        self.base_obs["privateObservation"]["currHand"]["opens"].append(open_code)
-                        for t in consume_tiles_from_hand:
-                            self.base_obs["privateObservation"]["currHand"]["closedTiles"].remove(t)
-
-                    row = {
-                        "type": "EVENT_TYPE_PON",
-                        "open": open_code,
-                    }
-                    if mjai_event["actor"] > 0:
-                        row["who"] = mjai_event["actor"]
+# CompactHand の手牌: 牌種ごとの 4 bit (bit i が id type * 4 + i) -> 持っている id、最小のオフセット
+_HELD_TILES = tuple(
+    tuple(tuple(tile_type * 4 + i for i in range(4) if (mask >> i) & 1) for mask in range(16))
+    for tile_type in range(34)
+)
+_LOWEST_HELD = tuple(next((i for i in range(4) if (mask >> i) & 1), -1) for mask in range(16))
+# to_mjx_base_tile の値 -> 同じ牌とみなす id のビット (赤と赤でない 5 を区別する)
+_HELD_MASK_OF_BASE = tuple(
+    (1 if base in RED_TILE_IDS else 14 if base - 1 in RED_TILE_IDS else 15) for base in range(136)
+)
 
-                    self.base_obs["publicObservation"]["events"].append(row)
 
-                case "reach":
-                    row = {
-                        "type": "EVENT_TYPE_RIICHI",
-                        "who": mjai_event["actor"],
-                    }
-                    self.base_obs["publicObservation"]["events"].append(row)
+class CompactHand:
+    """配牌・ツモ・手牌・副露だけの、ある家から見た観測の非公開部分
+
+    手牌は牌種ごとに 4 枚のどの id を持っているかのビット (34 種 x 4 枚) で持ち、
+    ツモも打牌も O(1) で更新する。並んだ牌 id の list は必要になったときに作る。
+    CompactObservationState と table.SeatState が公開部分の持ち方だけを変えて使う。
+    """
+
+    __slots__ = ("init_hand", "draw_history", "held", "hand_opens", "_closed_tiles")
+
+    def _start_hand(self, init_hand: list[int]) -> None:
+        self.init_hand = array.array("B", init_hand)
+        self.draw_history = array.array("B")
+        self._set_hand(init_hand)
+        self.hand_opens = array.array("H")
+
+    def _set_hand(self, tiles: list[int]) -> None:
+        self.held = bytearray(34)
+        for t in tiles:
+            self.held[t >> 2] |= 1 << (t & 3)
+        self._closed_tiles = None
+
+    def _sorted_closed_tiles(self) -> list[int]:
+        if self._closed_tiles is None:
+            self._closed_tiles = [t for tile_type, mask in enumerate(self.held) if mask for t in _HELD_TILES[tile_type][mask]]
+        return self._closed_tiles
+
+    def closed_tiles(self) -> list[int]:
+        return self._sorted_closed_tiles()[:]
+
+    def opens(self) -> list[int]:
+        return self.hand_opens.tolist()
+
+    def draw(self, tile: int) -> None:
+        self.draw_history.append(tile)
+        self.held[tile >> 2] |= 1 << (tile & 3)
+        self._closed_tiles = None
+
+    def remove_closed_tile(self, tile: int) -> None:
+        bit = 1 << (tile & 3)
+        if not self.held[tile >> 2] & bit:
+            raise ValueError(f"{tile} is not in the hand")
+        self.held[tile >> 2] ^= bit
+        self._closed_tiles = None
+
+    def take_closed_tile(self, hai: int) -> int:
+        # hai (赤は区別する) と同じ牌のうち最小の id を手牌から除く
+        tile_type = hai >> 2
+        offset = _LOWEST_HELD[self.held[tile_type] & _HELD_MASK_OF_BASE[hai]]
+        if offset < 0:
+            raise IndexError(f"{hai} is not in the hand")
+        self.held[tile_type] ^= 1 << offset
+        self._closed_tiles = None
+        return tile_type * 4 + offset
+
+    def add_open(self, open_code: int) -> None:
+        self.hand_opens.append(open_code)
+
+    def remove_open(self, open_code: int) -> None:
+        self.hand_opens.remove(open_code)
+
+    def _private_dict(self, who: int) -> dict[str, Any]:
+        return {
+            "who": who,
+            "initHand": {
+                "closedTiles": self.init_hand.tolist(),
+            },
+            "drawHistory": self.draw_history.tolist(),
+            "currHand": {
+                "closedTiles": self.closed_tiles(),
+                "opens": self.hand_opens.tolist(),
+            }
+        }
+
+    def _private_json(self, who: int) -> str:
+        # json_dumps(self._private_dict(who)) と同じ文字列
+        return (
+            '{"who":' + str(who)
+            + ',"initHand":{"closedTiles":' + json_dumps(self.init_hand.tolist())
+            + '},"drawHistory":' + json_dumps(self.draw_history.tolist())
+            + ',"currHand":{"closedTiles":' + json_dumps(self._sorted_closed_tiles())
+            + ',"opens":' + json_dumps(self.hand_opens.tolist())
+            + '}}'
+        )
+
+
+class CompactObservationState(CompactHand):
+    """mjx の Observation JSON と同じ形の観測を小さなオブジェクトで保持する
+
+    非公開部分は CompactHand。events は (type, who, tile, open) のタプルで、各家の河 (捨てた牌 id) も別に持つ。
+    mjx の形にするのは to_json (act に渡すとき) と to_dict (get_obs) のときだけで、
+    events の行の dict と JSON は必要になった分だけ作って使い回す。
+    """
+
+    __slots__ = (
+        "who", "scores", "dora_indicators", "events", "rivers",
+        "_event_rows", "_events_count", "_events_json",
+    )
+
+    def __init__(self, obs: dict[str, Any] | None = None):
+        self.who = None
+        self.events = []
+        self._event_rows = []
+        self._events_count = 0
+        self._events_json = ""
+        if obs:
+            self._load(obs)
+
+    def _load(self, obs: dict[str, Any]) -> None:
+        public = obs["publicObservation"]
+        private = obs["privateObservation"]
+        self.start_kyoku(
+            obs.get("who", 0),
+            list(public["initScore"]["tens"]),
+            public["doraIndicators"][0],
+            list(private["initHand"]["closedTiles"]),
+        )
+        self.dora_indicators = list(public["doraIndicators"])
+        self.draw_history = array.array("B", private["drawHistory"])
+        self._set_hand(private["currHand"]["closedTiles"])
+        self.hand_opens = array.array("H", private["currHand"]["opens"])
+        for row in public["events"]:
+            event_type = mjxproto.EventType.Value(row["type"]) if "type" in row else mjxproto.EVENT_TYPE_DISCARD
+            self.append_event(event_type, row.get("who", 0), row.get("tile"), row.get("open"))
+
+    def is_empty(self) -> bool:
+        return self.who is None
+
+    def start_kyoku(self, who: int, scores: list[int], dora_indicator: int, init_hand: list[int]) -> None:
+        self.who = who
+        self.scores = scores
+        self.dora_indicators = [dora_indicator]
+        self.events = []
+        self.rivers = tuple(array.array("B") for _ in range(4))
+        self._start_hand(init_hand)
+        self._event_rows = []
+        self._events_count = 0
+        self._events_json = ""
+
+    def append_event(self, event_type: int, who: int, tile: int | None = None, open_code: int | None = None) -> None:
+        self.events.append((event_type, who, tile, open_code))
+        if event_type == mjxproto.EVENT_TYPE_DISCARD and tile is not None:
+            self.rivers[who].append(tile)
+
+    def add_dora_indicator(self, tile: int) -> None:
+        self.dora_indicators.append(tile)
+
+    def last_event_who(self) -> int:
+        return self.events[-1][1]
+
+    def _rows(self) -> list[dict[str, Any]]:
+        rows = self._event_rows
+        for event in self.events[len(rows):]:
+            rows.append(event_row(*event))
+        return rows
+
+    def to_dict(self) -> dict[str, Any]:
+        if self.who is None:
+            return {}
+        return {
+            "who": self.who,
+            "publicObservation": {
+                "playerIds": ["player_0","player_1","player_2","player_3"],
+                "initScore": {
+                    "tens": self.scores,
+                },
+                "doraIndicators": self.dora_indicators,
+                "events": self._rows()[:],
+            },
+            "privateObservation": self._private_dict(self.who),
+        }
+
+    def _events_json_prefix(self) -> str:
+        if self._events_count < len(self.events):
+            rows = self._rows()
+            new_rows = ",".join(json_dumps(row) for row in rows[self._events_count:])
+            self._events_json = self._events_json + "," + new_rows if self._events_json else new_rows
+            self._events_count = len(rows)
+        return self._events_json
+
+    def to_json(self) -> str:
+        # json_dumps(self.to_dict()) と同じ文字列
+        return (
+            '{"who":' + str(self.who)
+            + ',"publicObservation":{"playerIds":' + _PLAYER_IDS_JSON
+            + ',"initScore":{"tens":' + json_dumps(self.scores)
+            + '},"doraIndicators":' + json_dumps(self.dora_indicators)
+            + ',"events":[' + self._events_json_prefix()
+            + ']},"privateObservation":' + self._private_json(self.who)
+            + '}'
+        )
+
+
+def meld_revealed_tiles(open_code: int) -> tuple[int, ...]:
+    # 鳴いた牌は河で数えているので、手牌から晒した牌だけ (加槓は加えた 1 枚)
+    meld = MELDS[open_code]
+    return (meld.last_tile,) if meld.kind == mjxproto.EVENT_TYPE_ADDED_KAN else meld.tiles_from_hand
+
+
+MELD_EVENT_TYPES = (
+    "EVENT_TYPE_CHI", "EVENT_TYPE_PON", "EVENT_TYPE_CLOSED_KAN", "EVENT_TYPE_OPEN_KAN", "EVENT_TYPE_ADDED_KAN")
+
+
+class DiscardIndex:
+    """Per-player discarded tile types, riichi status, melds and visible tiles of the current kyoku.
+
+    Updated as the gateway applies each dahai / reach event so that the agent does
+    not have to replay ``observation.events()``. ``safe_tiles[p]`` is what
+    RuleBasedAgent._safe_tiles computes from the same events: the types p has
+    discarded plus every type discarded by anyone after p's last discard.
+    ``visible[t]`` counts the copies of tile type t that everybody can see: the
+    rivers, the tiles melds took from hands and the dora indicators.
+    """
 
-                case "ankan":
-                    open_code, consume_tiles_from_hand = OpenCodeGen.from_mjai_kan(
-                        mjai_event, self.base_obs)
-
-                    if self.actor_id == mjai_event["actor"]:
-                        # Update obs
-                        self.base_obs["privateObservation"]["currHand"]["opens"].append(open_code)
-                        for t in consume_tiles_from_hand:
-                            self.base_obs["privateObservation"]["currHand"]["closedTiles"].remove(t)
-
-                    row = {
-                        "type": "EVENT_TYPE_CLOSED_KAN",
-                        "open": open_code,
-                    }
-                    if mjai_event["actor"] > 0:
-                        row["who"] = mjai_event["actor"]
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.discarded = [set() for _ in range(4)]
+        self.safe_tiles = [set() for _ in range(4)]
+        self.num_discards = [0] * 4
+        self.riichi = [False] * 4
+        # リーチ宣言までに自分が打牌した枚数 (リーチしていなければ None)
+        self.riichi_turn = [None] * 4
+        # ポンした牌の種類 -> open code (他家の加槓の open code を作るのに使う。加槓したら消す)
+        self.pons = {}
+        self.visible = [0] * 34
+
+    def discard(self, who: int, tile_type: int, tsumogiri: bool = False) -> None:
+        self.discarded[who].add(tile_type)
+        for safe in self.safe_tiles:
+            safe.add(tile_type)
+        if not tsumogiri:
+            self.safe_tiles[who] = set(self.discarded[who])
+        self.num_discards[who] += 1
+        self.visible[tile_type] += 1
+
+    def declare_riichi(self, who: int) -> None:
+        if not self.riichi[who]:
+            self.riichi[who] = True
+            self.riichi_turn[who] = self.num_discards[who]
+
+    def meld(self, who: int, open_code: int) -> None:
+        m = MELDS[open_code]
+        if m.kind == mjxproto.EVENT_TYPE_PON:
+            self.pons[m.tile_types[0]] = open_code
+        elif m.kind == mjxproto.EVENT_TYPE_ADDED_KAN:
+            self.pons.pop(m.tile_types[0], None)
+        for tile in meld_revealed_tiles(open_code):
+            self.visible[tile // 4] += 1
+
+    def reveal_dora_indicator(self, tile_type: int) -> None:
+        self.visible[tile_type] += 1
+
+    @classmethod
+    def from_events(cls, events: list[dict[str, Any]], dora_indicators: list[int] = ()) -> "DiscardIndex":
+        # dict 形式の観測の events から作り直す (DISCARD の行は "type" が省略されている)
+        index = cls()
+        for tile in dora_indicators:
+            index.reveal_dora_indicator(tile // 4)
+        for e in events:
+            event_type = e.get("type", "EVENT_TYPE_DISCARD")
+            if event_type in ["EVENT_TYPE_DISCARD", "EVENT_TYPE_TSUMOGIRI"]:
+                index.discard(e.get("who", 0), e.get("tile", 0) // 4, event_type == "EVENT_TYPE_TSUMOGIRI")
+            elif event_type == "EVENT_TYPE_RIICHI":
+                index.declare_riichi(e.get("who", 0))
+            elif event_type in MELD_EVENT_TYPES:
+                index.meld(e.get("who", 0), e.get("open", 0))
+        return index
+
+
+class StageTimer:
+    """Histograms of the time MjxGateway.react spends in each stage.
+
+    Stages: ``parse`` (json.loads), ``convert`` (_apply_mjai_events, including
+    ``open_code``, the OpenCodeGen calls), ``observation`` (serialization,
+    add_legal_actions and mjx.Observation), ``act``, ``response``
+    (_get_mjai_response) and ``total`` (the whole react call). Bucket i counts
+    the samples below 2**i microseconds.
+    """
+
+    STAGES = ("parse", "convert", "open_code", "observation", "act", "response", "total")
+    NUM_BUCKETS = 24
 
-                    self.base_obs["publicObservation"]["events"].append(row)
+    def __init__(self):
+        self.histograms = {stage: [0] * self.NUM_BUCKETS for stage in self.STAGES}
+        self.totals = {stage: 0.0 for stage in self.STAGES}
+        self.maxima = {stage: 0.0 for stage in self.STAGES}
+
+    def add(self, stage: str, seconds: float) -> None:
+        bucket = min(int(seconds * 1e6).bit_length(), self.NUM_BUCKETS - 1)
+        self.histograms[stage][bucket] += 1
+        self.totals[stage] += seconds
+        if seconds > self.maxima[stage]:
+            self.maxima[stage] = seconds
+
+    def lap(self, stage: str, start: float) -> float:
+        # start からの経過時間を stage に加え、次の区間の開始時刻を返す
+        now = time.perf_counter()
+        self.add(stage, now - start)
+        return now
+
+    def merge(self, other: "StageTimer") -> None:
+        for stage in self.STAGES:
+            self.histograms[stage] = [a + b for a, b in zip(self.histograms[stage], other.histograms[stage])]
+            self.totals[stage] += other.totals[stage]
+            self.maxima[stage] = max(self.maxima[stage], other.maxima[stage])
+
+    def _quantile_us(self, stage: str, q: float) -> int:
+        # 分位点を含むバケットの上限
+        histogram = self.histograms[stage]
+        rank = q * sum(histogram)
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if count and seen >= rank:
+                return 1 << bucket
+        return 0
+
+    def summary(self) -> dict[str, dict[str, Any]]:
+        result = {}
+        for stage in self.STAGES:
+            count = sum(self.histograms[stage])
+            if count == 0:
+                continue
+            result[stage] = {
+                "count": count,
+                "total_ms": self.totals[stage] * 1e3,
+                "mean_us": self.totals[stage] / count * 1e6,
+                "p50_us_below": self._quantile_us(stage, 0.5),
+                "p99_us_below": self._quantile_us(stage, 0.99),
+                "max_us": self.maxima[stage] * 1e6,
+                "histogram": {f"<{1 << bucket}us": n for bucket, n in enumerate(self.histograms[stage]) if n},
+            }
+        return result
+
+    def dump(self, path: str | None = None) -> None:
+        text = json.dumps(self.summary(), indent=2)
+        if path is None or path == "-":
+            print(text, file=sys.stderr)
+        else:
+            with open(path, "w") as f:
+                f.write(text + "\n")
+
+
+def seen_tiles_from_obs(obs: dict[str, Any]) -> int:
+    """The seen-tile mask of MjxGateway built from an observation dict."""
+    public = obs.get("publicObservation", {})
+    private = obs.get("privateObservation", {})
+    tiles = list(public.get("doraIndicators", []))
+    tiles += private.get("initHand", {}).get("closedTiles", [])
+    tiles += private.get("drawHistory", [])
+    tiles += private.get("currHand", {}).get("closedTiles", [])
+    open_codes = list(private.get("currHand", {}).get("opens", []))
+    for event in public.get("events", []):
+        if "tile" in event:
+            tiles.append(event["tile"])
+        if "open" in event:
+            open_codes.append(event["open"])
+    for open_code in open_codes:
+        tiles += MELDS[open_code].tiles
+    seen = 0
+    for t in tiles:
+        seen |= 1 << t
+    return seen
+
+
+class BaseGateway(abc.ABC):
+    """MJAI の入出力と mjx_bot.act の呼び出し。
+
+    観測 ``state`` の作り方 (``_new_state``) と MJAI イベントの反映 (``_apply_mjai_events``) は
+    サブクラスが決める。act に渡す観測には ``discard_index`` を添える。
+    """
 
-                case "kakan":
-                    open_code, consume_tiles_from_hand, called_tile_id, pon_open_code = OpenCodeGen.from_mjai_kakan(
-                        mjai_event, self.base_obs)
+    def __init__(self, actor_id, mjx_bot):
+        self.actor_id = actor_id
+        self.mjx_bot = mjx_bot
+        self.state = self._new_state()
 
-                    if self.actor_id == mjai_event["actor"]:
-                        # Update obs
-                        self.base_obs["privateObservation"]["currHand"]["opens"].append(open_code)
-                        self.base_obs["privateObservation"]["currHand"]["opens"].remove(pon_open_code)
-                        self.base_obs["privateObservation"]["currHand"]["closedTiles"].remove(called_tile_id)
+        # mjx_bot.act を呼んだ回数と、行動できないため省いた回数
+        self.num_acts = 0
+        self.num_skipped_acts = 0
+        # enable_timings を呼ぶまでは None (react は計測しない)
+        self.timer = None
+        # 終了時に書き出す先 (同じ先へは一度だけ登録する)
+        self.timings_dump_paths = set()
 
-                    row = {
-                        "type": "EVENT_TYPE_ADDED_KAN",
-                        "open": open_code,
-                    }
+    @abc.abstractmethod
+    def _new_state(self, obs=None):
+        """空の観測、obs (dict) があればそこから作った観測を返す"""
 
-                    if mjai_event["actor"] > 0:
-                        row["who"] = mjai_event["actor"]
+    @abc.abstractmethod
+    def _apply_mjai_events(self, mjai_events):
+        """MJAI イベントを state と discard_index に反映する"""
 
-                    self.base_obs["publicObservation"]["events"].append(row)
+    @property
+    def base_obs(self) -> dict[str, Any]:
+        return self.state.to_dict()
 
-                case "daiminkan":
-                    open_code, consume_tiles_from_hand = OpenCodeGen.from_mjai_kan(
-                        mjai_event, self.base_obs)
+    def get_obs_open(self) -> list[int]:
+        if self.state.is_empty():
+            raise ValueError("Kyoku not started.")
+        return self.state.opens()
 
-                    if self.actor_id == mjai_event["actor"]:
-                        # Update obs
-                        self.base_obs["privateObservation"]["currHand"]["opens"].append(open_code)
-                        for t in consume_tiles_from_hand:
-                            self.base_obs["privateObservation"]["currHand"]["closedTiles"].remove(t)
+    def get_obs_hand(self) -> list[int]:
+        if self.state.is_empty():
+            raise ValueError("Kyoku not started.")
+        return self.state.closed_tiles()
 
-                    row = {
-                        "type": "EVENT_TYPE_OPEN_KAN",
-                        "open": open_code,
-                    }
-                    if mjai_event["actor"] > 0:
-                        row["who"] = mjai_event["actor"]
+    def get_obs(self) -> dict[str, Any]:
+        return self.state.to_dict()
 
-                    self.base_obs["publicObservation"]["events"].append(row)
+    def enable_timings(self, dump_path: str | None = None) -> StageTimer:
+        """Time each stage of react from now on; with ``dump_path`` ("-" for stderr) dump them at exit."""
+        if self.timer is None:
+            self.timer = StageTimer()
+        if dump_path is not None and dump_path not in self.timings_dump_paths:
+            self.timings_dump_paths.add(dump_path)
+            atexit.register(self.timer.dump, dump_path)
+        return self.timer
 
-                case "reach_accepted":
-                    pass
+    def stage_timings(self) -> dict[str, dict[str, Any]]:
+        return self.timer.summary() if self.timer is not None else {}
 
-                case _:
-                    # self.base_obs に変更を行わない
-                    continue
+    def get_legal_actions(self) -> list[Any]:
+        obs = mjx.Observation(self.state.to_json())
+        return obs.legal_actions()
 
-        # legal action を付与する
-        obs_json = self.base_obs.copy()
-        obs = mjx.Observation(json.dumps(obs_json))
-        obs_json = mjx.Observation.add_legal_actions(json.dumps(obs_json, separators=(",", ":")))
+    def _get_mjx_obs(self, mjai_events):
+        timer = self.timer
+        if timer is not None:
+            t = time.perf_counter()
+        self._apply_mjai_events(mjai_events)
+        if timer is not None:
+            t = timer.lap("convert", t)
 
         # legal action を付与した上で act を呼ぶ
+        obs_json = mjx.Observation.add_legal_actions(self.state.to_json())
         obs = mjx.Observation(obs_json)
-
-        for action in obs.legal_actions():
-            if action.to_json().startswith('{"tile":'):
-                t_ = to_mjai_tile(json.loads(action.to_json())["tile"])
-
+        obs.discard_index = self.discard_index
+        if timer is not None:
+            timer.lap("observation", t)
         return obs
 
     def _get_mjai_response(self, mjx_action):
@@ -700,7 +812,7 @@ class MjxGateway:
                     "type": "hora",
                     "pai": to_mjai_tile(action_json.get("tile", 0)),
                     "actor": self.actor_id,
-                    "target": self.base_obs["publicObservation"]["events"][-1].get("who", 0),
+                    "target": self.state.last_event_who(),
                 })
 
             case mjxproto.ACTION_TYPE_CHI:
@@ -736,8 +848,30 @@ class MjxGateway:
 
         return json_dumps({"type": "none"})
 
+    def _can_act(self, mjai_event: dict[str, Any]) -> bool:
+        # can_act が付いていればそれに従う
+        if "can_act" in mjai_event:
+            return mjai_event["can_act"]
+        # 他家のツモに対してできることはない
+        if mjai_event["type"] == "tsumo" and mjai_event["actor"] != self.actor_id:
+            return False
+        return True
+
     def react(self, events_str: str) -> str:
+        if self.timer is None:
+            return self._react(events_str)
+        start = time.perf_counter()
+        response = self._react(events_str)
+        self.timer.lap("total", start)
+        return response
+
+    def _react(self, events_str: str) -> str:
+        timer = self.timer
+        if timer is not None:
+            t = time.perf_counter()
         events: list[dict[str, Any]] = json.loads(events_str)
+        if timer is not None:
+            timer.lap("parse", t)
 
         # 空ではないリストが与えられる
         assert len(events) > 0
@@ -745,9 +879,224 @@ class MjxGateway:
         # 最後のイベントの `type` によって分岐する
         if events[-1]["type"] in ["start_game", "end_kyoku", "end_game"]:
             return json_dumps({"type": "none"})
+        elif not self._can_act(events[-1]):
+            # 応答は none に決まっているので、観測の更新だけ行い legal action の生成と act を省く
+            if timer is not None:
+                t = time.perf_counter()
+            self._apply_mjai_events(events)
+            if timer is not None:
+                timer.lap("convert", t)
+            self.num_skipped_acts += 1
+            return json_dumps({"type": "none"})
         else:
             # 1. MJAI の入力を MJX に変換して Game Client に渡す
             # 2. MJX の Action を MJAI に変換する
             obs = self._get_mjx_obs(events)
+            if len(obs.legal_actions()) == 0:
+                self.num_skipped_acts += 1
+                return json_dumps({"type": "none"})
+            self.num_acts += 1
+            if timer is not None:
+                t = time.perf_counter()
             mjx_action = self.mjx_bot.act(obs)
-            return self._get_mjai_response(mjx_action)
+            if timer is not None:
+                t = timer.lap("act", t)
+            response = self._get_mjai_response(mjx_action)
+            if timer is not None:
+                timer.lap("response", t)
+            return response
+
+
+class MjxGateway(BaseGateway):
+    def __init__(self, actor_id, mjx_bot):
+        # 観測は CompactObservationState で保持する
+        super().__init__(actor_id, mjx_bot)
+        self.hai_offset = {}
+        # 払い出した牌 id の集合 (bit i が牌 id i)。他家の鳴きで晒された牌の id を O(1) で決めるのに使う
+        self.seen_tiles = 0
+        # 各家の捨て牌とリーチ状態。act に渡す mjx.Observation に discard_index として添える
+        self.discard_index = DiscardIndex()
+        # 直前の打牌の id (chi / pon で鳴かれた牌)
+        self.last_discard_tile = None
+
+    def _new_state(self, obs=None):
+        return CompactObservationState(obs)
+
+    def set_obs_offset(self, base_obs, hai_offset) -> None:
+        self.state = self._new_state(base_obs)
+        self.hai_offset = hai_offset
+        self.seen_tiles = seen_tiles_from_obs(base_obs) if base_obs else 0
+        public = base_obs.get("publicObservation", {}) if base_obs else {}
+        events = public.get("events", [])
+        self.discard_index = DiscardIndex.from_events(events, public.get("doraIndicators", []))
+        self.last_discard_tile = next((
+            e.get("tile", 0) for e in reversed(events)
+            if e.get("type", "EVENT_TYPE_DISCARD") in ["EVENT_TYPE_DISCARD", "EVENT_TYPE_TSUMOGIRI"]
+        ), None)
+
+    def _open_code(self, gen, mjai_event, *args, **kwargs):
+        if self.timer is None:
+            return gen(mjai_event, *args, **kwargs)
+        t = time.perf_counter()
+        result = gen(mjai_event, *args, **kwargs)
+        self.timer.lap("open_code", t)
+        return result
+
+    def _open_code_of_call(self, gen, mjai_event):
+        # chi / pon: 自家なら手牌から、他家ならまだ払い出していない牌 id から選ぶ
+        if self.actor_id == mjai_event["actor"]:
+            return self._open_code(gen, mjai_event, self.last_discard_tile, self.state.closed_tiles())
+        return self._open_code(gen, mjai_event, self.last_discard_tile, seen=self.seen_tiles)
+
+    def _allocate(self, hai: int) -> int:
+        # 同じ牌の何枚目かで id を払い出す
+        hai_ = hai + self.hai_offset.get(hai, 0)
+        self.hai_offset[hai] = self.hai_offset.get(hai, 0) + 1
+        self.seen_tiles |= 1 << hai_
+        return hai_
+
+    def _mark_seen(self, tiles: list[int]) -> None:
+        for t in tiles:
+            self.seen_tiles |= 1 << t
+
+    def _apply_mjai_events(self, mjai_events):
+        # 1. MJAI の入力を MJX に変換して Game Client に渡す
+        for mjai_event in mjai_events:
+            mjai_event_type = mjai_event.get("type")
+
+            match mjai_event_type:
+                case "start_kyoku":
+                    tehais = [to_mjx_tile(s) for s in mjai_event["tehais"][self.actor_id]]
+
+                    # Initialize hai_offset
+                    self.hai_offset = {}
+                    self.hai_offset[to_mjx_tile(mjai_event["dora_marker"])] = 1
+                    self.seen_tiles = 1 << to_mjx_tile(mjai_event["dora_marker"])
+                    tehais = [self._allocate(hai) for hai in tehais]
+
+                    self.state.start_kyoku(
+                        self.actor_id,
+                        mjai_event["scores"],
+                        to_mjx_tile(mjai_event["dora_marker"]),
+                        tehais,
+                    )
+                    self.discard_index.reset()
+                    self.discard_index.reveal_dora_indicator(to_mjx_tile(mjai_event["dora_marker"]) // 4)
+
+                case "tsumo":
+
+                    if self.actor_id == mjai_event["actor"]:
+                        hai_ = self._allocate(to_mjx_tile(mjai_event["pai"]))
+
+                        # Update obs
+                        self.state.draw(hai_)
+
+                    # Add event
+                    self.state.append_event(mjxproto.EVENT_TYPE_DRAW, mjai_event["actor"])
+
+                case "dahai":
+                    hai = to_mjx_tile(mjai_event["pai"])
+
+                    if self.actor_id == mjai_event["actor"]:
+                        # Update obs
+                        hai_ = self.state.take_closed_tile(hai)
+
+                    else:
+                        # 自分ではない場合、新規に出現するため hai をインクリメントする
+                        hai_ = self._allocate(hai)
+
+                    self.state.append_event(mjxproto.EVENT_TYPE_DISCARD, mjai_event["actor"], tile=hai_)
+                    self.discard_index.discard(mjai_event["actor"], hai_ // 4)
+                    self.last_discard_tile = hai_
+
+                case "chi":
+                    open_code, consume_tiles_from_hand = self._open_code_of_call(OpenCodeGen.from_mjai_chi, mjai_event)
+
+                    if self.actor_id == mjai_event["actor"]:
+                        # Update obs
+                        self.state.add_open(open_code)
+                        for t in consume_tiles_from_hand:
+                            self.state.remove_closed_tile(t)
+                    else:
+                        self._mark_seen(consume_tiles_from_hand)
+
+                    self.state.append_event(mjxproto.EVENT_TYPE_CHI, mjai_event["actor"], open_code=open_code)
+                    self.discard_index.meld(mjai_event["actor"], open_code)
+
+                case "pon":
+                    open_code, consume_tiles_from_hand = self._open_code_of_call(OpenCodeGen.from_mjai_pon, mjai_event)
+
+                    if self.actor_id == mjai_event["actor"]:
+                        # Update obs
+                        self.state.add_open(open_code)
+                        for t in consume_tiles_from_hand:
+                            self.state.remove_closed_tile(t)
+                    else:
+                        self._mark_seen(consume_tiles_from_hand)
+
+                    self.state.append_event(mjxproto.EVENT_TYPE_PON, mjai_event["actor"], open_code=open_code)
+                    self.discard_index.meld(mjai_event["actor"], open_code)
+
+                case "reach":
+                    self.state.append_event(mjxproto.EVENT_TYPE_RIICHI, mjai_event["actor"])
+                    self.discard_index.declare_riichi(mjai_event["actor"])
+
+                case "ankan":
+                    open_code, consume_tiles_from_hand = self._open_code(OpenCodeGen.from_mjai_kan, mjai_event)
+
+                    if self.actor_id == mjai_event["actor"]:
+                        # Update obs
+                        self.state.add_open(open_code)
+                        for t in consume_tiles_from_hand:
+                            self.state.remove_closed_tile(t)
+                    else:
+                        self._mark_seen(consume_tiles_from_hand)
+
+                    self.state.append_event(mjxproto.EVENT_TYPE_CLOSED_KAN, mjai_event["actor"], open_code=open_code)
+                    self.discard_index.meld(mjai_event["actor"], open_code)
+
+                case "kakan":
+                    if self.actor_id == mjai_event["actor"]:
+                        pons = self.state.opens()
+                    else:
+                        pons = self.discard_index.pons.values()
+                    open_code, consume_tiles_from_hand, called_tile_id, pon_open_code = self._open_code(
+                        OpenCodeGen.from_mjai_kakan, mjai_event, pons)
+
+                    if self.actor_id == mjai_event["actor"]:
+                        # Update obs
+                        self.state.add_open(open_code)
+                        self.state.remove_open(pon_open_code)
+                        self.state.remove_closed_tile(called_tile_id)
+                    else:
+                        self._mark_seen([called_tile_id])
+
+                    self.state.append_event(mjxproto.EVENT_TYPE_ADDED_KAN, mjai_event["actor"], open_code=open_code)
+                    self.discard_index.meld(mjai_event["actor"], open_code)
+
+                case "daiminkan":
+                    open_code, consume_tiles_from_hand = self._open_code(OpenCodeGen.from_mjai_kan, mjai_event)
+
+                    if self.actor_id == mjai_event["actor"]:
+                        # Update obs
+                        self.state.add_open(open_code)
+                        for t in consume_tiles_from_hand:
+                            self.state.remove_closed_tile(t)
+                    else:
+                        self._mark_seen(consume_tiles_from_hand)
+
+                    self.state.append_event(mjxproto.EVENT_TYPE_OPEN_KAN, mjai_event["actor"], open_code=open_code)
+                    self.discard_index.meld(mjai_event["actor"], open_code)
+
+                case "dora":
+                    # 槓ドラ。表示牌も払い出した牌として数える
+                    hai_ = self._allocate(to_mjx_tile(mjai_event["dora_marker"]))
+                    self.state.add_dora_indicator(hai_)
+                    self.discard_index.reveal_dora_indicator(hai_ // 4)
+
+                case "reach_accepted":
+                    pass
+
+                case _:
+                    # 観測に変更を行わない
+                    continue
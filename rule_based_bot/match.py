@@ -0,0 +1,163 @@
+"""A/B match between two agent configurations, stopped early by a sequential test.
+
+Usage::
+
+    python match.py --a rule --b "rule:adjacency_heuristics=0" [--opponent shanten]
+        [--metric rank|score] [--delta D] [--alpha 0.05] [--beta 0.05]
+        [--max-pairs N] [--workers N] [--seed S] [--out results.jsonl.gz]
+
+Pair ``p`` plays the wall seed ``S + p`` twice, with A and then B in the same seat
+(agent ``p % 4``, which also deals first) against three ``--opponent`` agents, so
+the luck of the wall cancels out of the per-pair difference. The differences
+(B's rank minus A's, or A's final score minus B's) feed a sequential probability
+ratio test of H0: "A is not better" (mean 0) against H1: "A is better by D"; the
+match stops as soon as either is accepted at the given error rates.
+"""
+import argparse
+import math
+import sys
+import time
+
+from gateway import json_dumps
+from selfplay import open_results, parse_agent_spec, run_games
+
+
+DEFAULT_DELTAS = {"rank": 0.05, "score": 500.0}
+
+
+class SPRT:
+    """Sequential probability ratio test of the mean of paired differences.
+
+    Uses the normal approximation with the sample variance, so the log-likelihood
+    ratio after n samples is ``n (mu1 - mu0) (mean - (mu0 + mu1) / 2) / var``.
+    """
+
+    def __init__(self, mu0: float, mu1: float, alpha: float = 0.05, beta: float = 0.05, min_samples: int = 30):
+        self.mu0 = mu0
+        self.mu1 = mu1
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.min_samples = min_samples
+        self.n = 0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+
+    def add(self, x: float) -> None:
+        self.n += 1
+        self.sum += x
+        self.sum_sq += x * x
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.n if self.n else 0.0
+
+    @property
+    def variance(self) -> float:
+        if self.n < 2:
+            return 0.0
+        return max(self.sum_sq - self.sum * self.sum / self.n, 0.0) / (self.n - 1)
+
+    def llr(self) -> float:
+        if self.n == 0:
+            return 0.0
+        excess = (self.mu1 - self.mu0) * (self.mean - (self.mu0 + self.mu1) / 2)
+        variance = self.variance
+        if variance == 0.0:
+            # 差がすべて同じ (A と B が同じ手を打つなど) ならその値だけで決まる
+            return math.copysign(math.inf, excess) if excess else 0.0
+        return self.n * excess / variance
+
+    def status(self) -> str | None:
+        """"H0" or "H1" once one of them is accepted, None while undecided."""
+        if self.n < self.min_samples:
+            return None
+        llr = self.llr()
+        if llr <= self.lower:
+            return "H0"
+        if llr >= self.upper:
+            return "H1"
+        return None
+
+
+def pair_tasks(spec_a: str, spec_b: str, opponent: str, num_pairs: int, seed: int = 0):
+    # (pair, 0 なら A / 1 なら B) を game 番号に詰める
+    for pair in range(num_pairs):
+        seat = pair % 4
+        for side, spec in enumerate([spec_a, spec_b]):
+            specs = [opponent] * 4
+            specs[seat] = spec
+            yield (pair * 2 + side, seed + pair, seat, tuple(specs))
+
+
+def pair_difference(result_a: dict, result_b: dict, seat: int, metric: str) -> float:
+    """How much better A did than B on the same wall; positive when A is better."""
+    if metric == "rank":
+        return result_b["ranks"][seat] - result_a["ranks"][seat]
+    return result_a["scores"][seat] - result_b["scores"][seat]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--a", required=True, help="agent spec of the candidate")
+    parser.add_argument("--b", required=True, help="agent spec of the baseline")
+    parser.add_argument("--opponent", default="shanten", help="agent spec of the other three seats")
+    parser.add_argument("--metric", choices=["rank", "score"], default="rank")
+    parser.add_argument("--delta", type=float, default=None, help="improvement of H1 per game (default: 0.05 rank, 500 points)")
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument("--min-pairs", type=int, default=30)
+    parser.add_argument("--max-pairs", type=int, default=20000)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count, 0: no pool)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default=None, help="per-game results, one JSON line each")
+    parser.add_argument("--progress", type=int, default=100, help="print a line every N pairs")
+    args = parser.parse_args()
+
+    for spec in [args.a, args.b, args.opponent]:
+        parse_agent_spec(spec)
+    delta = DEFAULT_DELTAS[args.metric] if args.delta is None else args.delta
+    sprt = SPRT(0.0, delta, args.alpha, args.beta, args.min_pairs)
+
+    out = open_results(args.out) if args.out else None
+    pending = {}
+    num_games = 0
+    status = None
+    start = time.perf_counter()
+    try:
+        tasks = pair_tasks(args.a, args.b, args.opponent, args.max_pairs, args.seed)
+        for result in run_games(tasks, args.workers):
+            num_games += 1
+            if out is not None:
+                out.write(json_dumps(result) + "\n")
+            pair, side = divmod(result["game"], 2)
+            other = pending.pop(pair, None)
+            if other is None:
+                pending[pair] = result
+                continue
+            result_a, result_b = (result, other) if side == 0 else (other, result)
+            sprt.add(pair_difference(result_a, result_b, pair % 4, args.metric))
+            if sprt.n % args.progress == 0:
+                print(f"{sprt.n} pairs, mean {sprt.mean:+.4f}, LLR {sprt.llr():+.2f}"
+                      f" [{sprt.lower:.2f}, {sprt.upper:.2f}]", file=sys.stderr)
+            status = sprt.status()
+            if status is not None:
+                break
+    finally:
+        if out is not None:
+            out.close()
+    elapsed = time.perf_counter() - start
+
+    stderr = math.sqrt(sprt.variance / sprt.n) if sprt.n > 1 else float("nan")
+    verdict = {
+        "H1": f"A is better than B by about {delta} {args.metric}",
+        "H0": f"A is not better than B by {delta} {args.metric}",
+        None: "undecided, --max-pairs reached",
+    }[status]
+    print(f"result: {verdict}")
+    print(f"pairs:  {sprt.n} ({num_games} games in {elapsed:.1f} s, {num_games / elapsed:.2f} games/s)")
+    print(f"mean difference per game: {sprt.mean:+.4f} +- {stderr:.4f} ({args.metric}, positive favours A)")
+    print(f"LLR:    {sprt.llr():+.3f} (bounds {sprt.lower:.3f}, {sprt.upper:.3f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Import-time tables of mjx open (meld) codes.
+
+An mjx open code packs the kind of a meld, its lowest tile type, which of its
+tiles was called, the ids of its tiles and the position of the player it was
+called from into 16 bits. Only a few thousand codes are valid, so both
+directions are tabulated once here: ``MELDS[code]`` decodes a code (what
+``mjx.open.Open(code)`` returns, without the C++ round trip per call) and
+``MELD_CODES[(kind, base_type, called, tile_ids, rel_pos)]`` encodes one.
+
+``kind`` is one of the mjxproto event types CHI, PON, CLOSED_KAN, OPEN_KAN and
+ADDED_KAN, ``base_type`` the lowest tile type of the meld, ``called`` the index
+field of the code (which of the three tiles of a chi or pon was called, the
+offset of the called id for a kan), ``tile_ids`` the sorted ids of the called and
+consumed tiles (for an added kan, those of the pon it extends) and ``rel_pos``
+the relative position of the player called from (0 for a closed kan, always 3
+for a chi).
+"""
+from typing import NamedTuple
+
+import mjxproto
+
+
+class Meld(NamedTuple):
+    kind: int
+    called: int
+    rel_pos: int
+    # mjx.open.Open の tiles(), tiles_from_hand(), stolen_tile(), last_tile() と同じ牌 id
+    tiles: tuple[int, ...]
+    tiles_from_hand: tuple[int, ...]
+    stolen_tile: int
+    last_tile: int
+    tile_types: tuple[int, ...]
+
+
+def _chi_melds():
+    for suit in range(3):
+        for number in range(7):
+            base_type = suit * 9 + number
+            for called in range(3):
+                for offsets in range(64):
+                    t = (offsets & 3, (offsets >> 2) & 3, offsets >> 4)
+                    tiles = tuple((base_type + i) * 4 + t[i] for i in range(3))
+                    # チーは上家からのみ
+                    code = ((suit * 7 + number) * 3 + called) << 10
+                    code |= (t[2] << 7) | (t[1] << 5) | (t[0] << 3) | (1 << 2) | 3
+                    stolen = tiles[called]
+                    yield code, tiles, Meld(
+                        mjxproto.EVENT_TYPE_CHI, called, 3, tiles,
+                        tuple(x for x in tiles if x != stolen), stolen, stolen,
+                        tuple(x // 4 for x in tiles),
+                    )
+
+
+def _pon_melds():
+    for base_type in range(34):
+        for called in range(3):
+            for unused in range(4):
+                pon_tiles = tuple(base_type * 4 + i for i in range(4) if i != unused)
+                kan_tiles = tuple(base_type * 4 + i for i in range(4))
+                stolen = pon_tiles[called]
+                for rel_pos in range(1, 4):
+                    code = ((base_type * 3 + called) << 9) | (unused << 5) | rel_pos
+                    # 加槓は同じポンに残りの 1 枚 (unused) を加えたもの
+                    yield code | (1 << 3), pon_tiles, Meld(
+                        mjxproto.EVENT_TYPE_PON, called, rel_pos, pon_tiles,
+                        tuple(x for x in pon_tiles if x != stolen), stolen, stolen,
+                        (base_type,) * 3,
+                    )
+                    yield code | (1 << 4), pon_tiles, Meld(
+                        mjxproto.EVENT_TYPE_ADDED_KAN, called, rel_pos, kan_tiles,
+                        tuple(x for x in kan_tiles if x != stolen), stolen, base_type * 4 + unused,
+                        (base_type,) * 4,
+                    )
+
+
+def _kan_melds():
+    for tile_id in range(136):
+        base_type = tile_id // 4
+        tiles = tuple(base_type * 4 + i for i in range(4))
+        for rel_pos in range(4):
+            code = (tile_id << 8) | rel_pos
+            if rel_pos == 0:
+                meld = Meld(
+                    mjxproto.EVENT_TYPE_CLOSED_KAN, tile_id % 4, 0, tiles, tiles, tile_id, tile_id, (base_type,) * 4)
+            else:
+                meld = Meld(
+                    mjxproto.EVENT_TYPE_OPEN_KAN, tile_id % 4, rel_pos, tiles,
+                    tuple(x for x in tiles if x != tile_id), tile_id, tile_id, (base_type,) * 4,
+                )
+            yield code, tiles, meld
+
+
+def _build_meld_tables():
+    melds = {}
+    codes = {}
+    for generate in [_chi_melds, _pon_melds, _kan_melds]:
+        for code, tile_ids, meld in generate():
+            melds[code] = meld
+            codes[(meld.kind, meld.tile_types[0], meld.called, tile_ids, meld.rel_pos)] = code
+    return melds, codes
+
+
+# 約 7000 通り。鳴きのたびにビット演算や mjx.open.Open を通さずに済むよう import 時に作っておく
+MELDS, MELD_CODES = _build_meld_tables()
+
+
+def meld_code(kind: int, base_type: int, called: int, tile_ids, rel_pos: int) -> int:
+    return MELD_CODES[(kind, base_type, called, tuple(sorted(tile_ids)), rel_pos)]
@@ -0,0 +1,234 @@
+"""Self-play evaluation of RuleBasedAgent on mjx environments, over a process pool.
+
+Usage::
+
+    python selfplay.py --games 1000 [--workers N] [--seed S] [--out results.jsonl.gz]
+        [--agent SPEC] [--agent SPEC] [--agent SPEC] [--agent SPEC]
+
+An agent SPEC is ``rule`` (this directory's RuleBasedAgent), optionally with flags
+as in ``rule:betaori_heuristics=0,adjacency_heuristics=0``, or one of the
+``mjx.agents`` baselines ``mjx-rule``, ``shanten``, ``tsumogiri`` and ``random``.
+The default table is ``rule`` against three ``shanten``.
+
+Game ``i`` is played with the wall seed ``S + i`` and the agents rotated so that
+agent ``i % 4`` is the first dealer, and python's ``random`` is reseeded before
+each game, so a run is reproducible regardless of the number of workers. One
+compact JSON line per game is written to ``--out`` (gzipped if it ends with .gz)
+as soon as the game finishes.
+"""
+import argparse
+import gzip
+import multiprocessing
+import random
+import sys
+import time
+
+import mjx
+import mjx.agents
+
+from bot import RuleBasedAgent
+from gateway import json_dumps
+from shanten import ShantenCache
+
+
+BASELINE_AGENTS = {
+    "mjx-rule": mjx.agents.RuleBasedAgent,
+    "shanten": mjx.agents.ShantenAgent,
+    "tsumogiri": mjx.agents.TsumogiriAgent,
+    "random": mjx.agents.RandomAgent,
+}
+DEFAULT_AGENTS = ["rule", "shanten", "shanten", "shanten"]
+PLAYER_IDS = ["player_0", "player_1", "player_2", "player_3"]
+
+
+def parse_agent_spec(spec: str) -> tuple[str, dict[str, bool]]:
+    name, _, flags = spec.partition(":")
+    if name != "rule" and name not in BASELINE_AGENTS:
+        raise ValueError(f"Unknown agent: {name}")
+    kwargs = {}
+    for flag in filter(None, flags.split(",")):
+        key, _, value = flag.partition("=")
+        if name != "rule":
+            raise ValueError(f"{name} does not take flags: {spec}")
+        if value not in ["0", "1"]:
+            raise ValueError(f"Flag values are 0 or 1: {spec}")
+        kwargs[key] = value == "1"
+    return name, kwargs
+
+
+def make_agent(spec: str, shanten_cache: ShantenCache | None = None) -> mjx.Agent:
+    name, kwargs = parse_agent_spec(spec)
+    if name == "rule":
+        return RuleBasedAgent(shanten_cache=shanten_cache, **kwargs)
+    return BASELINE_AGENTS[name]()
+
+
+# ワーカープロセスごとの agent ((番号, spec) -> agent)。同じプロセスの agent は向聴数キャッシュを共有する
+_agents = {}
+_shanten_cache = None
+
+
+def _agent(index: int, spec: str) -> mjx.Agent:
+    global _shanten_cache
+    if _shanten_cache is None:
+        _shanten_cache = ShantenCache()
+    agent = _agents.get((index, spec))
+    if agent is None:
+        agent = _agents[(index, spec)] = make_agent(spec, _shanten_cache)
+    return agent
+
+
+def _ranks(tens: list[int]) -> list[int]:
+    # 同点は起家に近い方が上位
+    order = sorted(range(len(tens)), key=lambda seat: (-tens[seat], seat))
+    ranks = [0] * len(tens)
+    for rank, seat in enumerate(order):
+        ranks[seat] = rank + 1
+    return ranks
+
+
+def play_game(task: tuple[int, int, int, tuple[str, ...]]) -> dict:
+    """Play one hanchan; the result lists are indexed by agent, not by seat."""
+    game, seed, first_dealer, specs = task
+    random.seed(seed)
+    num_agents = len(specs)
+    dealer_order = [PLAYER_IDS[(first_dealer + k) % num_agents] for k in range(num_agents)]
+    agent_of = {player_id: _agent(i, spec) for i, (player_id, spec) in enumerate(zip(PLAYER_IDS, specs))}
+
+    wins = [0] * num_agents
+    deal_ins = [0] * num_agents
+    num_rounds = 0
+    start = time.perf_counter()
+    env = mjx.MjxEnv()
+    obs_dict = env.reset(seed, dealer_order)
+    while not env.done():
+        actions = {player_id: agent_of[player_id].act(obs) for player_id, obs in obs_dict.items()}
+        obs_dict = env.step(actions)
+        if env.done("round"):
+            state = env.state().to_proto()
+            # 局の結果の who は席順なので agent の番号に直す
+            agent_at = [PLAYER_IDS.index(player_id) for player_id in state.public_observation.player_ids]
+            num_rounds += 1
+            for win in state.round_terminal.wins:
+                wins[agent_at[win.who]] += 1
+                if win.from_who != win.who:
+                    deal_ins[agent_at[win.from_who]] += 1
+    tens_by_seat = list(state.round_terminal.final_score.tens)
+    ranks_by_seat = _ranks(tens_by_seat)
+
+    scores = [0] * num_agents
+    ranks = [0] * num_agents
+    for seat, agent in enumerate(agent_at):
+        scores[agent] = tens_by_seat[seat]
+        ranks[agent] = ranks_by_seat[seat]
+    return {
+        "game": game,
+        "seed": seed,
+        "ranks": ranks,
+        "scores": scores,
+        "rounds": num_rounds,
+        "wins": wins,
+        "deal_ins": deal_ins,
+        "sec": round(time.perf_counter() - start, 3),
+    }
+
+
+def game_tasks(specs: list[str], num_games: int, seed: int = 0) -> list[tuple[int, int, int, tuple[str, ...]]]:
+    return [(game, seed + game, game % len(specs), tuple(specs)) for game in range(num_games)]
+
+
+def run_games(tasks, num_workers: int | None = None):
+    """Yield play_game results in completion order; ``num_workers=0`` plays in this process.
+
+    Tasks may be a lazy iterable. Leaving the generator early terminates the pool.
+    """
+    if num_workers == 0:
+        yield from map(play_game, tasks)
+        return
+    with multiprocessing.Pool(num_workers) as pool:
+        yield from pool.imap_unordered(play_game, tasks)
+
+
+class Summary:
+    """Running totals of play_game results per agent."""
+
+    def __init__(self, num_agents: int = 4):
+        self.num_games = 0
+        self.num_rounds = 0
+        self.rank_sums = [0] * num_agents
+        self.rank_counts = [[0] * num_agents for _ in range(num_agents)]
+        self.score_sums = [0] * num_agents
+        self.wins = [0] * num_agents
+        self.deal_ins = [0] * num_agents
+
+    def add(self, result: dict) -> None:
+        self.num_games += 1
+        self.num_rounds += result["rounds"]
+        for agent, rank in enumerate(result["ranks"]):
+            self.rank_sums[agent] += rank
+            self.rank_counts[agent][rank - 1] += 1
+            self.score_sums[agent] += result["scores"][agent]
+            self.wins[agent] += result["wins"][agent]
+            self.deal_ins[agent] += result["deal_ins"][agent]
+
+    def rows(self) -> list[dict]:
+        games = max(self.num_games, 1)
+        rounds = max(self.num_rounds, 1)
+        return [{
+            "average_rank": self.rank_sums[agent] / games,
+            "rank_rates": [count / games for count in self.rank_counts[agent]],
+            "average_score": self.score_sums[agent] / games,
+            "win_rate": self.wins[agent] / rounds,
+            "deal_in_rate": self.deal_ins[agent] / rounds,
+        } for agent in range(len(self.rank_sums))]
+
+
+def open_results(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt")
+    return open(path, "w")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count, 0: no pool)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--agent", action="append", dest="agents", help="agent spec, given four times")
+    parser.add_argument("--out", default=None, help="per-game results, one JSON line each")
+    parser.add_argument("--progress", type=int, default=100, help="print a line every N games")
+    args = parser.parse_args()
+
+    specs = args.agents or DEFAULT_AGENTS
+    if len(specs) != 4:
+        parser.error("--agent must be given four times")
+    for spec in specs:
+        parse_agent_spec(spec)
+
+    out = open_results(args.out) if args.out else None
+    summary = Summary(len(specs))
+    start = time.perf_counter()
+    try:
+        for result in run_games(game_tasks(specs, args.games, args.seed), args.workers):
+            summary.add(result)
+            if out is not None:
+                out.write(json_dumps(result) + "\n")
+                out.flush()
+            if summary.num_games % args.progress == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{summary.num_games} games, {summary.num_games / elapsed:.2f} games/s", file=sys.stderr)
+    finally:
+        if out is not None:
+            out.close()
+    elapsed = time.perf_counter() - start
+
+    print(f"games:  {summary.num_games} in {elapsed:.1f} s ({summary.num_games / elapsed:.2f} games/s)")
+    print(f"{'agent':<40} {'rank':>5} {'1st':>6} {'2nd':>6} {'3rd':>6} {'4th':>6} {'score':>8} {'win':>6} {'deal-in':>8}")
+    for spec, row in zip(specs, summary.rows()):
+        rates = " ".join(f"{rate:6.3f}" for rate in row["rank_rates"])
+        print(f"{spec:<40} {row['average_rank']:5.3f} {rates} {row['average_score']:8.0f}"
+              f" {row['win_rate']:6.3f} {row['deal_in_rate']:8.3f}")
+
+
+if __name__ == "__main__":
+    main()
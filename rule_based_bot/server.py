@@ -0,0 +1,200 @@
+"""Asyncio MJAI server hosting one MjxGateway + RuleBasedAgent per connection.
+
+Usage::
+
+    python server.py --port 11600 [--host 127.0.0.1] [--workers N] [--tables]
+    python server.py --unix /tmp/mjai.sock [--workers N] [--tables]
+
+A connection plays one seat of one game. The client sends the same lines as to
+``bot.py`` (one JSON array of MJAI events per line) and gets one response line for
+each of them. The seat is taken from the ``id`` of the ``start_game`` event, or
+from a first line that only holds the seat number.
+
+Sessions are pinned to one of ``--workers`` single process pools, so a gateway
+never leaves the process that created it and all the agents of a worker share one
+shanten cache. With ``--workers 0`` everything runs in the event loop process.
+
+With ``--tables`` the four seats of a game share the public state of the table
+(see table.py): they are hosted on the same worker, each as a TableGateway of
+one TableState. Connections are grouped into tables in the order they send their
+seat: a connection joins the newest table whose seat is still free, otherwise it
+opens a new table. The four connections of a game must therefore give their seats
+before those of the next game, and feed their lines in game order, as a MJAI
+server does.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from bot import RuleBasedAgent
+from gateway import MjxGateway, json_dumps
+from shanten import ShantenCache
+from table import TableGateway, TableState
+
+
+# このプロセスが受け持つセッション (session id -> MjxGateway / TableGateway)
+_sessions = {}
+# --tables のときの卓 (table id -> TableState)
+_tables = {}
+_shanten_cache = None
+
+
+def open_session(session_id: int, seat: int, table_id: int | None = None) -> None:
+    global _shanten_cache
+    if _shanten_cache is None:
+        _shanten_cache = ShantenCache()
+    agent = RuleBasedAgent(shanten_cache=_shanten_cache)
+    if table_id is None:
+        _sessions[session_id] = MjxGateway(seat, agent)
+    else:
+        table = _tables.setdefault(table_id, TableState())
+        _sessions[session_id] = TableGateway(table, seat, agent)
+
+
+def session_react(session_id: int, line: str) -> str:
+    return _sessions[session_id].react(line)
+
+
+def close_session(session_id: int) -> None:
+    gateway = _sessions.pop(session_id, None)
+    # 卓の最後の席が抜けたら卓も捨てる
+    if isinstance(gateway, TableGateway) and not any(
+        isinstance(other, TableGateway) and other.table is gateway.table for other in _sessions.values()
+    ):
+        for table_id, table in list(_tables.items()):
+            if table is gateway.table:
+                del _tables[table_id]
+
+
+def seat_of(line: str) -> int | None:
+    if line.isdigit():
+        return int(line)
+    for event in json.loads(line):
+        if event.get("type") == "start_game" and "id" in event:
+            return event["id"]
+    return None
+
+
+class MjaiServer:
+    def __init__(self, num_workers: int | None = None, tables: bool = False):
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        self.executors = [ProcessPoolExecutor(max_workers=1) for _ in range(num_workers)]
+        self.num_sessions = [0] * max(num_workers, 1)
+        self.num_requests = 0
+        self.tables = tables
+        # 席を受け付けている卓 (table id, worker, 埋まった席)
+        self._open_table = None
+        self._session_ids = itertools.count()
+        self._table_ids = itertools.count()
+        self._shut_down = False
+        self._handlers = set()
+
+    def _assign(self, seat: int) -> tuple[int, int | None]:
+        # セッション数が一番少ないワーカーに割り当て、以後は同じワーカーで処理する
+        # --tables のときは卓ごとに割り当て、同じ卓の席は同じワーカーに置く
+        if not self.tables:
+            return self.num_sessions.index(min(self.num_sessions)), None
+        if self._open_table is None or seat in self._open_table[2]:
+            worker = self.num_sessions.index(min(self.num_sessions))
+            self._open_table = (next(self._table_ids), worker, set())
+        table_id, worker, seats = self._open_table
+        seats.add(seat)
+        if len(seats) == 4:
+            self._open_table = None
+        return worker, table_id
+
+    async def _call(self, worker: int, fn, *args):
+        if not self.executors:
+            return fn(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executors[worker], fn, *args)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session_id = next(self._session_ids)
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        worker = None
+        opened = False
+        try:
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    if reader.at_eof():
+                        break
+                    continue
+
+                if not opened:
+                    seat = seat_of(line)
+                    if seat is None:
+                        writer.write((json_dumps({"type": "error", "message": "seat is not known yet"}) + "\n").encode())
+                        break
+                    worker, table_id = self._assign(seat)
+                    self.num_sessions[worker] += 1
+                    await self._call(worker, open_session, session_id, seat, table_id)
+                    opened = True
+                    if line.isdigit():
+                        writer.write(b'{"type":"none"}\n')
+                        await writer.drain()
+                        continue
+
+                response = await self._call(worker, session_react, session_id, line)
+                self.num_requests += 1
+                writer.write((response + "\n").encode())
+                await writer.drain()
+        finally:
+            if worker is not None:
+                self.num_sessions[worker] -= 1
+            # shutdown 後はワーカーごと破棄されるので片付け不要
+            if opened and not self._shut_down:
+                await self._call(worker, close_session, session_id)
+            writer.close()
+            self._handlers.discard(task)
+
+    async def wait_sessions(self) -> None:
+        # 接続中のセッションがすべて終わるまで待つ
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    async def start(self, host: str | None = None, port: int | None = None, path: str | None = None):
+        # ワーカーは最初の submit で fork されるので、接続を受ける前に起動しておく
+        # (後から fork すると、その時点で開いているソケットが子プロセスにも残ってしまう)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(executor, os.getpid) for executor in self.executors])
+        if path is not None:
+            return await asyncio.start_unix_server(self.handle, path=path)
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def serve(self, host: str | None = None, port: int | None = None, path: str | None = None) -> None:
+        server = await self.start(host, port, path)
+        async with server:
+            await server.serve_forever()
+
+    def shutdown(self) -> None:
+        self._shut_down = True
+        for executor in self.executors:
+            executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11600)
+    parser.add_argument("--unix", help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--tables", action="store_true", help="share the public state between the seats of a table")
+    args = parser.parse_args()
+
+    server = MjaiServer(args.workers, args.tables)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+import json
+import os
+import zlib
+from collections import OrderedDict
+
+import mjx
+
+from meld import MELDS
+
+# mjx.Hand を使わない向聴数計算用の牌種別テーブル (初回に作って保存する)
+SHANTEN_TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shanten_table.bin")
+
+# 表の各エントリは (面子数 m, 雀頭数 h) ごとの「完成形までに足りない牌の枚数」で、
+# m * 2 + h の順に 10 個を 4bit ずつ 5 バイトに詰めている
+_NUM_SUIT_CODES = 5 ** 9
+_NUM_HONOR_CODES = 5 ** 7
+_ENTRY_BYTES = 5
+_INF = 60
+
+_TERMINAL_AND_HONOR_TYPES = (0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33)
+_TERMINAL_AND_HONOR_SET = frozenset(_TERMINAL_AND_HONOR_TYPES)
+
+_GROUPS = ((0, 9), (9, 18), (18, 27), (27, 34))
+_GROUP_OF = tuple(g for g, (begin, end) in enumerate(_GROUPS) for _ in range(begin, end))
+_PLACE_OF = tuple(5 ** (end - 1 - i) for begin, end in _GROUPS for i in range(begin, end))
+
+_tables = None
+
+
+def _build_table(length: int, sequences: bool):
+    # 先頭の牌種から順に、(前の牌種から始まった順子数, 2 つ前から始まった順子数, 面子数, 雀頭数)
+    # を状態とする DP を、その牌種までの枚数パターン全体についてまとめて回す
+    import numpy as np
+
+    dp = {(0, 0, 0, 0): np.zeros(1, dtype=np.int8)}
+    for i in range(length):
+        max_k = 4 if sequences and i < length - 2 else 0
+        num_prefixes = 5 ** i
+        new_dp = {}
+        for (a, b, m, h), cost in dp.items():
+            for k in range(max_k + 1):
+                for t in range(2):
+                    for p in range(2 - h):
+                        required = a + b + k + 3 * t + 2 * p
+                        if required > 4 or m + k + t > 4:
+                            continue
+                        state = (k, a, m + k + t, h + p)
+                        arr = new_dp.get(state)
+                        if arr is None:
+                            arr = new_dp[state] = np.full((num_prefixes, 5), _INF, dtype=np.int8)
+                        for c in range(5):
+                            np.minimum(arr[:, c], cost + max(0, required - c), out=arr[:, c])
+        dp = {state: np.minimum(arr.reshape(-1), _INF) for state, arr in new_dp.items()}
+
+    table = np.empty((5 ** length, 10), dtype=np.uint8)
+    for m in range(5):
+        for h in range(2):
+            table[:, m * 2 + h] = dp[(0, 0, m, h)]
+    return (table[:, 0::2] | (table[:, 1::2] << 4)).astype(np.uint8).tobytes()
+
+
+def build_shanten_tables(path: str = SHANTEN_TABLE_PATH) -> None:
+    """Build the per-suit tables used by the table based engine and write them to ``path``.
+
+    Building needs numpy (a dependency of mjx) and takes well under a second;
+    the zlib compressed file is about 200 KB.
+    """
+    data = _build_table(9, True) + _build_table(7, False)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(zlib.compress(data, 9))
+    os.replace(tmp_path, path)
+
+
+def _load_tables(path: str = SHANTEN_TABLE_PATH):
+    global _tables
+    if _tables is None:
+        if not os.path.exists(path):
+            build_shanten_tables(path)
+        with open(path, "rb") as f:
+            data = zlib.decompress(f.read())
+        split = _NUM_SUIT_CODES * _ENTRY_BYTES
+        assert len(data) == split + _NUM_HONOR_CODES * _ENTRY_BYTES
+        _tables = (data[:split], data[split:])
+    return _tables
+
+
+def _entry(table: bytes, code: int) -> tuple[int, ...]:
+    b0, b1, b2, b3, b4 = table[code * 5:code * 5 + 5]
+    return (b0 & 15, b0 >> 4, b1 & 15, b1 >> 4, b2 & 15, b2 >> 4, b3 & 15, b3 >> 4, b4 & 15, b4 >> 4)
+
+
+def _group_codes(counts) -> list[int]:
+    codes = []
+    for begin, end in _GROUPS:
+        code = 0
+        for i in range(begin, end):
+            code = code * 5 + counts[i]
+        codes.append(code)
+    return codes
+
+
+def _combine(x, y, max_m: int) -> list[int]:
+    z = [_INF] * 10
+    for m1 in range(max_m + 1):
+        for h1 in range(2):
+            v1 = x[m1 * 2 + h1]
+            for m2 in range(max_m - m1 + 1):
+                for h2 in range(2 - h1):
+                    v = v1 + y[m2 * 2 + h2]
+                    i = (m1 + m2) * 2 + h1 + h2
+                    if v < z[i]:
+                        z[i] = v
+    return z
+
+
+def _best_split(x, y, num_melds: int) -> int:
+    # x と y に面子・雀頭を振り分けて num_melds 面子 1 雀頭にするときの最小枚数
+    best = _INF
+    for m in range(num_melds + 1):
+        i = m * 2
+        j = (num_melds - m) * 2
+        v = x[i] + y[j + 1]
+        if v < best:
+            best = v
+        v = x[i + 1] + y[j]
+        if v < best:
+            best = v
+    return best
+
+
+def _seven_pairs_shanten(counts) -> int:
+    pairs = 0
+    kinds = 0
+    for c in counts:
+        if c > 0:
+            kinds += 1
+            if c > 1:
+                pairs += 1
+    return 6 - pairs + max(0, 7 - kinds)
+
+
+def _thirteen_orphans_shanten(counts) -> int:
+    kinds = 0
+    has_pair = False
+    for i in _TERMINAL_AND_HONOR_TYPES:
+        if counts[i] > 0:
+            kinds += 1
+            if counts[i] > 1:
+                has_pair = True
+    return 13 - kinds - has_pair
+
+
+def _group_entries(counts):
+    suit_table, honor_table = _load_tables()
+    codes = _group_codes(counts)
+    return codes, [_entry(suit_table, codes[0]), _entry(suit_table, codes[1]),
+                   _entry(suit_table, codes[2]), _entry(honor_table, codes[3])]
+
+
+def table_shanten_number(counts, num_opens: int = 0) -> int:
+    """Shanten number of the closed tile type counts (34 entries), as ``mjx.Hand.shanten_number``."""
+    num_melds = 4 - num_opens
+    _, (m, p, s, z) = _group_entries(counts)
+    shanten = _best_split(_combine(m, p, num_melds), _combine(s, z, num_melds), num_melds) - 1
+    if num_opens == 0:
+        shanten = min(shanten, _seven_pairs_shanten(counts), _thirteen_orphans_shanten(counts))
+    return shanten
+
+
+def table_shanten_and_effective_draw_types(counts, num_opens: int = 0) -> tuple[int, tuple[int, ...]]:
+    """Shanten number and the tile types whose draw lowers it, as ``mjx.Hand.effective_draw_types``."""
+    num_melds = 4 - num_opens
+    codes, (m, p, s, z) = _group_entries(counts)
+    mp = _combine(m, p, num_melds)
+    sz = _combine(s, z, num_melds)
+    regular = _best_split(mp, sz, num_melds) - 1
+    # 1 種類引いたときに変わるのはその牌種の属するグループだけなので、残りを先に畳み込んでおく
+    rests = (_combine(p, sz, num_melds), _combine(m, sz, num_melds),
+             _combine(mp, z, num_melds), _combine(mp, s, num_melds))
+    tables = _load_tables()
+
+    closed = num_opens == 0
+    if closed:
+        pairs = sum(c > 1 for c in counts)
+        kinds = sum(c > 0 for c in counts)
+        orphan_kinds = sum(counts[i] > 0 for i in _TERMINAL_AND_HONOR_TYPES)
+        orphan_pair = any(counts[i] > 1 for i in _TERMINAL_AND_HONOR_TYPES)
+        seven_pairs = 6 - pairs + max(0, 7 - kinds)
+        thirteen_orphans = 13 - orphan_kinds - orphan_pair
+        shanten = min(regular, seven_pairs, thirteen_orphans)
+    else:
+        shanten = regular
+
+    effective_draw_types = []
+    for tile_type in range(34):
+        c = counts[tile_type]
+        if c == 4:
+            continue
+        group = _GROUP_OF[tile_type]
+        entry = _entry(tables[group == 3], codes[group] + _PLACE_OF[tile_type])
+        if _best_split(rests[group], entry, num_melds) - 1 < shanten:
+            effective_draw_types.append(tile_type)
+            continue
+        if not closed:
+            continue
+        if 6 - pairs - (c == 1) + max(0, 7 - kinds - (c == 0)) < shanten:
+            effective_draw_types.append(tile_type)
+        elif tile_type in _TERMINAL_AND_HONOR_SET and \
+                13 - orphan_kinds - (c == 0) - (orphan_pair or c == 1) < shanten:
+            effective_draw_types.append(tile_type)
+    return shanten, tuple(effective_draw_types)
+
+
+def closed_tile_type_counts(closed_tile_ids: list[int]) -> tuple[int, ...]:
+    counts = [0] * 34
+    for tile_id in closed_tile_ids:
+        counts[tile_id // 4] += 1
+    return tuple(counts)
+
+
+def tile_ids_of_counts(counts, opens: list[int]) -> list[int]:
+    """Closed tile ids for the type counts that do not clash with the ids of ``opens``."""
+    used = {t for code in opens for t in MELDS[code].tiles}
+    tile_ids = []
+    for tile_type, c in enumerate(counts):
+        if c:
+            tile_ids.extend([t for t in range(tile_type * 4, tile_type * 4 + 4) if t not in used][:c])
+    return tile_ids
+
+
+class ShantenCache:
+    """Bounded LRU cache of shanten numbers and effective draw types.
+
+    Both only depend on the counts of the closed tile types and on the number of
+    opens, so hands that differ only in tile ids (or in which meld was called)
+    share an entry. Misses are computed with ``mjx.Hand``, or with the table based
+    engine of this module when ``use_table`` is set.
+
+    Whether a call lowers the shanten number (``call_reduces_shanten``) is cached
+    too, keyed by the counts and the tile types of the meld, so chi variants that
+    differ only in tile ids are answered by one entry.
+    """
+
+    def __init__(self, maxsize: int = 65536, use_table: bool = False):
+        self.maxsize = maxsize
+        self.use_table = use_table
+        self.hits = 0
+        self.misses = 0
+        self.call_hits = 0
+        self.call_misses = 0
+        self._cache = OrderedDict()
+        self._call_cache = OrderedDict()
+
+    def get(self, closed_tile_ids: list[int], opens: list[int]) -> tuple[int, tuple[int, ...]]:
+        return self.get_counts(closed_tile_type_counts(closed_tile_ids), opens, closed_tile_ids)
+
+    def get_counts(self, counts, opens: list[int], closed_tile_ids: list[int] | None = None) -> tuple[int, tuple[int, ...]]:
+        """As ``get``, from the closed tile type counts (ids are only needed for ``mjx.Hand`` on a miss)."""
+        key = (tuple(counts), len(opens))
+        value = self._cache.get(key)
+        if value is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return value
+
+        self.misses += 1
+        if self.use_table:
+            value = table_shanten_and_effective_draw_types(key[0], len(opens))
+        else:
+            if closed_tile_ids is None:
+                closed_tile_ids = tile_ids_of_counts(key[0], opens)
+            hand = mjx.Hand(json.dumps({"closedTiles": closed_tile_ids, "opens": opens}))
+            value = (hand.shanten_number(), tuple(int(t) for t in hand.effective_draw_types()))
+        self._cache[key] = value
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return value
+
+    def shanten_number(self, closed_tile_ids: list[int], opens: list[int]) -> int:
+        return self.get(closed_tile_ids, opens)[0]
+
+    def effective_draw_types(self, closed_tile_ids: list[int], opens: list[int]) -> tuple[int, ...]:
+        return self.get(closed_tile_ids, opens)[1]
+
+    def call_reduces_shanten(self, counts, opens: list[int], stolen_type: int,
+                             meld_tile_types: tuple[int, ...]) -> tuple[bool, int, int, int | None]:
+        """Whether calling ``stolen_type`` into a meld of ``meld_tile_types`` lowers the shanten number.
+
+        As ``RuleBasedAgent._is_shanten_reduced_by_open`` did with one ``mjx.Hand`` per
+        closed tile: the stolen tile is added and each closed tile type outside the meld
+        is tried as the discard (with the opens before the call). Returns
+        ``(ok, shanten, shanten_after_call, discarded_type)`` for the last type tried.
+        """
+        counts = tuple(counts)
+        key = (counts, len(opens), stolen_type, meld_tile_types)
+        value = self._call_cache.get(key)
+        if value is not None:
+            self.call_hits += 1
+            self._call_cache.move_to_end(key)
+            return value
+
+        self.call_misses += 1
+        shanten = self.get_counts(counts, opens)[0]
+        after_call = list(counts)
+        after_call[stolen_type] += 1
+        value = (False, shanten, shanten, None)
+        for tile_type in range(34):
+            if not counts[tile_type] or tile_type in meld_tile_types:
+                continue
+            after_call[tile_type] -= 1
+            shanten_after_call = self.get_counts(after_call, opens)[0]
+            after_call[tile_type] += 1
+            value = (shanten_after_call < shanten, shanten, shanten_after_call, tile_type)
+            if value[0]:
+                break
+        self._call_cache[key] = value
+        if len(self._call_cache) > self.maxsize:
+            self._call_cache.popitem(last=False)
+        return value
+
+    def info(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._cache),
+            "maxsize": self.maxsize,
+            "call_hits": self.call_hits,
+            "call_misses": self.call_misses,
+        }
+
+    def clear(self) -> None:
+        self._cache.clear()
+        self._call_cache.clear()
+        self.hits = 0
+        self.misses = 0
+        self.call_hits = 0
+        self.call_misses = 0
+
+
+if __name__ == "__main__":
+    build_shanten_tables()
@@ -0,0 +1,304 @@
+"""Seats of one table hosted in the same process, sharing the public state.
+
+Each MjxGateway keeps its own copy of everything public (the events rows, the
+dora indicators and their serialized JSON), so hosting the four seats of a table
+means parsing and storing every public event four times. TableGateway keeps that
+part in one TableKyoku per kyoku: whichever seat receives an event first applies
+its public part, and the other seats only advance their cursor. Each seat keeps
+just its private view (init hand, draws and current hand) in a SeatState, which
+shares the CompactHand part of CompactObservationState, plus its own DiscardIndex,
+replayed from the kyoku's recorded updates as the seat catches up so that a
+lagging seat sees the table as it was at its cursor.
+
+Usage::
+
+    table = TableState()
+    gateways = [TableGateway(table, seat, RuleBasedAgent()) for seat in range(4)]
+
+Each gateway is then fed its own seat's MJAI stream, as with MjxGateway. The
+streams must be fed event by event in game order (as a MJAI server does); a
+seat may lag behind the others within a kyoku. ``server.py --tables`` hosts the
+seats of each table this way.
+
+Known limits:
+
+- Tile ids are allocated table-wide, so that no two seats hold the same id. A
+  seat's ids therefore differ from the ones MjxGateway assigns for the same
+  stream (the tile types are the same), and so do the ids in its observations.
+- The target was about 4x less memory and time than four MjxGateways (one
+  copy of the public state instead of four). ``benchmark.py table`` measures
+  about 2.6x less memory and 1.9x less time: each seat still keeps its own
+  hand and DiscardIndex, and still serializes its own observation after every
+  event, so only the parsing and storing of the public events is shared.
+"""
+from typing import Any
+
+import mjxproto
+
+from gateway import (
+    _PLAYER_IDS_JSON,
+    BaseGateway,
+    CompactHand,
+    DiscardIndex,
+    OpenCodeGen,
+    event_row,
+    json_dumps,
+    to_mjx_tile,
+)
+
+
+# 観測を変えないイベント (react がそれだけでは観測を更新しないので席ごとに数がずれうる)
+_OUT_OF_KYOKU_EVENTS = ("start_game", "end_kyoku", "end_game")
+
+
+class TableKyoku:
+    """Public state of the current kyoku, shared by all the seats of a table."""
+
+    def __init__(self, scores: list[int], dora_indicator: int):
+        self.scores = scores
+        self.dora_indicators = [dora_indicator]
+        # 牌 id は卓全体で払い出すので、席をまたいでも重複しない
+        self.hai_offset = {dora_indicator: 1}
+        self.seen_tiles = 1 << dora_indicator
+        self.events = []
+        # ポンした牌の種類 -> open code (卓にいない席の加槓の open code を作るのに使う。加槓したら消す)
+        self.pons = {}
+        # 直前の打牌の id (chi / pon で鳴かれた牌)
+        self.last_discard_tile = None
+        # i 番目の MJAI イベントまでを適用した時点の events の行数とドラ表示牌の数
+        self.rows_after = []
+        self.doras_after = []
+        # i 番目の MJAI イベントによる DiscardIndex の更新 (メソッドと引数、なければ None)。各席が追いついたときに適用する
+        self.index_updates = []
+        # events をシリアライズした文字列と、各行までの長さ (to_json で必要になった分だけ)
+        self._events_json = ""
+        self._events_json_ends = [0]
+        # この局を始めた席 (who -> SeatState)
+        self.seats = {}
+
+    @property
+    def num_events(self) -> int:
+        return len(self.rows_after)
+
+    def allocate(self, hai: int) -> int:
+        hai_ = hai + self.hai_offset.get(hai, 0)
+        self.hai_offset[hai] = self.hai_offset.get(hai, 0) + 1
+        self.seen_tiles |= 1 << hai_
+        return hai_
+
+    def mark_seen(self, tiles: list[int]) -> None:
+        for t in tiles:
+            self.seen_tiles |= 1 << t
+
+    def append_event(self, event_type: int, who: int, tile: int | None = None, open_code: int | None = None) -> None:
+        self.events.append(event_row(event_type, who, tile, open_code))
+
+    def events_json(self, num_rows: int) -> str:
+        # まだシリアライズしていない行を追記してから、num_rows 行目までを切り出す
+        for row in self.events[len(self._events_json_ends) - 1:num_rows]:
+            row_json = json_dumps(row)
+            self._events_json = self._events_json + "," + row_json if self._events_json else row_json
+            self._events_json_ends.append(len(self._events_json))
+        return self._events_json[:self._events_json_ends[num_rows]]
+
+    def apply(self, mjai_event: dict[str, Any]) -> None:
+        # MjxGateway._apply_mjai_events の公開部分。手牌の更新は鳴いた (打牌した) 席がこの卓にいればその席に行う
+        actor = mjai_event.get("actor")
+        actor_seat = self.seats.get(actor)
+        update = None
+
+        match mjai_event.get("type"):
+            case "tsumo":
+                self.append_event(mjxproto.EVENT_TYPE_DRAW, actor)
+
+            case "dahai":
+                hai = to_mjx_tile(mjai_event["pai"])
+                if actor_seat is not None:
+                    hai_ = actor_seat.take_closed_tile(hai)
+                else:
+                    hai_ = self.allocate(hai)
+                self.append_event(mjxproto.EVENT_TYPE_DISCARD, actor, tile=hai_)
+                update = (DiscardIndex.discard, actor, hai_ // 4)
+                self.last_discard_tile = hai_
+
+            case "chi" | "pon" | "ankan" | "daiminkan" as call_type:
+                event_type = {
+                    "chi": mjxproto.EVENT_TYPE_CHI,
+                    "pon": mjxproto.EVENT_TYPE_PON,
+                    "ankan": mjxproto.EVENT_TYPE_CLOSED_KAN,
+                    "daiminkan": mjxproto.EVENT_TYPE_OPEN_KAN,
+                }[call_type]
+                if call_type in ["ankan", "daiminkan"]:
+                    open_code, consume_tiles_from_hand = OpenCodeGen.from_mjai_kan(mjai_event)
+                else:
+                    # 鳴いた席がこの卓にいればその手牌から、いなければ卓でまだ払い出していない牌 id を使う
+                    gen = OpenCodeGen.from_mjai_chi if call_type == "chi" else OpenCodeGen.from_mjai_pon
+                    if actor_seat is not None:
+                        open_code, consume_tiles_from_hand = gen(
+                            mjai_event, self.last_discard_tile, actor_seat.closed_tiles())
+                    else:
+                        open_code, consume_tiles_from_hand = gen(
+                            mjai_event, self.last_discard_tile, seen=self.seen_tiles)
+                if actor_seat is not None:
+                    actor_seat.add_open(open_code)
+                    for t in consume_tiles_from_hand:
+                        actor_seat.remove_closed_tile(t)
+                else:
+                    self.mark_seen(consume_tiles_from_hand)
+                if call_type == "pon":
+                    self.pons[to_mjx_tile(mjai_event["pai"]) // 4] = open_code
+                self.append_event(event_type, actor, open_code=open_code)
+                update = (DiscardIndex.meld, actor, open_code)
+
+            case "kakan":
+                pons = actor_seat.opens() if actor_seat is not None else self.pons.values()
+                open_code, consume_tiles_from_hand, called_tile_id, pon_open_code = OpenCodeGen.from_mjai_kakan(
+                    mjai_event, pons)
+                self.pons.pop(to_mjx_tile(mjai_event["pai"]) // 4, None)
+                if actor_seat is not None:
+                    actor_seat.add_open(open_code)
+                    actor_seat.remove_open(pon_open_code)
+                    actor_seat.remove_closed_tile(called_tile_id)
+                else:
+                    self.mark_seen([called_tile_id])
+                self.append_event(mjxproto.EVENT_TYPE_ADDED_KAN, actor, open_code=open_code)
+                update = (DiscardIndex.meld, actor, open_code)
+
+            case "reach":
+                self.append_event(mjxproto.EVENT_TYPE_RIICHI, actor)
+                update = (DiscardIndex.declare_riichi, actor)
+
+            case "dora":
+                hai_ = self.allocate(to_mjx_tile(mjai_event["dora_marker"]))
+                self.dora_indicators.append(hai_)
+                update = (DiscardIndex.reveal_dora_indicator, hai_ // 4)
+
+        self.rows_after.append(len(self.events))
+        self.doras_after.append(len(self.dora_indicators))
+        self.index_updates.append(update)
+
+
+class SeatState(CompactHand):
+    """Private view of one seat on top of a TableKyoku, with the CompactObservationState interface."""
+
+    def __init__(self, who: int):
+        self.who = who
+        self.kyoku = None
+        # 局の中で受け取った MJAI イベントの数
+        self.cursor = 0
+        # cursor までのイベントで更新した捨て牌とリーチ状態
+        self.discard_index = DiscardIndex()
+        self._start_hand([])
+
+    def is_empty(self) -> bool:
+        return self.kyoku is None
+
+    def start_kyoku(self, kyoku: TableKyoku, init_hand: list[int]) -> None:
+        self.kyoku = kyoku
+        self.cursor = 0
+        self.discard_index = DiscardIndex()
+        self.discard_index.reveal_dora_indicator(kyoku.dora_indicators[0] // 4)
+        self._start_hand(init_hand)
+        kyoku.seats[self.who] = self
+
+    def advance(self) -> None:
+        # 卓で適用済みの次のイベントまで進める
+        update = self.kyoku.index_updates[self.cursor]
+        if update is not None:
+            method, *args = update
+            method(self.discard_index, *args)
+        self.cursor += 1
+
+    def num_rows(self) -> int:
+        return self.kyoku.rows_after[self.cursor - 1] if self.cursor > 0 else 0
+
+    def dora_indicators(self) -> list[int]:
+        num_doras = self.kyoku.doras_after[self.cursor - 1] if self.cursor > 0 else 1
+        return self.kyoku.dora_indicators[:num_doras]
+
+    def last_event_who(self) -> int:
+        return self.kyoku.events[self.num_rows() - 1].get("who", 0)
+
+    def to_dict(self) -> dict[str, Any]:
+        if self.kyoku is None:
+            return {}
+        return {
+            "who": self.who,
+            "publicObservation": {
+                "playerIds": ["player_0","player_1","player_2","player_3"],
+                "initScore": {
+                    "tens": self.kyoku.scores,
+                },
+                "doraIndicators": self.dora_indicators(),
+                "events": self.kyoku.events[:self.num_rows()],
+            },
+            "privateObservation": self._private_dict(self.who),
+        }
+
+    def to_json(self) -> str:
+        # json_dumps(self.to_dict()) と同じ文字列を、events は卓で共有しているものから切り出す
+        return (
+            '{"who":' + str(self.who)
+            + ',"publicObservation":{"playerIds":' + _PLAYER_IDS_JSON
+            + ',"initScore":{"tens":' + json_dumps(self.kyoku.scores)
+            + '},"doraIndicators":' + json_dumps(self.dora_indicators())
+            + ',"events":[' + self.kyoku.events_json(self.num_rows())
+            + ']},"privateObservation":' + self._private_json(self.who)
+            + '}'
+        )
+
+
+class TableState:
+    """The seats of one table hosted in this process and the kyoku they share."""
+
+    def __init__(self):
+        self.kyoku = None
+        self.seats = {}
+
+    def seat(self, who: int) -> SeatState:
+        if who in self.seats:
+            raise ValueError(f"Seat {who} is already taken.")
+        self.seats[who] = SeatState(who)
+        return self.seats[who]
+
+    def apply(self, who: int, mjai_events: list[dict[str, Any]]) -> None:
+        seat = self.seats[who]
+        for mjai_event in mjai_events:
+            mjai_event_type = mjai_event.get("type")
+
+            if mjai_event_type == "start_kyoku":
+                # 最初に受け取った席が新しい局を作り、残りの席はそこに加わる
+                if self.kyoku is None or seat.kyoku is self.kyoku:
+                    self.kyoku = TableKyoku(mjai_event["scores"], to_mjx_tile(mjai_event["dora_marker"]))
+                tehais = [self.kyoku.allocate(to_mjx_tile(s)) for s in mjai_event["tehais"][who]]
+                seat.start_kyoku(self.kyoku, tehais)
+                continue
+
+            if seat.kyoku is None or mjai_event_type in _OUT_OF_KYOKU_EVENTS:
+                continue
+
+            kyoku = seat.kyoku
+            if mjai_event_type == "tsumo" and mjai_event["actor"] == who:
+                seat.draw(kyoku.allocate(to_mjx_tile(mjai_event["pai"])))
+            if seat.cursor == kyoku.num_events:
+                # 先頭の席が公開部分を適用する。遅れている席は適用済みのものを使う
+                kyoku.apply(mjai_event)
+            seat.advance()
+
+
+class TableGateway(BaseGateway):
+    """Gateway for one seat of a TableState, fed the seat's MJAI stream as MjxGateway is."""
+
+    def __init__(self, table: TableState, actor_id: int, mjx_bot):
+        self.table = table
+        super().__init__(actor_id, mjx_bot)
+
+    def _new_state(self, obs=None):
+        return self.table.seat(self.actor_id)
+
+    @property
+    def discard_index(self) -> DiscardIndex:
+        return self.state.discard_index
+
+    def _apply_mjai_events(self, mjai_events):
+        self.table.apply(self.actor_id, mjai_events)
@@ -0,0 +1,60 @@
+import gzip
+import json
+
+from benchmark import compare_to_baseline, mask_for_seat, replay_sessions, synthetic_kyoku
+
+
+def _without_can_act(events):
+    return [{k: v for k, v in e.items() if k != "can_act"} for e in events]
+
+
+def _full_log():
+    # synthetic_kyoku の牌を伏せていないもの (実際のログと同じく can_act は持たない)
+    events = [{"type": "start_game", "names": ["a", "b", "c", "d"]}]
+    kyoku = _without_can_act(synthetic_kyoku(0, seed=1, num_draws=8))
+    unmasked = [_without_can_act(synthetic_kyoku(seat, seed=1, num_draws=8)) for seat in range(4)]
+    start = dict(kyoku[0], tehais=[unmasked[seat][0]["tehais"][seat] for seat in range(4)])
+    events.append(start)
+    for i, event in enumerate(kyoku[1:], 1):
+        events.append(unmasked[event["actor"]][i] if event["type"] == "tsumo" else event)
+    events.append({"type": "end_kyoku"})
+    return events
+
+
+def test_mask_for_seat_matches_synthetic_kyoku():
+    events = _full_log()
+    for seat in range(4):
+        masked = [mask_for_seat(e, seat) for e in events]
+        assert masked[0]["id"] == seat
+        assert masked[1:-1] == _without_can_act(synthetic_kyoku(seat, seed=1, num_draws=8))
+
+
+def test_replay_sessions(tmp_path):
+    path = tmp_path / "game.json.gz"
+    with gzip.open(path, "wt") as f:
+        for event in _full_log():
+            f.write(json.dumps(event) + "\n")
+    react_path = tmp_path / "seat2.jsonl"
+    react_path.write_text('[{"type":"start_game","id":2}]\n[{"type":"end_game"}]\n')
+
+    sessions = replay_sessions([str(path), str(react_path)])
+    assert [seat for seat, _ in sessions] == [0, 1, 2, 3, 2]
+    assert all(len(lines) == len(_full_log()) for _, lines in sessions[:4])
+    assert json.loads(sessions[1][1][0]) == [{"type": "start_game", "names": ["a", "b", "c", "d"], "id": 1}]
+    assert [seat for seat, _ in replay_sessions([str(path)], seats=[3])] == [3]
+
+
+def test_compare_to_baseline():
+    stats = {"count": 100, "p50": 100.0, "p95": 200.0, "p99": 300.0, "mean": 120.0}
+    baseline = {"throughput": 1000.0, "latency_us": {"tsumo": stats, "dahai": dict(stats, count=10)}}
+    assert compare_to_baseline(baseline, baseline) == []
+
+    slower = {"throughput": 700.0, "latency_us": {
+        "tsumo": dict(stats, p95=300.0),
+        # 件数が少ないものは比較しない
+        "dahai": dict(stats, count=10, p50=1000.0),
+    }}
+    regressions = compare_to_baseline(slower, baseline, tolerance=0.2)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("throughput")
+    assert regressions[1].startswith("tsumo p95")
@@ -0,0 +1,334 @@
+import json
+import random
+
+import mjx
+import pytest
+from mjx.const import ActionType, TileType
+
+from bot import (
+    DecisionContext,
+    DiscardSpeculation,
+    RuleBasedAgent,
+    ADJACENCY_HEAD,
+    ADJACENCY_NONE,
+    ADJACENCY_PENCHAN,
+    ADJACENCY_RYANMEN,
+    ADJACENCY_SCORES,
+    ADJACENCY_SKIP,
+    DISCARD_SCORE_SCALE,
+    adjacency_classes,
+)
+from gateway import MjxGateway
+from meld import MELDS
+from shanten import ShantenCache
+
+
+INPUTS = [
+    '[{"type":"start_kyoku","bakaze":"E","dora_marker":"5p","kyoku":1,"honba":0,"kyotaku":0,"oya":0,"scores":[25000,25000,25000,25000],"tehais":[["S","2m","C","2m","7p","C","6m","7m","N","W","3p","6s","8s"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"]],"can_act":false},{"type":"tsumo","actor":0,"pai":"3p","can_act":true}]',
+    '[{"type":"dahai","actor":0,"pai":"8s","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":1,"pai":"?","can_act":false},{"type":"dahai","actor":1,"pai":"E","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":2,"pai":"?","can_act":false},{"type":"dahai","actor":2,"pai":"S","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":3,"pai":"?","can_act":false},{"type":"dahai","actor":3,"pai":"1m","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":0,"pai":"1p","can_act":true}]',
+    '[{"type":"dahai","actor":0,"pai":"N","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":1,"pai":"?","can_act":false},{"type":"dahai","actor":1,"pai":"9m","tsumogiri":true,"can_act":false},{"type":"tsumo","actor":2,"pai":"?","can_act":false},{"type":"reach","actor":2,"can_act":false},{"type":"dahai","actor":2,"pai":"1p","tsumogiri":false,"can_act":false},{"type":"reach_accepted","actor":2,"can_act":false},{"type":"tsumo","actor":3,"pai":"?","can_act":false},{"type":"dahai","actor":3,"pai":"W","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":0,"pai":"5mr","can_act":true}]',
+    '[{"type":"dahai","actor":0,"pai":"W","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":1,"pai":"?","can_act":false},{"type":"dahai","actor":1,"pai":"S","tsumogiri":true,"can_act":false},{"type":"tsumo","actor":2,"pai":"?","can_act":false},{"type":"dahai","actor":2,"pai":"7p","tsumogiri":true,"can_act":false},{"type":"tsumo","actor":3,"pai":"?","can_act":false},{"type":"dahai","actor":3,"pai":"2s","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":0,"pai":"C","can_act":true}]',
+]
+
+
+def _reference_live_tiles(observation):
+    # 観測の JSON から数え直した、自分から見えていない牌種ごとの残り枚数
+    obs = json.loads(observation.to_json())
+    public = obs["publicObservation"]
+    tiles = public.get("doraIndicators", []) + obs["privateObservation"]["currHand"].get("closedTiles", [])
+    for e in public.get("events", []):
+        event_type = e.get("type", "EVENT_TYPE_DISCARD")
+        if event_type in ["EVENT_TYPE_DISCARD", "EVENT_TYPE_TSUMOGIRI"]:
+            tiles.append(e.get("tile", 0))
+        elif event_type == "EVENT_TYPE_ADDED_KAN":
+            tiles.append(MELDS[e.get("open", 0)].last_tile)
+        elif event_type in ["EVENT_TYPE_CHI", "EVENT_TYPE_PON", "EVENT_TYPE_OPEN_KAN", "EVENT_TYPE_CLOSED_KAN"]:
+            tiles += MELDS[e.get("open", 0)].tiles_from_hand
+    live_tiles = [4] * 34
+    for tile in tiles:
+        live_tiles[tile // 4] -= 1
+    return live_tiles
+
+
+def _reference_heuristic_score(agent, observation, action):
+    # ベクトル化する前の _heuristic_score / _betaori_score と同じ計算
+    curr_hand = observation.curr_hand()
+    tile = action.tile()
+    shanten, effective_draw_types = agent._shanten_and_effective_types_after_discard(curr_hand, tile)
+    live_tiles = _reference_live_tiles(observation)
+    score = 13000 - 1000 * shanten + 2.5 * sum(live_tiles[t] for t in effective_draw_types)
+    num = tile.num()
+    if num == None:
+        score += 6
+    if num == 1 or num == 9:
+        score += 4
+    if num == 2 or num == 8:
+        score += 2
+    if tile.type() in agent._fanpais(observation):
+        score -= 1
+    score -= 2 * observation.doras().count(tile.type())
+    if tile.is_red():
+        score -= 2
+    score -= agent._adjacency_heuristic_score(curr_hand, tile)
+    riichi_players = agent._get_riichi_players(observation)
+    if any(riichi_players):
+        safe_tiles = agent._safe_tiles(observation)
+        for player in range(4):
+            if riichi_players[player] and tile.type() in safe_tiles[player]:
+                score += 20000
+        score -= 10000 * observation.doras().count(tile.type())
+        if tile.is_red():
+            score -= 10000
+        if num == None:
+            score += 200
+        if num == 1 or num == 9:
+            score += 100
+    return score
+
+
+def _own_draw_observations():
+    gateway = MjxGateway(0, None)
+    for line in INPUTS:
+        yield gateway._get_mjx_obs(json.loads(line))
+
+
+def _legal_discards(observation):
+    return [a for a in observation.legal_actions() if a.type() in [ActionType.DISCARD, ActionType.TSUMOGIRI]]
+
+
+def test_decision_context_matches_helpers():
+    agent = RuleBasedAgent()
+    under_riichi = []
+    for observation in _own_draw_observations():
+        ctx = DecisionContext(agent, observation)
+        # discard_index を付けない観測 (牌譜を走査する経路) とも比べる
+        plain = mjx.Observation(observation.to_json())
+        assert ctx.fanpais == agent._fanpais(observation) == agent._fanpais(plain)
+        assert ctx.doras == observation.doras()
+        assert ctx.riichi_players == agent._get_riichi_players(observation) == agent._get_riichi_players(plain)
+        assert ctx.under_riichi == any(ctx.riichi_players)
+        if ctx.under_riichi:
+            assert ctx.safe_tiles == [frozenset(s) for s in agent._safe_tiles(plain)]
+        else:
+            assert ctx.safe_tiles is None
+        under_riichi.append(ctx.under_riichi)
+    assert under_riichi == [False, False, True, True]
+
+
+def test_vectorized_discard_scores_match_reference():
+    agent = RuleBasedAgent()
+    for observation in _own_draw_observations():
+        discards = _legal_discards(observation)
+        ctx = DecisionContext(agent, observation)
+        scores = agent._score_discards([ctx], [discards])[0]
+        for action, score in zip(discards, scores):
+            assert abs(score / DISCARD_SCORE_SCALE - _reference_heuristic_score(agent, observation, action)) < 1e-6
+
+        expected = sorted(discards, key=lambda a: _reference_heuristic_score(agent, observation, a))[-1]
+        assert agent._select_discard(scores, discards).to_json() == expected.to_json()
+        if len(discards) == len(observation.legal_actions()):
+            assert agent.act(observation).to_json() == expected.to_json()
+
+
+def test_score_discards_batch_matches_single():
+    agent = RuleBasedAgent()
+    contexts = []
+    candidates = []
+    singles = []
+    for observation in _own_draw_observations():
+        ctx = DecisionContext(agent, observation)
+        discards = _legal_discards(observation)
+        contexts.append(ctx)
+        candidates.append(discards)
+        singles.append(agent._score_discards([ctx], [discards])[0])
+    batch = agent._score_discards(contexts, candidates)
+    assert len(batch) == len(singles)
+    for batch_scores, single_scores in zip(batch, singles):
+        assert batch_scores.tolist() == single_scores.tolist()
+
+
+def test_act_batch_matches_act():
+    agent = RuleBasedAgent()
+    observations = list(_own_draw_observations())
+    expected = [agent.act(observation).to_json() for observation in observations]
+    assert [action.to_json() for action in agent.act_batch(observations)] == expected
+    assert agent.act_batch([]) == []
+
+
+def test_act_batch_speculates_like_act():
+    # 後処理は act() を順に呼んだ最後の状態と同じで、先読みは 1 度だけ始める
+    observations = list(_own_draw_observations())
+    reference = RuleBasedAgent(speculative=True)
+    for observation in observations:
+        reference.act(observation)
+    agent = RuleBasedAgent(speculative=True)
+    agent.act_batch(observations)
+    assert agent.speculation.key == reference.speculation.key is not None
+    assert agent.speculation_info()["started"] == 1
+    reference.close()
+    agent.close()
+
+
+def test_call_table_matches_call_path():
+    # 鳴きの判定を表で引く agent と毎回計算する agent が、mjx の対局で同じ行動を選ぶ
+    player_ids = ["player_0", "player_1", "player_2", "player_3"]
+    agents = {player_id: RuleBasedAgent() for player_id in player_ids}
+    references = {player_id: RuleBasedAgent(use_call_table=False) for player_id in player_ids}
+    num_call_decisions = 0
+    for seed in range(2):
+        random.seed(seed)
+        env = mjx.MjxEnv()
+        obs_dict = env.reset(seed, player_ids)
+        while not env.done():
+            actions = {}
+            for player_id, obs in obs_dict.items():
+                state = random.getstate()
+                expected = references[player_id].act(obs)
+                random.setstate(state)
+                actions[player_id] = agents[player_id].act(obs)
+                assert actions[player_id].to_json() == expected.to_json()
+                if any(a.type() in [ActionType.CHI, ActionType.PON, ActionType.OPEN_KAN] for a in obs.legal_actions()):
+                    num_call_decisions += 1
+            obs_dict = env.step(actions)
+    assert num_call_decisions > 0
+    assert sum(agent.call_table_hits for agent in agents.values()) > 0
+
+
+def test_discard_speculation_matches_shanten_cache():
+    rng = random.Random(0)
+    cache = ShantenCache()
+    speculation = DiscardSpeculation()
+    for _ in range(10):
+        hand = sorted(rng.sample(range(136), 13))
+        speculation.start(hand, [])
+        assert speculation.wait(10)
+        drawn = rng.choice([t for t in range(136) if t not in hand])
+        after_discard = speculation.lookup(hand + [drawn], [])
+        for tile in hand + [drawn]:
+            shanten_number, effective_draw_types = cache.get([t for t in hand + [drawn] if t != tile], [])
+            assert after_discard[tile // 4] == (shanten_number, effective_draw_types)
+    # 手牌が合わなければ外れ
+    speculation.start(hand, [])
+    assert speculation.lookup(hand[1:] + [drawn], []) is None
+    info = speculation.info()
+    assert (info["hits"], info["misses"]) == (10, 1)
+
+    # 残りのない牌種は計算しない
+    live_tiles = [4] * 34
+    live_tiles[drawn // 4] = 0
+    speculation.start(hand, [], live_tiles)
+    assert speculation.wait(10)
+    assert drawn // 4 not in speculation.results
+    assert len(speculation.results) > 0
+
+    # close で worker が終わり、次の start でまた動く
+    thread = speculation._thread
+    speculation.close()
+    assert speculation._thread is None and not thread.is_alive()
+    speculation.start(hand, [])
+    assert speculation.wait(10)
+    speculation.close()
+
+
+def test_discard_speculation_saved_time():
+    # ヒットで短くなった _discard_features の平均時間 × ヒットした回数
+    speculation = DiscardSpeculation()
+    assert speculation.info()["saved_ms"] == 0.0
+    for seconds in [0.003, 0.005]:
+        speculation.record_features(False, seconds)
+    for seconds in [0.001, 0.001, 0.001]:
+        speculation.record_features(True, seconds)
+    info = speculation.info()
+    assert info["miss_features_us"] == pytest.approx(4000)
+    assert info["hit_features_us"] == pytest.approx(1000)
+    assert info["saved_ms"] == pytest.approx(9)
+
+
+def test_speculative_agent_matches_agent():
+    player_ids = ["player_0", "player_1", "player_2", "player_3"]
+    agents = {player_id: RuleBasedAgent(speculative=True) for player_id in player_ids}
+    references = {player_id: RuleBasedAgent() for player_id in player_ids}
+    random.seed(0)
+    env = mjx.MjxEnv()
+    obs_dict = env.reset(0, player_ids)
+    while not env.done():
+        actions = {}
+        for player_id, obs in obs_dict.items():
+            state = random.getstate()
+            expected = references[player_id].act(obs)
+            random.setstate(state)
+            actions[player_id] = agents[player_id].act(obs)
+            assert actions[player_id].to_json() == expected.to_json()
+        obs_dict = env.step(actions)
+    assert sum(agent.speculation_info()["hits"] for agent in agents.values()) > 0
+    for agent in agents.values():
+        agent.close()
+
+
+def _reference_adjacency_class(closed_tile_types, tile):
+    # 表にする前の RuleBasedAgent._adjacency_class
+    def is_single(tile):
+        return closed_tile_types[tile.type()] == 1
+    def is_head(tile):
+        return closed_tile_types[tile.type()] >= 2
+    def is_kotsu(tile):
+        return closed_tile_types[tile.type()] >= 3
+    def has_relative(tile, offset):
+        if offset == 0:
+            return True
+        to_find = int(tile.type()) + offset
+        if to_find < TileType.M1 or to_find > TileType.S9 or int(tile.type()) // 9 != int(to_find) // 9:
+            return False
+        return closed_tile_types[to_find] > 0
+    def is_shuntsu(tile):
+        for start in range(-2, 1):
+            if has_relative(tile, start) and has_relative(tile, start+1) and has_relative(tile, start+2):
+                return True
+        return False
+    def has_neighbors(tile):
+        return has_relative(tile, -1) or has_relative(tile, 1)
+    def has_skip_neighbors(tile):
+        return has_relative(tile, -2) or has_relative(tile, 2)
+    def is_penchan(tile):
+        return not is_shuntsu(tile) and (
+            tile.num() == 1 and has_relative(tile, 1) or
+            tile.num() == 2 and has_relative(tile, -1) or
+            tile.num() == 8 and has_relative(tile, 1) or
+            tile.num() == 9 and has_relative(tile, -1))
+    def is_ryanmen(tile):
+        return not is_shuntsu(tile) and not is_penchan(tile) and has_neighbors(tile)
+    def is_ryankan(tile):
+        return not is_shuntsu(tile) and not has_neighbors(tile) and (
+            has_relative(tile, -4) and has_relative(tile, -2) or
+            has_relative(tile, -2) and has_relative(tile, 2) or
+            has_relative(tile, 2) and has_relative(tile, 4))
+    if is_head(tile):
+        return ADJACENCY_HEAD
+    elif is_ryanmen(tile):
+        return ADJACENCY_RYANMEN
+    elif has_skip_neighbors(tile):
+        return ADJACENCY_SKIP
+    elif is_penchan(tile):
+        return ADJACENCY_PENCHAN
+    return ADJACENCY_NONE
+
+
+def test_adjacency_classes_match_adjacency_class():
+    # 各色の 9 種を持つ/持たない全パターンと、各牌が対子かどうかのすべてで確かめる
+    for suit_begin in (0, 9, 18):
+        for present in range(1 << 9):
+            for head in range(9):
+                counts = [0] * 34
+                for i in range(9):
+                    if present >> i & 1:
+                        counts[suit_begin + i] = 2 if i == head else 1
+                classes = adjacency_classes(counts)
+                for i in range(9):
+                    tile = mjx.Tile((suit_begin + i) * 4)
+                    assert classes[suit_begin + i] == _reference_adjacency_class(counts, tile), (counts, i)
+    for tile_type in range(27, 34):
+        for count in range(4):
+            counts = [0] * 34
+            counts[tile_type] = count
+            assert adjacency_classes(counts)[tile_type] == _reference_adjacency_class(counts, mjx.Tile(tile_type * 4))
+    assert ADJACENCY_SCORES[adjacency_classes([0, 1, 1, 0, 1] + [0] * 29)[1]] == 0.3
@@ -1,4 +1,5 @@
 import json
+import random
 from loguru import logger
 
 from mjx.agents import ShantenAgent, RuleBasedAgent
@@ -7,9 +8,16 @@ import mjx
 from gateway import (
     to_mjx_tile,
     to_mjai_tile,
+    to_mjx_base_tile,
     MjxGateway,
     OpenCodeGen,
+    DiscardIndex,
+    StageTimer,
+    event_row,
+    json_dumps,
+    lowest_unseen_tile,
 )
+import gateway as gateway_module
 
 
 TODO_FIX_KNOWN_BUGS = False
@@ -19,6 +27,8 @@ def test_to_mjx_tile():
     assert to_mjx_tile("5mr") == 16
     assert to_mjx_tile("5m") == 17
     assert to_mjx_tile("5m", ignore_aka=True) == 16
+    assert to_mjx_tile("?") is None
+    assert to_mjx_tile("?", ignore_aka=True) is None
 
 
 def test_to_mjai_tile():
@@ -30,6 +40,15 @@ def test_to_mjai_tile():
     assert to_mjai_tile(20) == "6m"
 
 
+def test_to_mjx_base_tile():
+    for tile_id in range(136):
+        assert to_mjx_base_tile(tile_id) == to_mjx_tile(to_mjai_tile(tile_id))
+        assert to_mjx_base_tile(tile_id, ignore_aka=True) == to_mjx_tile(to_mjai_tile(tile_id), ignore_aka=True)
+    assert to_mjx_base_tile(16) == 16
+    assert to_mjx_base_tile(19) == 17
+    assert to_mjx_base_tile(19, ignore_aka=True) == 16
+
+
 def test_shanten_agent_case1():
     player_id = 1
     bot = MjxGateway(player_id, ShantenAgent())
@@ -125,6 +144,374 @@ def test_shanten_agent_case5():
     assert bot.get_obs_hand() == [0, 4, 9, 56, 60, 64, 96, 100]
 
 
+class DictObservationState:
+    """CompactObservationState の参照実装。mjx の Observation JSON と同じ形の dict をそのまま更新する"""
+
+    def __init__(self, obs=None):
+        self.obs = {} if obs is None else obs
+
+    def is_empty(self):
+        return len(self.obs) == 0
+
+    def start_kyoku(self, who, scores, dora_indicator, init_hand):
+        self.obs = {
+            "who": who,
+            "publicObservation": {
+                "playerIds": ["player_0","player_1","player_2","player_3"],
+                "initScore": {
+                    "tens": scores,
+                },
+                "doraIndicators": [
+                    dora_indicator
+                ],
+                "events": [],
+            },
+            "privateObservation": {
+                "who": who,
+                "initHand": {
+                    "closedTiles": init_hand,
+                },
+                "drawHistory": [],
+                "currHand": {
+                    "closedTiles": list(sorted(init_hand)),
+                    "opens": [],
+                }
+            }
+        }
+
+    def append_event(self, event_type, who, tile=None, open_code=None):
+        self.obs["publicObservation"]["events"].append(event_row(event_type, who, tile, open_code))
+
+    def add_dora_indicator(self, tile):
+        self.obs["publicObservation"]["doraIndicators"].append(tile)
+
+    def last_event_who(self):
+        return self.obs["publicObservation"]["events"][-1].get("who", 0)
+
+    def closed_tiles(self):
+        return self.obs["privateObservation"]["currHand"]["closedTiles"]
+
+    def opens(self):
+        return self.obs["privateObservation"]["currHand"]["opens"]
+
+    def draw(self, tile):
+        self.obs["privateObservation"]["drawHistory"].append(tile)
+        self.obs["privateObservation"]["currHand"]["closedTiles"] = list(sorted(self.closed_tiles() + [tile]))
+
+    def remove_closed_tile(self, tile):
+        self.closed_tiles().remove(tile)
+
+    def take_closed_tile(self, hai):
+        # hai (赤は区別する) と同じ牌のうち最小の id を手牌から除く
+        tile = [t for t in self.closed_tiles() if to_mjx_base_tile(t) == hai][0]
+        self.remove_closed_tile(tile)
+        return tile
+
+    def add_open(self, open_code):
+        self.opens().append(open_code)
+
+    def remove_open(self, open_code):
+        self.opens().remove(open_code)
+
+    def to_dict(self):
+        return self.obs
+
+    def to_json(self):
+        return json_dumps(self.obs)
+
+
+class DictGateway(MjxGateway):
+    """観測を DictObservationState で持つ MjxGateway"""
+
+    def _new_state(self, obs=None):
+        return DictObservationState(obs)
+
+
+def test_compact_state_matches_dict_state():
+    inputs = [
+        '[{"type":"start_kyoku","bakaze":"E","dora_marker":"4p","kyoku":1,"honba":1,"kyotaku":0,"oya":0,"scores":[26500,23500,25000,25000],"tehais":[["6m","2p","3s","6p","7m","7p","8p","7m","8m","N","E","P","2m"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"]],"can_act":false},{"type":"tsumo","actor":0,"pai":"1m","can_act":true}]',
+        '[{"type":"dahai","actor":0,"pai":"3s","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":1,"pai":"?","can_act":false},{"type":"ankan","actor":1,"consumed":["9s","9s","9s","9s"],"can_act":false},{"type":"dora","dora_marker":"2s","can_act":false},{"type":"tsumo","actor":1,"pai":"W","can_act":false},{"type":"dahai","actor":1,"pai":"W","tsumogiri":true,"can_act":false},{"type":"tsumo","actor":2,"pai":"1s","can_act":false},{"type":"reach","actor":2,"can_act":false},{"type":"dahai","actor":2,"pai":"1s","tsumogiri":true,"can_act":false},{"type":"reach_accepted","actor":2,"can_act":false},{"type":"tsumo","actor":3,"pai":"6m","can_act":false},{"type":"dahai","actor":3,"pai":"6m","tsumogiri":true,"can_act":true}]',
+        '[{"type":"chi","actor":0,"target":3,"pai":"6m","consumed":["7m","8m"],"can_act":true}]',
+        '[{"type":"dahai","actor":0,"pai":"P","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":1,"pai":"3p","can_act":false},{"type":"dahai","actor":1,"pai":"3p","tsumogiri":true,"can_act":false},{"type":"tsumo","actor":2,"pai":"4m","can_act":false},{"type":"dahai","actor":2,"pai":"4m","tsumogiri":true,"can_act":false},{"type":"tsumo","actor":3,"pai":"8m","can_act":false},{"type":"dahai","actor":3,"pai":"8m","tsumogiri":true,"can_act":true}]',
+        '[{"type":"chi","actor":0,"target":3,"pai":"8m","consumed":["6m","7m"],"can_act":true}]',
+    ]
+    dict_bot = DictGateway(0, ShantenAgent())
+    compact_bot = MjxGateway(0, ShantenAgent())
+    for line in inputs:
+        dict_bot._apply_mjai_events(json.loads(line))
+        compact_bot._apply_mjai_events(json.loads(line))
+        assert compact_bot.get_obs_hand() == dict_bot.get_obs_hand()
+        assert compact_bot.get_obs_open() == dict_bot.get_obs_open()
+        assert compact_bot.get_obs() == dict_bot.get_obs()
+        assert compact_bot.state.to_json() == dict_bot.state.to_json()
+    assert [river.tolist() for river in compact_bot.state.rivers] == [[80, 124], [116, 44], [72, 12], [21, 29]]
+
+    # set_obs_offset で dict から作り直しても同じ
+    rebuilt = MjxGateway(0, ShantenAgent())
+    rebuilt.set_obs_offset(dict_bot.get_obs(), dict(dict_bot.hai_offset))
+    assert rebuilt.get_obs() == dict_bot.get_obs()
+    assert rebuilt.state.to_json() == dict_bot.state.to_json()
+
+    # 見えている牌: ドラ表示牌 4p と槓ドラ表示牌 2s、河の 3s W 1s 6m P 3p 4m 8m、暗槓した 9s、チーで晒した 7m 8m と 6m 7m
+    assert compact_bot.state.dora_indicators == [48, 76]
+    visible = [0] * 34
+    for tile_type, n in [(12, 1), (19, 1), (20, 1), (29, 1), (18, 1), (26, 4), (5, 2), (31, 1), (11, 1), (3, 1), (6, 2), (7, 2)]:
+        visible[tile_type] = n
+    assert compact_bot.discard_index.visible == visible
+    assert rebuilt.discard_index.visible == visible
+
+
+def test_kan_dora_indicator_ids():
+    # 槓ドラ表示牌にも牌 id を払い出して doraIndicators に加えるので、同じ種類の後の牌は次の id になる
+    events = [
+        {"type":"start_kyoku","bakaze":"E","dora_marker":"4p","kyoku":1,"honba":0,"kyotaku":0,"oya":0,"scores":[25000,25000,25000,25000],"tehais":[["6m","2p","3s","6p","7m","7p","8p","7m","8m","N","E","P","2m"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"]]},
+        {"type":"tsumo","actor":0,"pai":"1m"},
+        {"type":"dahai","actor":0,"pai":"3s","tsumogiri":False},
+        {"type":"tsumo","actor":1,"pai":"?"},
+        {"type":"ankan","actor":1,"consumed":["9s","9s","9s","9s"]},
+        {"type":"dora","dora_marker":"2s"},
+        {"type":"tsumo","actor":1,"pai":"?"},
+        {"type":"dahai","actor":1,"pai":"2s","tsumogiri":True},
+    ]
+    bot = MjxGateway(0, None)
+    bot._apply_mjai_events(events)
+    public = bot.get_obs()["publicObservation"]
+    assert public["doraIndicators"] == [48, 76]
+    assert public["events"][-1] == {"tile": 77, "who": 1}
+    assert bot.hai_offset[76] == 2
+
+
+def _random_call(rng, hands, target, tile):
+    # target が切った tile をポンできる他家と、チーできる下家の (種類, 鳴く人, 晒す牌) からひとつ選ぶ。
+    # 他家は赤を含めてどの牌でも晒し、自家 (0) は OpenCodeGen と同じく同じ種類の小さい id から晒す
+    def pick(actor, same, n):
+        return sorted(same)[:n] if actor == 0 else rng.sample(same, n)
+
+    tile_type = tile // 4
+    candidates = []
+    for actor in range(4):
+        same = [t for t in hands[actor] if t // 4 == tile_type]
+        if actor != target and len(same) >= 2:
+            candidates.append(("pon", actor, pick(actor, same, 2)))
+    actor = (target + 1) % 4
+    if tile_type < 27:
+        for first in range(tile_type - 2, tile_type + 1):
+            if first < 0 or first // 9 != tile_type // 9 or first % 9 > 6:
+                continue
+            consumed = []
+            for t in range(first, first + 3):
+                if t != tile_type:
+                    same = [x for x in hands[actor] if x // 4 == t]
+                    if not same:
+                        break
+                    consumed += pick(actor, same, 1)
+            else:
+                candidates.append(("chi", actor, consumed))
+    return rng.choice(candidates) if candidates else None
+
+
+def _random_kyoku_events(rng):
+    # 赤を含む 136 枚を配り、4 人がツモ切りか手出しを繰り返す mjai イベント列。ときどきチー・ポン・加槓が入る
+    wall = list(range(136))
+    rng.shuffle(wall)
+    hands = [sorted(wall[i * 13:(i + 1) * 13]) for i in range(4)]
+    wall = wall[52:]
+    events = [{
+        "type": "start_kyoku", "bakaze": "E", "dora_marker": to_mjai_tile(wall.pop()), "kyoku": 1, "honba": 0,
+        "kyotaku": 0, "oya": 0, "scores": [25000] * 4,
+        "tehais": [[to_mjai_tile(t) for t in hands[0]]] + [["?"] * 13] * 3, "can_act": False,
+    }]
+    # 各家のポン (牌種 -> 3 枚)
+    pons = [{} for _ in range(4)]
+    actor = 0
+    draw = True
+    while len(wall) > 14:
+        hand = hands[actor]
+        tile = None
+        if draw:
+            tile = wall.pop()
+            hand.append(tile)
+            events.append({"type": "tsumo", "actor": actor, "pai": to_mjai_tile(tile) if actor == 0 else "?", "can_act": False})
+            if tile // 4 in pons[actor] and rng.random() < 0.8:
+                events.append({"type": "kakan", "actor": actor, "pai": to_mjai_tile(tile),
+                               "consumed": [to_mjai_tile(t) for t in pons[actor].pop(tile // 4)], "can_act": False})
+                hand.remove(tile)
+                tile = wall.pop()
+                hand.append(tile)
+                events.append({"type": "tsumo", "actor": actor, "pai": to_mjai_tile(tile) if actor == 0 else "?", "can_act": False})
+        discarded = hand.pop(rng.randrange(len(hand)))
+        events.append({"type": "dahai", "actor": actor, "pai": to_mjai_tile(discarded), "tsumogiri": discarded == tile, "can_act": False})
+        call = _random_call(rng, hands, actor, discarded) if rng.random() < 0.3 else None
+        if call is not None:
+            call_type, caller, consumed = call
+            events.append({"type": call_type, "actor": caller, "target": actor, "pai": to_mjai_tile(discarded),
+                           "consumed": [to_mjai_tile(t) for t in consumed], "can_act": False})
+            for t in consumed:
+                hands[caller].remove(t)
+            if call_type == "pon":
+                pons[caller][discarded // 4] = consumed + [discarded]
+            actor = caller
+            draw = False
+        else:
+            actor = (actor + 1) % 4
+            draw = True
+    return events
+
+
+def test_compact_hand_matches_dict_hand_on_random_events():
+    rng = random.Random(20)
+    call_types = set()
+    num_red_calls = 0
+    for _ in range(20):
+        dict_bot = DictGateway(0, ShantenAgent())
+        compact_bot = MjxGateway(0, ShantenAgent())
+        events = _random_kyoku_events(rng)
+        calls = [event for event in events if event["type"] in ["chi", "pon", "kakan"]]
+        call_types.update(event["type"] for event in calls)
+        num_red_calls += sum(any(pai.endswith("r") for pai in event["consumed"]) for event in calls)
+        for event in events:
+            dict_bot._apply_mjai_events([event])
+            compact_bot._apply_mjai_events([event])
+            assert compact_bot.get_obs_hand() == dict_bot.get_obs_hand()
+            assert compact_bot.state.to_json() == dict_bot.state.to_json()
+    assert call_types == {"chi", "pon", "kakan"}
+    assert num_red_calls > 0
+
+
+class CountingAgent(ShantenAgent):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def act(self, observation):
+        self.calls += 1
+        return super().act(observation)
+
+
+def test_skip_act_when_cannot_act():
+    agent = CountingAgent()
+    bot = MjxGateway(0, agent)
+
+    resp = bot.react('[{"type":"start_game"}]')
+    resp = bot.react('[{"type":"start_kyoku","bakaze":"E","dora_marker":"5p","kyoku":1,"honba":0,"kyotaku":0,"oya":0,"scores":[25000,25000,25000,25000],"tehais":[["S","2m","C","2m","7p","C","6m","7m","N","W","3p","6s","8s"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"]],"can_act":false},{"type":"tsumo","actor":0,"pai":"3p","can_act":true}]')
+    assert json.loads(resp)["type"] == "dahai"
+    assert agent.calls == 1
+
+    resp = bot.react('[{"type":"dahai","actor":0,"pai":"S","tsumogiri":false,"can_act":false}]')
+    assert resp == '{"type":"none"}'
+    resp = bot.react('[{"type":"tsumo","actor":1,"pai":"?"}]')
+    assert resp == '{"type":"none"}'
+    assert agent.calls == 1
+    assert bot.num_skipped_acts == 2
+    assert len(bot.get_obs_hand()) == 13
+
+    resp = bot.react('[{"type":"dahai","actor":1,"pai":"2m","tsumogiri":true,"can_act":true}]')
+    assert agent.calls == bot.num_acts == 2
+    resp = bot.react('[{"type":"pon","actor":0,"target":1,"pai":"2m","consumed":["2m","2m"],"can_act":true}]')
+    assert bot.get_obs_open() == [2665]
+    assert agent.calls == bot.num_acts == 3
+
+
+TIMING_INPUTS = [
+    '[{"type":"start_game"}]',
+    '[{"type":"start_kyoku","bakaze":"E","dora_marker":"5p","kyoku":1,"honba":0,"kyotaku":0,"oya":0,"scores":[25000,25000,25000,25000],"tehais":[["S","2m","C","2m","7p","C","6m","7m","N","W","3p","6s","8s"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"]],"can_act":false},{"type":"tsumo","actor":0,"pai":"3p","can_act":true}]',
+    '[{"type":"dahai","actor":0,"pai":"S","tsumogiri":false,"can_act":false}]',
+    '[{"type":"tsumo","actor":1,"pai":"?"}]',
+    '[{"type":"dahai","actor":1,"pai":"2m","tsumogiri":true,"can_act":true}]',
+    '[{"type":"pon","actor":0,"target":1,"pai":"2m","consumed":["2m","2m"],"can_act":true}]',
+]
+
+
+def test_stage_timings():
+    bot = MjxGateway(0, RuleBasedAgent())
+    assert bot.stage_timings() == {}
+    bot.enable_timings()
+    for line in TIMING_INPUTS:
+        bot.react(line)
+
+    timings = bot.stage_timings()
+    assert timings["total"]["count"] == len(TIMING_INPUTS)
+    assert timings["parse"]["count"] == len(TIMING_INPUTS)
+    assert timings["convert"]["count"] == len(TIMING_INPUTS) - 1
+    assert timings["observation"]["count"] == timings["act"]["count"] == timings["response"]["count"] == bot.num_acts
+    assert timings["open_code"]["count"] == 1
+    assert sum(timings["total"]["histogram"].values()) == len(TIMING_INPUTS)
+    assert timings["total"]["total_ms"] >= timings["act"]["total_ms"]
+
+    merged = StageTimer()
+    merged.merge(bot.timer)
+    merged.merge(bot.timer)
+    assert merged.summary()["total"]["count"] == 2 * len(TIMING_INPUTS)
+
+
+def test_enable_timings_registers_dump_once(monkeypatch):
+    registered = []
+    monkeypatch.setattr(gateway_module.atexit, "register", lambda *args: registered.append(args))
+    bot = MjxGateway(0, ShantenAgent())
+    timer = bot.enable_timings("-")
+    assert bot.enable_timings("-") is timer
+    bot.enable_timings()
+    assert registered == [(timer.dump, "-")]
+
+
+def test_stage_timings_disabled_cost(monkeypatch):
+    # 無効なときは時刻を一度も読まない
+    calls = []
+    perf_counter = gateway_module.time.perf_counter
+
+    def counting_perf_counter():
+        calls.append(1)
+        return perf_counter()
+
+    monkeypatch.setattr(gateway_module.time, "perf_counter", counting_perf_counter)
+    bot = MjxGateway(0, RuleBasedAgent())
+    for line in TIMING_INPUTS:
+        bot.react(line)
+    assert calls == []
+    assert bot.timer is None
+
+    bot = MjxGateway(0, RuleBasedAgent())
+    bot.enable_timings()
+    for line in TIMING_INPUTS:
+        bot.react(line)
+    assert len(calls) > 0
+
+
+def test_discard_index_matches_event_scan():
+    import bot as rule_based_bot
+
+    agent = rule_based_bot.RuleBasedAgent()
+    bot = MjxGateway(0, ShantenAgent())
+    inputs = [
+        '[{"type":"start_kyoku","bakaze":"E","dora_marker":"5p","kyoku":1,"honba":0,"kyotaku":0,"oya":0,"scores":[25000,25000,25000,25000],"tehais":[["S","2m","C","2m","7p","C","6m","7m","N","W","3p","6s","8s"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"]],"can_act":false},{"type":"tsumo","actor":0,"pai":"3p","can_act":true}]',
+        '[{"type":"dahai","actor":0,"pai":"8s","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":1,"pai":"?","can_act":false},{"type":"dahai","actor":1,"pai":"E","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":2,"pai":"?","can_act":false},{"type":"dahai","actor":2,"pai":"S","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":3,"pai":"?","can_act":false},{"type":"dahai","actor":3,"pai":"1m","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":0,"pai":"1p","can_act":true}]',
+        '[{"type":"dahai","actor":0,"pai":"N","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":1,"pai":"?","can_act":false},{"type":"dahai","actor":1,"pai":"9m","tsumogiri":true,"can_act":false},{"type":"tsumo","actor":2,"pai":"?","can_act":false},{"type":"reach","actor":2,"can_act":false},{"type":"dahai","actor":2,"pai":"1p","tsumogiri":false,"can_act":false},{"type":"reach_accepted","actor":2,"can_act":false},{"type":"tsumo","actor":3,"pai":"?","can_act":false},{"type":"dahai","actor":3,"pai":"W","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":0,"pai":"9s","can_act":true}]',
+        '[{"type":"dahai","actor":0,"pai":"W","tsumogiri":false,"can_act":false},{"type":"tsumo","actor":1,"pai":"?","can_act":false},{"type":"dahai","actor":1,"pai":"S","tsumogiri":true,"can_act":false},{"type":"tsumo","actor":2,"pai":"?","can_act":false},{"type":"dahai","actor":2,"pai":"7p","tsumogiri":true,"can_act":false}]',
+    ]
+    for line in inputs:
+        bot._apply_mjai_events(json.loads(line))
+        # discard_index を付けない観測では牌譜を走査して求める
+        obs = mjx.Observation(bot.state.to_json())
+        assert bot.discard_index.safe_tiles == agent._safe_tiles(obs)
+        assert bot.discard_index.riichi == agent._get_riichi_players(obs)
+        public = bot.get_obs()["publicObservation"]
+        rebuilt = DiscardIndex.from_events(public["events"], public["doraIndicators"])
+        assert rebuilt.safe_tiles == bot.discard_index.safe_tiles
+        assert rebuilt.riichi_turn == bot.discard_index.riichi_turn
+        assert rebuilt.visible == bot.discard_index.visible == agent._visible_tiles(obs)
+
+    assert bot.discard_index.riichi == [False, False, True, False]
+    assert bot.discard_index.riichi_turn == [None, None, 1, None]
+    assert bot.discard_index.num_discards == [3, 3, 3, 2]
+
+    bot._apply_mjai_events(json.loads('[{"type":"tsumo","actor":3,"pai":"?","can_act":false},{"type":"dahai","actor":3,"pai":"2s","tsumogiri":false,"can_act":false}]'))
+    assert 19 in bot.discard_index.safe_tiles[2]
+
+    bot._apply_mjai_events(json.loads(inputs[0]))
+    assert bot.discard_index.riichi == [False] * 4
+    assert bot.discard_index.safe_tiles == [set() for _ in range(4)]
+
+
 def test_shanten_agent_case6():
     player_id = 0
     bot = MjxGateway(player_id, ShantenAgent())
@@ -418,16 +805,7 @@ def test_kakan_value():
     assert op1.steal_from() == 1
 
     ev = {"pai": "C", "actor": 0}
-    obs = {
-        "who": 0,
-        "privateObservation": {
-            "currHand": {
-                "opens": [val],
-            }
-        },
-    }
-
-    value, _, _, _ = OpenCodeGen.from_mjai_kakan(ev, obs)
+    value, _, _, _ = OpenCodeGen.from_mjai_kakan(ev, [val])
     assert value == 51825
     op2 = mjx.open.Open(value)
     assert [t.id() for t in op2.tiles_from_hand()] == [132, 133, 135]
@@ -443,29 +821,64 @@ def test_kakan_value_other_actor():
     assert op1.last_tile().id() == 134
     assert op1.steal_from() == 1
 
-    ev = {"pai": "C", "actor": 0}
-    obs = {
-        "who": 1,
-        "privateObservation": {
-            "currHand": {
-                "opens": [val],
-            }
-        },
-        "publicObservation": {
-            "events": [
-                {"type": "EVENT_TYPE_PON", "open": val},
-            ],
-        },
-    }
+    # 他家のポンは DiscardIndex.pons から探す
+    index = DiscardIndex()
+    other_pon, _ = OpenCodeGen.from_mjai_pon(
+        {"type": "pon", "actor": 2, "target": 3, "pai": "P", "consumed": ["P", "P"]}, 126)
+    index.meld(2, other_pon)
+    index.meld(0, val)
+    assert index.pons == {31: other_pon, 33: val}
 
-    value, _, _, _ = OpenCodeGen.from_mjai_kakan(ev, obs)
+    ev = {"pai": "C", "actor": 0}
+    value, _, _, pon_code = OpenCodeGen.from_mjai_kakan(ev, index.pons.values())
     assert value == 51825
+    assert pon_code == val
+    # 加槓したポンは pons から消える
+    index.meld(0, value)
+    assert index.pons == {31: other_pon}
     op2 = mjx.open.Open(value)
     assert [t.id() for t in op2.tiles_from_hand()] == [132, 133, 135]
     assert [t.id() for t in op2.tiles()] == [132, 133, 134, 135]
     assert op2.last_tile().id() == 135
 
 
+def test_lowest_unseen_tile():
+    assert lowest_unseen_tile(0, 0) == 0
+    assert lowest_unseen_tile(0b0101, 0) == 1
+    assert lowest_unseen_tile(0b1111, 0) == -1
+    assert lowest_unseen_tile(0b1111, 1) == 4
+    assert lowest_unseen_tile(0, 4) == 16
+    assert lowest_unseen_tile(0, 4, exclude_red=True) == 17
+    assert lowest_unseen_tile(1 << 17, 4, exclude_red=True) == 18
+    assert lowest_unseen_tile(0, 3, exclude_red=True) == 12
+
+
+def test_other_actor_chi_uses_unseen_tiles():
+    bot = MjxGateway(0, None)
+    bot._apply_mjai_events([
+        {"type":"start_kyoku","bakaze":"E","dora_marker":"9s","kyoku":1,"honba":0,"kyotaku":0,"oya":0,"scores":[25000,25000,25000,25000],"tehais":[["1m","1m","2m","4p","5p","6p","7p","8p","1s","2s","3s","E","E"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"]]},
+        {"type":"tsumo","actor":0,"pai":"9p"},
+        {"type":"dahai","actor":0,"pai":"9p","tsumogiri":True},
+        {"type":"tsumo","actor":1,"pai":"?"},
+        {"type":"dahai","actor":1,"pai":"2m","tsumogiri":False},
+        {"type":"tsumo","actor":2,"pai":"?"},
+        {"type":"dahai","actor":2,"pai":"N","tsumogiri":False},
+        {"type":"tsumo","actor":3,"pai":"?"},
+        {"type":"dahai","actor":3,"pai":"N","tsumogiri":False},
+        {"type":"tsumo","actor":0,"pai":"9p"},
+        {"type":"dahai","actor":0,"pai":"9p","tsumogiri":True},
+        {"type":"tsumo","actor":1,"pai":"?"},
+        {"type":"dahai","actor":1,"pai":"3m","tsumogiri":False},
+        {"type":"chi","actor":2,"target":1,"pai":"3m","consumed":["1m","2m"]},
+    ])
+    # 1m は 0, 1 が手牌、2m は 4 が手牌で 5 が捨て牌なので 2 と 6 を晒す
+    open_code = bot.get_obs()["publicObservation"]["events"][-1]["open"]
+    assert [t.id() for t in mjx.open.Open(open_code).tiles()] == [2, 6, 8]
+    assert [t.id() for t in mjx.open.Open(open_code).tiles_from_hand()] == [2, 6]
+    for t in [0, 1, 2, 4, 5, 6, 8]:
+        assert bot.seen_tiles >> t & 1
+
+
 def test_rulebased_agent_kakan():
     player_id = 1
     bot = MjxGateway(player_id, RuleBasedAgent())
@@ -0,0 +1,63 @@
+import random
+
+from match import SPRT, pair_difference, pair_tasks
+
+
+def _run(sprt, rng, mean, sd, max_samples=100000):
+    while sprt.status() is None and sprt.n < max_samples:
+        sprt.add(rng.gauss(mean, sd))
+    return sprt.status()
+
+
+def test_sprt_accepts_h1_for_a_large_difference():
+    rng = random.Random(0)
+    sprt = SPRT(0.0, 0.1, alpha=0.05, beta=0.05)
+    assert _run(sprt, rng, 0.3, 1.0) == "H1"
+    # 差が大きければ少ないサンプルで止まる
+    assert sprt.n < 1000
+
+
+def test_sprt_accepts_h0_without_difference():
+    rng = random.Random(1)
+    sprt = SPRT(0.0, 0.1, alpha=0.05, beta=0.05)
+    assert _run(sprt, rng, 0.0, 1.0) == "H0"
+
+
+def test_sprt_error_rate():
+    rng = random.Random(2)
+    false_positives = sum(_run(SPRT(0.0, 0.2), rng, 0.0, 1.0) == "H1" for _ in range(200))
+    assert false_positives <= 20
+
+
+def test_sprt_waits_for_min_samples():
+    sprt = SPRT(0.0, 0.1, min_samples=30)
+    for _ in range(29):
+        sprt.add(5.0 + random.random())
+    assert sprt.status() is None
+
+
+def test_sprt_identical_agents():
+    sprt = SPRT(0.0, 0.1)
+    for _ in range(30):
+        sprt.add(0.0)
+    assert sprt.status() == "H0"
+
+
+def test_pair_tasks_share_wall_and_seat():
+    tasks = list(pair_tasks("rule", "rule:betaori_heuristics=0", "shanten", 5, seed=7))
+    assert len(tasks) == 10
+    for pair in range(5):
+        (game_a, seed_a, dealer_a, specs_a), (game_b, seed_b, dealer_b, specs_b) = tasks[2 * pair:2 * pair + 2]
+        assert (game_a, game_b) == (2 * pair, 2 * pair + 1)
+        assert seed_a == seed_b == 7 + pair
+        assert dealer_a == dealer_b == pair % 4
+        assert specs_a[pair % 4] == "rule" and specs_b[pair % 4] == "rule:betaori_heuristics=0"
+        assert [s for i, s in enumerate(specs_a) if i != pair % 4] == ["shanten"] * 3
+
+
+def test_pair_difference():
+    a = {"ranks": [2, 1, 3, 4], "scores": [30000, 40000, 20000, 10000]}
+    b = {"ranks": [1, 3, 2, 4], "scores": [35000, 22000, 30000, 13000]}
+    assert pair_difference(a, b, 1, "rank") == 2
+    assert pair_difference(a, b, 1, "score") == 18000
+    assert pair_difference(a, b, 0, "rank") == -1
@@ -0,0 +1,40 @@
+import mjx
+import mjxproto
+
+from meld import MELDS, MELD_CODES, meld_code
+
+
+def test_melds_match_mjx_open():
+    for code, meld in MELDS.items():
+        op = mjx.open.Open(code)
+        assert int(op.event_type()) == meld.kind
+        assert int(op.steal_from()) == meld.rel_pos
+        assert tuple(t.id() for t in op.tiles()) == meld.tiles
+        assert tuple(t.id() for t in op.tiles_from_hand()) == meld.tiles_from_hand
+        assert op.stolen_tile().id() == meld.stolen_tile
+        assert op.last_tile().id() == meld.last_tile
+        assert tuple(int(t.type()) for t in op.tiles()) == meld.tile_types
+
+
+def test_meld_codes_round_trip():
+    assert len(MELD_CODES) == len(MELDS)
+    for (kind, base_type, called, tile_ids, rel_pos), code in MELD_CODES.items():
+        meld = MELDS[code]
+        assert (meld.kind, meld.tile_types[0], meld.called, meld.rel_pos) == (kind, base_type, called, rel_pos)
+        if kind == mjxproto.EVENT_TYPE_ADDED_KAN:
+            assert tuple(sorted(tile_ids + (meld.last_tile,))) == meld.tiles
+        else:
+            assert tile_ids == meld.tiles
+
+
+def test_meld_code_bits():
+    # OpenCodeGen がビット演算で組み立てていた値と同じ
+    # チー 4m5m6m (5m は赤), 4m を上家から
+    assert meld_code(mjxproto.EVENT_TYPE_CHI, 3, 0, [13, 16, 20], 3) == (((0 * 7 + 3) * 3 + 0) << 10) + (0 << 7) + (0 << 5) + (1 << 3) + (1 << 2) + 3
+    # ポン 中 (133, 134 を晒して 132 を対面から)
+    assert meld_code(mjxproto.EVENT_TYPE_PON, 33, 0, [134, 133, 132], 2) == 2 + (1 << 3) + (3 << 5) + ((33 * 3 + 0) << 9)
+    # 加槓は同じポンのフラグだけが変わる
+    pon = 51817
+    assert meld_code(mjxproto.EVENT_TYPE_ADDED_KAN, 33, 2, [132, 133, 134], 1) == ((0xffff ^ (1 << 3)) & pon) | (1 << 4)
+    assert meld_code(mjxproto.EVENT_TYPE_CLOSED_KAN, 4, 0, [16, 17, 18, 19], 0) == 16 << 8
+    assert meld_code(mjxproto.EVENT_TYPE_OPEN_KAN, 4, 3, [16, 17, 18, 19], 1) == (19 << 8) + 1
@@ -0,0 +1,36 @@
+import pytest
+
+from selfplay import Summary, game_tasks, parse_agent_spec, run_games, _ranks
+
+
+def test_parse_agent_spec():
+    assert parse_agent_spec("rule") == ("rule", {})
+    assert parse_agent_spec("rule:betaori_heuristics=0,adjacency_heuristics=1") == (
+        "rule", {"betaori_heuristics": False, "adjacency_heuristics": True})
+    assert parse_agent_spec("shanten") == ("shanten", {})
+    with pytest.raises(ValueError):
+        parse_agent_spec("unknown")
+    with pytest.raises(ValueError):
+        parse_agent_spec("shanten:foo=1")
+
+
+def test_ranks_break_ties_by_seat():
+    assert _ranks([25000, 30000, 25000, 20000]) == [2, 1, 3, 4]
+
+
+def test_games_are_reproducible():
+    specs = ["rule", "shanten", "rule:betaori_heuristics=0", "tsumogiri"]
+    tasks = game_tasks(specs, 4, seed=123)
+    inline = sorted(run_games(tasks, num_workers=0), key=lambda r: r["game"])
+    pooled = sorted(run_games(tasks, num_workers=2), key=lambda r: r["game"])
+
+    strip = lambda r: {k: v for k, v in r.items() if k != "sec"}
+    assert [strip(r) for r in inline] == [strip(r) for r in pooled]
+
+    summary = Summary()
+    for result in inline:
+        assert sorted(result["ranks"]) == [1, 2, 3, 4]
+        assert sum(result["scores"]) <= 100000
+        summary.add(result)
+    assert summary.num_games == 4
+    assert abs(sum(row["average_rank"] for row in summary.rows()) - 10) < 1e-9
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import random
+
+from benchmark import synthetic_react_inputs
+from bot import RuleBasedAgent
+from gateway import MjxGateway
+from server import MjaiServer, _sessions, _tables
+from table import TableGateway, TableState
+
+
+INPUTS = [
+    '[{"type":"start_game","id":0}]',
+    '[{"type":"start_kyoku","bakaze":"E","dora_marker":"5p","kyoku":1,"honba":0,"kyotaku":0,"oya":0,"scores":[25000,25000,25000,25000],"tehais":[["S","2m","C","2m","7p","C","6m","7m","N","W","3p","6s","8s"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"],["?","?","?","?","?","?","?","?","?","?","?","?","?"]],"can_act":false},{"type":"tsumo","actor":0,"pai":"3p","can_act":true}]',
+    '[{"type":"dahai","actor":0,"pai":"S","tsumogiri":false,"can_act":false}]',
+    '[{"type":"tsumo","actor":1,"pai":"?","can_act":false}]',
+    '[{"type":"dahai","actor":1,"pai":"2m","tsumogiri":true,"can_act":true}]',
+]
+
+
+async def _play(path, lines):
+    reader, writer = await asyncio.open_unix_connection(path)
+    responses = []
+    for line in lines:
+        writer.write((line + "\n").encode())
+        await writer.drain()
+        responses.append((await reader.readline()).decode().strip())
+    writer.close()
+    await writer.wait_closed()
+    return responses
+
+
+async def _run_sessions(path, num_workers, num_sessions):
+    server = MjaiServer(num_workers)
+    listener = await server.start(path=path)
+    try:
+        results = await asyncio.gather(*[_play(path, INPUTS) for _ in range(num_sessions)])
+        num_requests = server.num_requests
+        listener.close()
+        await server.wait_sessions()
+        await listener.wait_closed()
+    finally:
+        server.shutdown()
+    return results, num_requests
+
+
+def test_server_sessions_match_gateway(tmp_path):
+    gateway = MjxGateway(0, RuleBasedAgent())
+    expected = [gateway.react(line) for line in INPUTS]
+
+    results, num_requests = asyncio.run(_run_sessions(str(tmp_path / "mjai.sock"), 0, 3))
+    assert results == [expected] * 3
+    assert num_requests == 3 * len(INPUTS)
+
+
+def test_server_with_worker_processes(tmp_path):
+    gateway = MjxGateway(0, RuleBasedAgent())
+    expected = [gateway.react(line) for line in INPUTS]
+
+    results, _ = asyncio.run(_run_sessions(str(tmp_path / "mjai.sock"), 2, 4))
+    assert results == [expected] * 4
+
+
+def test_server_requires_seat(tmp_path):
+    async def run(path):
+        server = MjaiServer(0)
+        listener = await server.start(path=path)
+        responses = await _play(path, [INPUTS[1]])
+        listener.close()
+        await server.wait_sessions()
+        return responses
+
+    responses = asyncio.run(run(str(tmp_path / "mjai.sock")))
+    assert json.loads(responses[0])["type"] == "error"
+
+
+def test_server_tables_share_state(tmp_path):
+    # 2 卓ぶんの 4 席を 1 行ずつゲーム順に送ると、卓ごとに TableState を共有した TableGateway と同じ応答になる
+    inputs = [synthetic_react_inputs(seat, num_kyokus=2, seed=10) for seat in range(4)]
+
+    def expected_responses():
+        random.seed(0)
+        tables = [TableState(), TableState()]
+        gateways = [TableGateway(tables[n // 4], n % 4, RuleBasedAgent()) for n in range(8)]
+        responses = [[] for _ in gateways]
+        for i in range(len(inputs[0])):
+            for n, gateway in enumerate(gateways):
+                responses[n].append(gateway.react(inputs[n % 4][i]))
+        return responses
+
+    async def run(path):
+        server = MjaiServer(0, tables=True)
+        listener = await server.start(path=path)
+        connections = [await asyncio.open_unix_connection(path) for _ in range(8)]
+        responses = [[] for _ in connections]
+        random.seed(0)
+        for i in range(len(inputs[0])):
+            for n, (reader, writer) in enumerate(connections):
+                writer.write((inputs[n % 4][i] + "\n").encode())
+                await writer.drain()
+                responses[n].append((await reader.readline()).decode().strip())
+            if i == 0:
+                # 席を送った順に 4 席ずつ 1 卓になる
+                assert len(_tables) == 2
+                assert len({id(gateway.table) for gateway in _sessions.values()}) == 2
+        for _, writer in connections:
+            writer.close()
+            await writer.wait_closed()
+        listener.close()
+        await server.wait_sessions()
+        return responses
+
+    expected = expected_responses()
+    responses = asyncio.run(run(str(tmp_path / "mjai.sock")))
+    assert responses == expected
+    assert any(json.loads(r)["type"] == "dahai" for r in responses[0])
+    assert _sessions == {} and _tables == {}
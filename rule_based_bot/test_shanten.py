@@ -0,0 +1,140 @@
+import json
+import random
+
+import mjx
+import mjxproto
+
+from meld import MELDS
+from shanten import (
+    ShantenCache,
+    closed_tile_type_counts,
+    table_shanten_number,
+    table_shanten_and_effective_draw_types,
+)
+
+
+def _random_hand(rng, num_tiles=13):
+    return sorted(rng.sample(range(136), num_tiles))
+
+
+def _random_concentrated_hand(rng, num_tiles=13):
+    # 一様な乱択だと向聴数の大きい手ばかりになるので、牌種を絞って聴牌近くの手も作る
+    tile_types = rng.sample(range(34), rng.randint(5, 9))
+    pool = [t * 4 + i for t in tile_types for i in range(4)]
+    return sorted(rng.sample(pool, num_tiles))
+
+
+def _type_counts(tile_types):
+    counts = [0] * 34
+    for t in tile_types:
+        counts[t] += 1
+    return counts
+
+
+def test_closed_tile_type_counts():
+    counts = closed_tile_type_counts([0, 1, 4, 135])
+    assert len(counts) == 34
+    assert counts[0] == 2
+    assert counts[1] == 1
+    assert counts[33] == 1
+    assert sum(counts) == 4
+
+
+def test_shanten_cache_matches_mjx_hand():
+    rng = random.Random(0)
+    cache = ShantenCache()
+    for _ in range(200):
+        closed_tiles = _random_hand(rng)
+        hand = mjx.Hand(json.dumps({"closedTiles": closed_tiles, "opens": []}))
+        shanten_number, effective_draw_types = cache.get(closed_tiles, [])
+        assert shanten_number == hand.shanten_number()
+        assert list(effective_draw_types) == [int(t) for t in hand.effective_draw_types()]
+
+
+def test_shanten_cache_counts_and_evicts():
+    cache = ShantenCache(maxsize=2)
+    hand_a = [0, 4, 8, 12, 16, 20, 24, 28, 32, 36, 40, 44, 48]
+    # 同じ牌種で id だけが異なる手牌は同じエントリを使う
+    hand_a_other_ids = [1, 5, 9, 13, 17, 21, 25, 29, 33, 37, 41, 45, 49]
+    hand_b = [0, 1, 2, 8, 12, 16, 20, 24, 28, 32, 36, 40, 44]
+    hand_c = [108, 109, 112, 113, 116, 117, 120, 121, 124, 125, 128, 129, 132]
+
+    cache.get(hand_a, [])
+    cache.get(hand_a_other_ids, [])
+    assert cache.info()["hits"] == 1
+    assert cache.info()["misses"] == 1
+
+    cache.get(hand_b, [])
+    cache.get(hand_c, [])
+    assert cache.info()["size"] == 2
+    cache.get(hand_a, [])
+    assert cache.info()["misses"] == 4
+
+
+def test_table_shanten_matches_mjx_hand():
+    rng = random.Random(1)
+    for i in range(1000):
+        num_tiles = 13 if i % 3 else 14
+        closed_tiles = _random_hand(rng, num_tiles) if i % 2 else _random_concentrated_hand(rng, num_tiles)
+        hand = mjx.Hand(json.dumps({"closedTiles": closed_tiles, "opens": []}))
+        counts = closed_tile_type_counts(closed_tiles)
+        assert table_shanten_number(counts) == hand.shanten_number(), closed_tiles
+        if num_tiles == 13:
+            shanten_number, effective_draw_types = table_shanten_and_effective_draw_types(counts)
+            assert shanten_number == hand.shanten_number()
+            assert list(effective_draw_types) == [int(t) for t in hand.effective_draw_types()], closed_tiles
+
+
+def test_table_shanten_special_forms():
+    # 七対子の聴牌
+    assert table_shanten_number(_type_counts([0, 0, 2, 2, 4, 4, 12, 12, 19, 19, 27, 27, 33])) == 0
+    # 国士無双の 13 面待ち
+    thirteen_orphans = _type_counts([0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33])
+    assert table_shanten_and_effective_draw_types(thirteen_orphans) == \
+        (0, (0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33))
+    # 鳴いていれば七対子・国士無双は考えない
+    assert table_shanten_number(_type_counts([0, 0, 2, 2, 4, 4, 12, 12, 19, 19]), 1) == 2
+    # 和了形は -1
+    assert table_shanten_number(_type_counts([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 9, 10, 10])) == -1
+    assert table_shanten_and_effective_draw_types(_type_counts([0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 9, 10])) == \
+        (0, (10, 11))
+
+
+def test_shanten_cache_use_table():
+    rng = random.Random(2)
+    mjx_cache = ShantenCache()
+    table_cache = ShantenCache(use_table=True)
+    for _ in range(200):
+        closed_tiles = _random_concentrated_hand(rng)
+        assert table_cache.get(closed_tiles, []) == mjx_cache.get(closed_tiles, [])
+
+
+def _reference_call_reduces_shanten(closed_tiles, meld):
+    # 鳴く牌を加えて、面子に含まれない手牌を 1 枚ずつ切ってみる (RuleBasedAgent の以前の実装)
+    def shanten_number(tile_ids):
+        return mjx.Hand(json.dumps({"closedTiles": tile_ids, "opens": []})).shanten_number()
+    curr_shanten = shanten_number(closed_tiles)
+    for tile_id in closed_tiles:
+        if tile_id // 4 in meld.tile_types:
+            continue
+        ids_after_call = closed_tiles + [meld.stolen_tile]
+        ids_after_call.remove(tile_id)
+        if shanten_number(ids_after_call) < curr_shanten:
+            return True
+    return False
+
+
+def test_call_reduces_shanten_matches_reference():
+    rng = random.Random(3)
+    cache = ShantenCache()
+    calls = [m for m in MELDS.values() if m.kind in (mjxproto.EVENT_TYPE_CHI, mjxproto.EVENT_TYPE_PON)]
+    for _ in range(50):
+        closed_tiles = _random_concentrated_hand(rng)
+        counts = closed_tile_type_counts(closed_tiles)
+        for meld in calls:
+            if meld.stolen_tile in closed_tiles or not set(meld.tiles_from_hand) <= set(closed_tiles):
+                continue
+            ok = cache.call_reduces_shanten(counts, [], meld.stolen_tile // 4, meld.tile_types)[0]
+            assert ok == _reference_call_reduces_shanten(closed_tiles, meld), (closed_tiles, meld)
+    # 赤や id だけが違うチーは同じエントリを使う
+    assert cache.info()["call_hits"] > 0
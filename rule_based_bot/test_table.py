@@ -0,0 +1,168 @@
+import json
+import random
+
+from benchmark import synthetic_kyoku, synthetic_react_inputs
+from bot import RuleBasedAgent
+from gateway import MjxGateway, json_dumps
+from table import TableState, TableGateway
+
+
+def _events_by_seat(seed):
+    return [synthetic_kyoku(seat, seed=seed, num_draws=40) for seat in range(4)]
+
+
+def _tile_types(tiles):
+    return sorted(t // 4 for t in tiles)
+
+
+def _public_rows(obs):
+    return [
+        (e.get("type"), e.get("who", 0), e.get("tile", 0) // 4)
+        for e in obs["publicObservation"]["events"]
+    ]
+
+
+def test_table_matches_separate_gateways():
+    for seed, order in [(0, [0, 1, 2, 3]), (1, [3, 2, 1, 0]), (2, [2, 0, 3, 1])]:
+        events = _events_by_seat(seed)
+        gateways = [MjxGateway(seat, None) for seat in range(4)]
+        table = TableState()
+        table_gateways = [TableGateway(table, seat, None) for seat in range(4)]
+
+        for i in range(len(events[0])):
+            for seat in order:
+                gateways[seat]._apply_mjai_events([events[seat][i]])
+                table_gateways[seat]._apply_mjai_events([events[seat][i]])
+
+            for seat in range(4):
+                obs = gateways[seat].get_obs()
+                table_obs = table_gateways[seat].get_obs()
+                assert table_gateways[seat].state.to_json() == json_dumps(table_obs)
+                assert _tile_types(table_gateways[seat].get_obs_hand()) == _tile_types(gateways[seat].get_obs_hand())
+                assert _public_rows(table_obs) == _public_rows(obs)
+                assert table_gateways[seat].get_obs_open() == gateways[seat].get_obs_open()
+
+        # 牌 id は卓全体で一意
+        tiles = list(table.kyoku.dora_indicators)
+        for seat in range(4):
+            tiles += table_gateways[seat].get_obs_hand()
+        tiles += [e["tile"] for e in table.kyoku.events if "tile" in e]
+        assert len(tiles) == len(set(tiles))
+
+        # 公開部分は 1 つだけ
+        assert all(gateway.state.kyoku is table.kyoku for gateway in table_gateways)
+        for seat in range(4):
+            assert table_gateways[seat].discard_index.safe_tiles == gateways[seat].discard_index.safe_tiles
+
+
+def _mask(events, seat):
+    masked = []
+    for event in events:
+        event = dict(event)
+        if event["type"] == "start_kyoku":
+            event["tehais"] = [tehai if i == seat else ["?"] * 13 for i, tehai in enumerate(event["tehais"])]
+        elif event["type"] == "tsumo" and event["actor"] != seat:
+            event["pai"] = "?"
+        masked.append(event)
+    return masked
+
+
+def test_table_pon_matches_separate_gateways():
+    events = [
+        {"type": "start_kyoku", "bakaze": "E", "kyoku": 1, "honba": 0, "kyotaku": 0, "oya": 0,
+         "scores": [25000, 25000, 25000, 25000], "dora_marker": "3m",
+         "tehais": [
+             ["1m", "1m", "2p", "3p", "4p", "5s", "6s", "7s", "E", "E", "S", "W", "N"],
+             ["2m", "3m", "4m", "6p", "7p", "8p", "2s", "3s", "4s", "P", "P", "F", "C"],
+             ["9m", "9m", "9m", "9p", "1s", "1s", "9s", "9s", "S", "S", "W", "W", "N"],
+             ["5m", "6m", "7m", "1p", "2p", "3p", "4s", "5s", "6s", "7p", "8p", "9p", "C"],
+         ]},
+        {"type": "tsumo", "actor": 0, "pai": "8m"},
+        {"type": "dahai", "actor": 0, "pai": "8m", "tsumogiri": True},
+        {"type": "tsumo", "actor": 1, "pai": "1m"},
+        {"type": "dahai", "actor": 1, "pai": "1m", "tsumogiri": True},
+        {"type": "pon", "actor": 0, "target": 1, "pai": "1m", "consumed": ["1m", "1m"]},
+        {"type": "dahai", "actor": 0, "pai": "N", "tsumogiri": False},
+        {"type": "tsumo", "actor": 1, "pai": "2m"},
+        {"type": "dahai", "actor": 1, "pai": "2m", "tsumogiri": True},
+        {"type": "tsumo", "actor": 2, "pai": "9m"},
+        {"type": "ankan", "actor": 2, "consumed": ["9m", "9m", "9m", "9m"]},
+        {"type": "dora", "dora_marker": "7s"},
+        {"type": "tsumo", "actor": 2, "pai": "1p"},
+        {"type": "dahai", "actor": 2, "pai": "N", "tsumogiri": False},
+    ]
+    gateways = [MjxGateway(seat, None) for seat in range(4)]
+    table = TableState()
+    table_gateways = [TableGateway(table, seat, None) for seat in range(4)]
+    for seat in range(4):
+        gateways[seat]._apply_mjai_events(_mask(events, seat))
+    for event in events:
+        for seat in [3, 2, 1, 0]:
+            table_gateways[seat]._apply_mjai_events(_mask([event], seat))
+
+    for seat in range(4):
+        assert _tile_types(table_gateways[seat].get_obs_hand()) == _tile_types(gateways[seat].get_obs_hand())
+        assert _public_rows(table_gateways[seat].get_obs()) == _public_rows(gateways[seat].get_obs())
+        assert _tile_types(table_gateways[seat].get_obs()["publicObservation"]["doraIndicators"]) == [2, 24]
+        # 槓ドラの表示牌も見えている牌に数える
+        assert table_gateways[seat].discard_index.visible == gateways[seat].discard_index.visible
+        assert table_gateways[seat].discard_index.visible[24] == 1
+    assert table_gateways[0].get_obs_open() == gateways[0].get_obs_open()
+    assert len(table_gateways[0].get_obs_hand()) == 10
+
+
+def _index_fields(index):
+    return (
+        index.discarded, index.safe_tiles, index.num_discards, index.riichi,
+        index.riichi_turn, index.visible,
+    )
+
+
+def test_lagging_seat():
+    events = _events_by_seat(3)
+    table = TableState()
+    table_gateways = [TableGateway(table, seat, None) for seat in range(3)]
+    table_gateways.append(TableGateway(table, 3, RuleBasedAgent()))
+    gateway = MjxGateway(3, RuleBasedAgent())
+
+    # 4 番目の席は自分が行動できるイベントまでまとめて後から受け取る
+    begin = 0
+    for i in range(len(events[0])):
+        for seat in range(3):
+            table_gateways[seat]._apply_mjai_events([events[seat][i]])
+        if events[3][i]["can_act"] or i == len(events[0]) - 1:
+            batch = events[3][begin:i + 1]
+            begin = i + 1
+            # 追いつくまでの各時点でも、単独の MjxGateway と同じものが見えている
+            for event in batch[:-1]:
+                table_gateways[3]._apply_mjai_events([event])
+                gateway._apply_mjai_events([event])
+                assert _public_rows(table_gateways[3].get_obs()) == _public_rows(gateway.get_obs())
+                assert _index_fields(table_gateways[3].discard_index) == _index_fields(gateway.discard_index)
+            random.seed(i)
+            response = table_gateways[3].react(json_dumps(batch[-1:]))
+            random.seed(i)
+            assert response == gateway.react(json_dumps(batch[-1:]))
+            assert _public_rows(table_gateways[3].get_obs()) == _public_rows(gateway.get_obs())
+            assert _tile_types(table_gateways[3].get_obs()["publicObservation"]["doraIndicators"]) == _tile_types(
+                gateway.get_obs()["publicObservation"]["doraIndicators"])
+            assert _tile_types(table_gateways[3].get_obs_hand()) == _tile_types(gateway.get_obs_hand())
+            assert _index_fields(table_gateways[3].discard_index) == _index_fields(gateway.discard_index)
+
+
+def test_table_react_matches_separate_gateways():
+    inputs = [synthetic_react_inputs(seat, num_kyokus=2, seed=10) for seat in range(4)]
+
+    def play(gateways):
+        random.seed(0)
+        responses = []
+        for i in range(len(inputs[0])):
+            for seat in range(4):
+                responses.append(gateways[seat].react(inputs[seat][i]))
+        return responses
+
+    table = TableState()
+    expected = play([MjxGateway(seat, RuleBasedAgent()) for seat in range(4)])
+    actual = play([TableGateway(table, seat, RuleBasedAgent()) for seat in range(4)])
+    assert actual == expected
+    assert any(json.loads(r)["type"] == "dahai" for r in actual)